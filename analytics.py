@@ -0,0 +1,164 @@
+"""
+Rolling rating analytics: karma gained this week, this month, trending now.
+
+A `WindowCounter` keeps a ring of time buckets (e.g. 7 daily buckets), each
+bucket a dict member -> karma gained in it, plus the running window totals.
+A rating event is O(1): one bucket entry and one total; a bucket is expired
+(subtracted from the totals) when the ring wraps over it. Queries pick the
+top of the totals: nothing is summed over history, and memory is bounded by
+the window (buckets x members active in them), not by the number of events.
+
+`RatingAnalytics` keeps one counter per window for all chats and per chat.
+The counters of a chat with no events for longer than the longest window
+hold nothing: they are dropped by `advance()`, which `add()` runs once per
+shortest bucket.
+"""
+
+import heapq
+
+# # name -> (bucket seconds, buckets)
+WINDOWS = {
+    "week": (24 * 3600, 7),
+    "month": (24 * 3600, 30),
+    "trending": (3600, 24),
+}
+
+
+def _order(item):
+    member, total = item
+    return (-total, str(member))
+
+
+class WindowCounter:
+    """ Sums of values per member over the last `buckets` x `bucket_seconds` """
+
+    def __init__(self, bucket_seconds, buckets):
+        self.bucket_seconds = bucket_seconds
+        self.buckets = buckets
+        self.totals = {}  # member -> sum over the live buckets (zero sums are left out)
+        self._ring = [{} for _ in range(buckets)]
+        self._current = None  # number of the newest bucket
+
+    def __len__(self):
+        return len(self.totals)
+
+    @property
+    def entries(self):
+        """ Bucket entries held: the memory the counter takes """
+        return sum(len(counts) for counts in self._ring) + len(self.totals)
+
+    def add(self, member, value, ts):
+        bucket = int(ts // self.bucket_seconds)
+        self._advance(bucket)
+        if bucket <= self._current - self.buckets:
+            # # older than the window
+            return
+        counts = self._ring[bucket % self.buckets]
+        counts[member] = counts.get(member, 0) + value
+        self._set_total(member, self.totals.get(member, 0) + value)
+
+    def advance(self, ts):
+        """ Expire the buckets that left the window by `ts` """
+        self._advance(int(ts // self.bucket_seconds))
+
+    def _advance(self, bucket):
+        if self._current is None:
+            self._current = bucket
+            return
+        if bucket <= self._current:
+            return
+        if bucket - self._current >= self.buckets:
+            # # idle longer than the window: everything expired
+            self._ring = [{} for _ in range(self.buckets)]
+            self.totals = {}
+            self._current = bucket
+            return
+        while self._current < bucket:
+            self._current += 1
+            slot = self._current % self.buckets
+            for member, value in self._ring[slot].items():
+                self._set_total(member, self.totals.get(member, 0) - value)
+            self._ring[slot] = {}
+
+    def _set_total(self, member, total):
+        if total:
+            self.totals[member] = total
+        else:
+            self.totals.pop(member, None)
+
+    def top(self, count, offset=0, ts=None):
+        """ [(place, member, sum)] of the window ending at `ts`, highest first (ties — by member) """
+        if ts is not None:
+            self.advance(ts)
+        best = heapq.nsmallest(offset + count, self.totals.items(), key=_order)
+        return [(offset + n + 1, member, total) for n, (member, total) in enumerate(best[offset:])]
+
+    def place(self, member):
+        """ 1-based place of the member, None if it gained nothing in the window """
+        if member not in self.totals:
+            return None
+        key = _order((member, self.totals[member]))
+        return 1 + sum(1 for item in self.totals.items() if _order(item) < key)
+
+
+class RatingAnalytics:
+    """ Window counters of all chats and of every chat """
+
+    def __init__(self, windows=None):
+        self.windows = dict(windows or WINDOWS)
+        self.all = {name: WindowCounter(*window) for name, window in self.windows.items()}
+        self.chats = {}  # chat id -> {window name -> WindowCounter}
+        self.last_seen = {}  # chat id -> unix time of its newest event
+        self._sweep_seconds = min(seconds for seconds, _ in self.windows.values())
+        self._swept_at = None
+
+    @property
+    def span(self):
+        """ Seconds of the longest window: how much history `load()` needs """
+        return max(seconds * buckets for seconds, buckets in self.windows.values())
+
+    def add(self, member, value, ts, chat_id=None):
+        """ A rating event: `value` karma to `member` at unix time `ts` """
+        if member is None:
+            return
+        if self._swept_at is None or ts - self._swept_at >= self._sweep_seconds:
+            self.advance(ts)
+        for counter in self.all.values():
+            counter.add(member, value, ts)
+        if chat_id:
+            self.last_seen[chat_id] = max(ts, self.last_seen.get(chat_id, ts))
+            counters = self.chats.get(chat_id)
+            if counters is None:
+                counters = self.chats[chat_id] = {name: WindowCounter(*window) for name, window in self.windows.items()}
+            for counter in counters.values():
+                counter.add(member, value, ts)
+
+    def advance(self, ts):
+        """ Expire old buckets of all chats and drop the counters of chats idle for the longest window """
+        for counter in self.all.values():
+            counter.advance(ts)
+        span = self.span
+        for chat_id in [chat_id for chat_id, seen in self.last_seen.items() if ts - seen > span]:
+            del self.last_seen[chat_id]
+            self.chats.pop(chat_id, None)
+        self._swept_at = ts
+
+    def load(self, events):
+        """ Replay (member, value, ts, chat_id) events, oldest first """
+        for member, value, ts, chat_id in events:
+            self.add(member, value, ts, chat_id=chat_id)
+        return self
+
+    @property
+    def entries(self):
+        return sum(counter.entries for counter in self.all.values()) + sum(
+            counter.entries for counters in self.chats.values() for counter in counters.values())
+
+    def counter(self, window, chat_id=None, ts=None):
+        """ The window counter of a chat (all chats if None), advanced to `ts` """
+        counter = self.all[window] if chat_id is None else self.chats.get(chat_id, {}).get(window)
+        if counter is None:
+            return WindowCounter(*self.windows[window])
+        if ts is not None:
+            counter.advance(ts)
+        return counter
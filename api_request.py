@@ -0,0 +1,43 @@
+"""
+Bot API transport with timing.
+
+`TimedRequest` wraps the request object of the `Bot` (by default PTB's
+`HTTPXRequest`) and records the latency of every Bot API call per method
+(sendMessage, sendAnimation, ...) and its HTTP status in a histogram.
+"""
+
+import time
+
+from telegram.request import BaseRequest, HTTPXRequest
+
+
+class TimedRequest(BaseRequest):
+    """ Delegates to `inner`, observing the latency of each call """
+
+    def __init__(self, histogram, inner=None):
+        self.histogram = histogram  # labels: method, status
+        self.inner = inner if inner is not None else HTTPXRequest(connection_pool_size=256)
+
+    @property
+    def read_timeout(self):
+        return self.inner.read_timeout
+
+    async def initialize(self):
+        await self.inner.initialize()
+
+    async def shutdown(self):
+        await self.inner.shutdown()
+
+    async def do_request(self, url, method, request_data=None, read_timeout=BaseRequest.DEFAULT_NONE,
+                         write_timeout=BaseRequest.DEFAULT_NONE, connect_timeout=BaseRequest.DEFAULT_NONE,
+                         pool_timeout=BaseRequest.DEFAULT_NONE):
+        endpoint = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        status = "error"
+        try:
+            status, payload = await self.inner.do_request(url, method, request_data=request_data,
+                                                          read_timeout=read_timeout, write_timeout=write_timeout,
+                                                          connect_timeout=connect_timeout, pool_timeout=pool_timeout)
+            return status, payload
+        finally:
+            self.histogram.observe(time.perf_counter() - started, endpoint, str(status))
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""
+Rolling week/month/trending counters fed with a year of synthetic rating events.
+
+Prints throughput and the bucket entries held after every simulated month:
+memory follows the window size, not the number of events fed.
+
+Usage:
+    python benchmarks/bench_analytics.py [--events 3000000] [--users 20000] [--chats 200] [--days 365]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from analytics import RatingAnalytics  # noqa: E402
+
+DAY = 24 * 3600
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--events", type=int, default=3_000_000)
+    parser.add_argument("--users", type=int, default=20_000)
+    parser.add_argument("--chats", type=int, default=200)
+    parser.add_argument("--days", type=int, default=365)
+    args = parser.parse_args()
+
+    analytics = RatingAnalytics()
+    started_at = 1_700_000_000
+    step = args.days * DAY / args.events
+    report_every = args.events // (args.days // 30 or 1)
+    users = list(range(1, args.users + 1))
+    chats = [-1000 - n for n in range(args.chats)]
+
+    elapsed = 0.0
+    fed = 0
+    print(f"{'events fed':>12} {'day':>5} {'entries held':>13} {'events/s':>10}")
+    while fed < args.events:
+        batch = min(report_every, args.events - fed)
+        events = [(random.choice(users), 1 if random.random() < 0.8 else -1, started_at + (fed + n) * step,
+                   random.choice(chats)) for n in range(batch)]
+        began = time.perf_counter()
+        analytics.load(events)
+        took = time.perf_counter() - began
+        elapsed += took
+        fed += batch
+        print(f"{fed:>12,} {int(fed * step / DAY):>5} {analytics.entries:>13,} {batch / took:>10,.0f}")
+
+    ts = started_at + args.events * step
+    began = time.perf_counter()
+    for chat_id in chats:
+        for window in analytics.windows:
+            analytics.counter(window, chat_id=chat_id, ts=ts).top(10)
+    queries = len(chats) * len(analytics.windows)
+    print(f"total: {args.events:,} events at {args.events / elapsed:,.0f} events/s; "
+          f"top-10 query: {(time.perf_counter() - began) / queries * 1e6:.0f} us")
+
+
+if __name__ == '__main__':
+    main()
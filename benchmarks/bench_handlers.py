@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+"""
+End-to-end handler benchmark: synthetic updates through the real Application, no network.
+
+Every scenario builds Telegram `Update`s (reply "+", emoji rating, "+ @mention",
+"+ @a @b", plain chatter, /about, /top, ratings of new users) and puts them on
+the `update_queue` of the running `plus_bot` Application, as polling or the
+webhook would: the `InFlightQueue` backpressure (`--concurrency` updates in
+flight) and the `ShardedUpdateProcessor` queues are part of the numbers. The
+Bot talks to a `FakeRequest` that records API calls and answers like Telegram
+would. The bot runs in a temporary directory with a seeded user table.
+
+Per scenario: throughput, latency percentiles (from offering an update to the
+queue until its handlers are done), average wait in the shard queues, peak
+traced memory and net allocated blocks per update, file reads/writes (from
+/proc/self/io, Linux) and API calls made. `--json` writes the results together with the commit
+and parameters, so runs of different commits can be diffed.
+
+Usage:
+    python benchmarks/bench_handlers.py [--updates 2000] [--users 1000] [--concurrency 1] [--json results.json]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from telegram import Update  # noqa: E402
+from telegram.ext import TypeHandler  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+BOT_ID = 1968168927
+CHAT_ID = -100200300
+DONE_GROUP = 100  # handler group after all the bot's handlers
+
+
+class FakeRequest(BaseRequest):
+    """ Bot API transport that answers locally and counts the calls """
+
+    def __init__(self):
+        self.calls = {}
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        params = request_data.parameters if request_data is not None else {}
+        return 200, json.dumps({"ok": True, "result": self._result(endpoint, params)}).encode()
+
+    def _result(self, endpoint, params):
+        if endpoint == "getMe":
+            return {"id": BOT_ID, "is_bot": True, "first_name": "Plus", "username": "plus_bot"}
+        if endpoint.startswith("send"):
+            self._message_id += 1
+            message = {"message_id": self._message_id, "date": int(time.time()),
+                       "chat": {"id": int(params.get("chat_id", CHAT_ID)), "type": "supergroup"},
+                       "text": params.get("text") or params.get("caption")}
+            if endpoint == "sendAnimation":
+                message["animation"] = {"file_id": f"anim{self._message_id}", "file_unique_id": f"u{self._message_id}",
+                                        "width": 1, "height": 1, "duration": 1}
+            return message
+        return True
+
+
+# # —— Synthetic updates
+class UpdateFactory:
+    def __init__(self, users):
+        self.users = users
+        self.update_id = 0
+        self.message_id = 0
+
+    @staticmethod
+    def user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"First{user_id}", "last_name": f"Last{user_id}",
+                "username": f"user{user_id}"}
+
+    def message(self, text, from_id, reply_to=None, entities=()):
+        self.update_id += 1
+        self.message_id += 1
+        message = {"message_id": self.message_id, "date": int(time.time()),
+                   "chat": {"id": CHAT_ID, "type": "supergroup", "title": "Bench chat"},
+                   "from": self.user(from_id), "text": text}
+        if reply_to is not None:
+            message["reply_to_message"] = {"message_id": self.message_id - 1, "date": int(time.time()),
+                                           "chat": message["chat"], "from": self.user(reply_to), "text": "hi"}
+        if entities:
+            message["entities"] = [dict(entity) for entity in entities]
+        return {"update_id": self.update_id, "message": message}
+
+    def pair(self):
+        giver, receiver = random.sample(self.users, 2)
+        return giver, receiver
+
+    def reply_plus(self):
+        giver, receiver = self.pair()
+        return self.message(random.choice("+-+"), giver, reply_to=receiver)
+
+    def emoji(self):
+        giver, receiver = self.pair()
+        return self.message(random.choice(["👍", "🙂", "👎"]), giver, reply_to=receiver)
+
+    def mention(self):
+        giver, receiver = self.pair()
+        name = f"@user{receiver}"
+        return self.message(f"+ {name}", giver, entities=[{"type": "mention", "offset": 2, "length": len(name)}])
+
+    def multi_mention(self):
+        giver, first, second = random.sample(self.users, 3)
+        text = f"+ @user{first} @user{second}"
+        second_at = text.index(" @", 2) + 1
+        return self.message(text, giver, entities=[
+            {"type": "mention", "offset": 2, "length": second_at - 3},
+            {"type": "mention", "offset": second_at, "length": len(text) - second_at}])
+
+    def chatter(self):
+        giver, _ = self.pair()
+        return self.message(random.choice(["ok", "lol", "кто идёт сегодня?", "thanks!", "1+1=2"]), giver)
+
+    def about(self):
+        giver, receiver = self.pair()
+        return self.message(f"/about @user{receiver}", giver,
+                            entities=[{"type": "bot_command", "offset": 0, "length": 6}])
+
+    def top(self):
+        giver, _ = self.pair()
+        return self.message("/top", giver, entities=[{"type": "bot_command", "offset": 0, "length": 4}])
+
+    def new_user(self):
+        giver, _ = self.pair()
+        self.users.append(max(self.users) + 1)
+        return self.message("+", giver, reply_to=self.users[-1])
+
+
+SCENARIOS = ("reply_plus", "emoji", "mention", "multi_mention", "chatter", "about", "top", "new_user")
+
+
+# # —— Measurements
+def proc_io():
+    """ (read syscalls, write syscalls, bytes read, bytes written) of the process, zeros if unknown """
+    try:
+        with open("/proc/self/io", "r") as f:
+            fields = dict(line.split(":") for line in f)
+        return tuple(int(fields[name]) for name in ("syscr", "syscw", "rchar", "wchar"))
+    except (OSError, KeyError, ValueError):
+        return (0, 0, 0, 0)
+
+
+def percentile(sorted_values, share):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * share))] if sorted_values else 0.0
+
+
+class Completions:
+    """ Time from putting an update on the queue until its handlers are done """
+
+    def __init__(self):
+        self.queued_at = {}  # update id -> perf_counter() when offered to the queue
+        self.latencies = []
+
+    async def processed(self, update, context):
+        queued_at = self.queued_at.pop(update.update_id, None)
+        if queued_at is not None:
+            self.latencies.append(time.perf_counter() - queued_at)
+
+
+async def run_updates(application, completions, updates, drain=None):
+    completions.latencies = []
+    started = time.perf_counter()
+    for update in updates:
+        # # the clock starts before put(): waiting for room in the InFlightQueue counts
+        completions.queued_at[update.update_id] = time.perf_counter()
+        await application.update_queue.put(update)
+    await application.update_queue.join()
+    if drain is not None:
+        # # coalesced ratings are written after their window: count them in
+        await drain()
+    return time.perf_counter() - started, completions.latencies
+
+
+async def run_scenario(name, application, completions, processor, factory, request, count, drain=None):
+    bot = application.bot
+    make = getattr(factory, name)
+    updates = [Update.de_json(make(), bot) for _ in range(count)]
+    warmup = [Update.de_json(make(), bot) for _ in range(min(50, count))]
+    await run_updates(application, completions, warmup, drain)
+
+    calls_before = sum(request.calls.values())
+    processed_before, wait_before = processor.processed, processor.wait_total
+    io_before = proc_io()
+    elapsed, latencies = await run_updates(application, completions, updates, drain)
+    io_after = proc_io()
+    calls = sum(request.calls.values()) - calls_before
+    processed = processor.processed - processed_before
+    wait = processor.wait_total - wait_before
+
+    # # memory in a separate pass: tracing slows everything down
+    traced = [Update.de_json(make(), bot) for _ in range(min(200, count))]
+    blocks_before = sys.getallocatedblocks()
+    tracemalloc.start()
+    await run_updates(application, completions, traced, drain)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    blocks = sys.getallocatedblocks() - blocks_before
+
+    latencies.sort()
+    return {
+        "updates": count,
+        "seconds": round(elapsed, 4),
+        "updates_per_s": round(count / elapsed, 1),
+        "latency_ms": {label: round(percentile(latencies, share) * 1000, 3)
+                       for label, share in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0))},
+        "queue_wait_ms_avg": round(wait / processed * 1000, 3) if processed else 0.0,
+        "alloc_peak_kib": round(peak / 1024, 1),
+        "net_blocks_per_update": round(blocks / len(traced), 1),
+        "read_syscalls_per_update": round((io_after[0] - io_before[0]) / count, 2),
+        "write_syscalls_per_update": round((io_after[1] - io_before[1]) / count, 2),
+        "bytes_written_per_update": round((io_after[3] - io_before[3]) / count, 1),
+        "api_calls_per_update": round(calls / count, 2),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+async def bench(args, plus_bot):
+    request = FakeRequest()
+    application = plus_bot.build_application(token="123456:BENCH", request=request)
+    # # intake waits above `--concurrency` updates in flight
+    application.update_queue.limit = args.concurrency
+    completions = Completions()
+    application.add_handler(TypeHandler(Update, completions.processed), group=DONE_GROUP)
+    factory = UpdateFactory(list(range(1000, 1000 + args.users)))
+    results = {}
+
+    async def drain():
+        # # ratings waiting in the coalescer, then the replies queued in the outbox
+        await plus_bot.RATING_COALESCER.drain()
+        await plus_bot.OUTBOX.drain()
+
+    async with application:
+        # # running: the update fetcher takes updates off the queue, coalesced rating writes are its tasks
+        await application.start()
+        for name in args.scenarios:
+            results[name] = await run_scenario(name, application, completions, plus_bot.UPDATE_PROCESSOR, factory, 
+                                               request, args.updates, drain=drain)
+            row = results[name]
+            print(f"{name:<13} {row['updates_per_s']:>9,.0f}/s  p50 {row['latency_ms']['p50']:>7.2f} ms  "
+                  f"p99 {row['latency_ms']['p99']:>7.2f} ms  wait {row['queue_wait_ms_avg']:>6.2f} ms  "
+                  f"peak {row['alloc_peak_kib']:>8,.0f} KiB  "
+                  f"writes {row['write_syscalls_per_update']:>5.2f}/upd  api {row['api_calls_per_update']:.2f}/upd")
+        await application.stop()
+        await plus_bot.stop_outbox(application)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--updates", type=int, default=2000, help="updates per scenario")
+    parser.add_argument("--users", type=int, default=1000, help="users in the seeded table")
+    parser.add_argument("--concurrency", type=int, default=1, help="updates in flight at a time (the update queue limit)")
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument("--rate-limits", action="store_true", help="keep the anti-spam limits (default: off)")
+    parser.add_argument("--log-level", default="ERROR")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="write results to this file")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    json_path = os.path.abspath(args.json) if args.json else None
+
+    # # the bot keeps its files in the working directory: use a scratch one
+    workdir = tempfile.mkdtemp(prefix="plus_bot_bench_")
+    os.chdir(workdir)
+    import plus_bot
+    from outbox import Outbox
+    from rate_limiter import RateLimiter
+
+    logging.getLogger().setLevel(args.log_level)
+    if not args.rate_limits:
+        plus_bot.RATE_LIMITER = RateLimiter({})
+    plus_bot.warm_users()
+    for user_id in range(1000, 1000 + args.users):
+        plus_bot.update_user_db(user_id=user_id, username=f"user{user_id}", first_name=f"First{user_id}",
+                                last_name=f"Last{user_id}")
+
+    plus_bot.MESSAGE_LOG.start()
+    plus_bot.CHAT_RATINGS.start()
+    # # no flood limits towards the fake API: measure the handlers, not the pacing
+    plus_bot.OUTBOX = Outbox(chat_limits={"private": (1e9, 1e9), "group": (1e9, 1e9)}, global_limit=(1e9, 1e9), 
+                             concurrency=plus_bot.OUTBOX_CONCURRENCY)
+
+    results = asyncio.run(bench(args, plus_bot))
+    plus_bot.STORAGE_EXECUTOR.shutdown(wait=True)
+    plus_bot.USERS.stop()
+    plus_bot.LEDGER.stop()
+    plus_bot.CHAT_RATINGS.stop()
+    plus_bot.MESSAGE_LOG.stop()
+
+    if json_path:
+        report = {
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "storage": plus_bot.STORAGE_BACKEND,
+            "params": {"updates": args.updates, "users": args.users, "concurrency": args.concurrency,
+                       "rate_limits": args.rate_limits, "seed": args.seed},
+            "scenarios": results,
+        }
+        with open(json_path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results: {json_path}")
+    print(f"Bot files: {workdir}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+Outbox against a local fake Bot API server: pacing, lanes and retries.
+
+The fake server answers sendMessage like Telegram would, but enforces its own
+per-chat flood limit (429 with retry_after when a chat sends too fast) and
+fails a share of the calls with 502 or a slow answer. A real `Bot` (HTTPX,
+keep-alive pool) talks to it through the `Outbox` of the bot.
+
+All limits are multiplied by --speed so a run takes seconds, not minutes.
+Reported: messages delivered, time, 429s and errors seen by the server,
+retries and failures of the outbox, delivery delay per lane.
+
+Usage:
+    python benchmarks/bench_outbox.py [--messages 2000] [--chats 20] [--speed 20] [--errors 0.02]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from telegram import Bot  # noqa: E402
+from telegram.request import HTTPXRequest  # noqa: E402
+
+import outbox  # noqa: E402
+
+LANES = {outbox.RATING: "rating", outbox.NORMAL: "normal", outbox.BULK: "bulk"}
+
+
+class FakeBotAPI:
+    """ sendMessage with a per-chat flood limit, random 502s and slow answers """
+
+    def __init__(self, chat_limits, errors=0.0, latency=0.0):
+        self.chat_limits = chat_limits
+        self.errors = errors
+        self.latency = latency
+        self.buckets = {}
+        self.delivered = []  # (chat id, text, monotonic time)
+        self.too_many = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._message_id = 0
+
+    def answer(self, method, params):
+        """ (HTTP status, JSON body) """
+        if method == "getMe":
+            return 200, {"ok": True, "result": {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}}
+        chat_id = int(params["chat_id"])
+        now = time.monotonic()
+        with self._lock:
+            if random.random() < self.errors:
+                self.failed += 1
+                return 502, {"ok": False, "error_code": 502, "description": "Bad Gateway"}
+            bucket = self.buckets.get(chat_id)
+            if bucket is None:
+                bucket = self.buckets[chat_id] = outbox.TokenBucket(*self.chat_limits["group" if chat_id < 0 else "private"])
+            if bucket.delay(now) > 0:
+                self.too_many += 1
+                return 429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                             "parameters": {"retry_after": 1}}
+            bucket.take(now)
+            self._message_id += 1
+            self.delivered.append((chat_id, params.get("text"), now))
+            return 200, {"ok": True, "result": {"message_id": self._message_id, "date": int(time.time()),
+                                                "chat": {"id": chat_id, "type": "group" if chat_id < 0 else "private"},
+                                                "text": params.get("text")}}
+
+    def serve(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(body or "{}")
+                else:
+                    params = {key: values[0] for key, values in parse_qs(body).items()}
+                if api.latency:
+                    time.sleep(random.expovariate(1 / api.latency))
+                status, answer = api.answer(self.path.rsplit("/", 1)[-1], params)
+                payload = json.dumps(answer).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="fake-bot-api", daemon=True).start()
+        return server
+
+
+def scaled(limits, speed):
+    return {kind: (rate * speed, burst) for kind, (rate, burst) in limits.items()}
+
+
+async def bench(args):
+    chat_limits = scaled(outbox.CHAT_LIMITS, args.speed)
+    api = FakeBotAPI(chat_limits, errors=args.errors, latency=args.latency_ms / 1000)
+    server = api.serve()
+    bot = Bot("123:FAKE", base_url=f"http://127.0.0.1:{server.server_address[1]}/bot",
+              request=HTTPXRequest(connection_pool_size=args.concurrency))
+    box = outbox.Outbox(chat_limits=chat_limits,
+                        global_limit=(outbox.GLOBAL_LIMIT[0] * args.speed, outbox.GLOBAL_LIMIT[1]),
+                        concurrency=args.concurrency)
+    chats = [-1000 - number for number in range(args.chats)]
+    submitted = {}
+    async with bot:
+        started = time.monotonic()
+        for number in range(args.messages):
+            lane = random.choice((outbox.RATING, outbox.NORMAL, outbox.NORMAL, outbox.BULK))
+            chat_id = random.choice(chats)
+            text = f"{LANES[lane]} {number}"
+            submitted[text] = (lane, time.monotonic())
+            box.submit(chat_id, lambda chat_id=chat_id, text=text: bot.send_message(chat_id, text), lane=lane)
+        await box.drain()
+        elapsed = time.monotonic() - started
+        await box.stop()
+    server.shutdown()
+
+    delays = {lane: [] for lane in LANES}
+    for _, text, at in api.delivered:
+        lane, queued = submitted[text]
+        delays[lane].append(at - queued)
+    print(f"delivered {len(api.delivered):,} of {args.messages:,} in {elapsed:.2f} s "
+          f"({len(api.delivered) / elapsed:,.0f}/s, fair limit {args.chats * chat_limits['group'][0]:,.0f}/s)")
+    print(f"server: 429 {api.too_many}, 502 {api.failed}; outbox: retried {box.retried}, failed {box.failed}, "
+          f"dropped {box.dropped}")
+    for lane, values in delays.items():
+        if values:
+            values.sort()
+            print(f"{LANES[lane]:<7} delay p50 {values[len(values) // 2]:6.2f} s  max {values[-1]:6.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--speed", type=float, default=20, help="multiply every flood limit by this")
+    parser.add_argument("--errors", type=float, default=0.02, help="share of calls failing with 502")
+    parser.add_argument("--latency-ms", type=float, default=5, help="mean answer latency of the server")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    asyncio.run(bench(args))
+
+
+if __name__ == '__main__':
+    main()
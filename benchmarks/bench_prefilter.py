@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Messages per second through the rating pre-filter on synthetic group chat traffic.
+
+Usage:
+    python benchmarks/bench_prefilter.py [--messages 1000000] [--rating-share 0.03]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from rating_filter import RatingPrefilter  # noqa: E402
+
+COMMANDS = {"+": "Plus", "-": "Minus"}
+RATING_COMMANDS = {"👍": "+", "👎": "-", "🙂": "+", "🙁": "-"}
+
+CHATTER = [
+    "ok", "lol", "да", "нет, не так", "Привет всем!", "кто идёт сегодня?", "@alex глянь плиз",
+    "https://example.com/some/long/link?with=query", "😂😂😂", "Спасибо за ссылку", "thanks!",
+    "I think we should move the meeting to Friday, what do you all think about that?",
+    "Кстати, вчерашний созвон перенесли на четверг, не забудьте обновить календарь.",
+    "1+1=2", "a - b", "/gif", "", "   ", "👍👍",
+]
+RATINGS = ["+", "+1", "+ @alex", "-", "- спам", "👍", "👎 не согласен", "🙂", "🙁", "++"]
+
+
+def make_traffic(size, rating_share):
+    return [random.choice(RATINGS) if random.random() < rating_share else random.choice(CHATTER)
+            for _ in range(size)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--messages", type=int, default=1_000_000)
+    parser.add_argument("--rating-share", type=float, default=0.03, help="share of rating messages in traffic")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    is_candidate = RatingPrefilter(COMMANDS, RATING_COMMANDS)
+    traffic = make_traffic(args.messages, args.rating_share)
+
+    best = None
+    for _ in range(args.rounds):
+        started = time.perf_counter()
+        passed = sum(1 for text in traffic if is_candidate(text))
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"messages: {len(traffic):,}  passed to handlers: {passed:,} ({passed / len(traffic):.1%})")
+    print(f"pre-filter: {len(traffic) / best:,.0f} msg/s  ({best / len(traffic) * 1e9:.0f} ns/msg, best of {args.rounds})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Rating lookups: boolean-mask scans over the pandas table vs the hash indexes of UserStore.
+
+Usage:
+    python benchmarks/bench_user_index.py [--sizes 1000 100000 1000000]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from user_store import USER_COLUMNS, UserStore, UserTable  # noqa: E402
+
+
+def make_users(size):
+    return pd.DataFrame(
+        [[i + 1, 100000 + i, f"User_{i}", f"Name{i}", f"Last{i}", random.randrange(-50, 500)] for i in range(size)],
+        columns=USER_COLUMNS,
+    )
+
+
+def timed(func, keys):
+    started = time.perf_counter()
+    for key in keys:
+        func(key)
+    return (time.perf_counter() - started) / len(keys)
+
+
+def pandas_rating_by_id(users, user_id):
+    rating = users.loc[users['user_id'] == user_id, 'rating']
+    return rating.item() if len(rating) == 1 else 0
+
+
+def pandas_rating_by_username(users, username):
+    rating = users.loc[users['username'] == username, 'rating']
+    return rating.item() if len(rating) == 1 else 0
+
+
+def pandas_membership(users, user_id):
+    return user_id in users['user_id'].to_list()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 100_000, 1_000_000])
+    parser.add_argument("--queries", type=int, default=10_000, help="lookups per indexed measurement")
+    args = parser.parse_args()
+
+    print(f"{'users':>10} {'lookup':<22} {'pandas, us':>12} {'index, us':>12} {'speedup':>9}")
+    for size in args.sizes:
+        users = make_users(size)
+        store = UserStore(path=os.devnull, flush_interval=0)
+        store.users = UserTable(users.itertuples(index=False, name=None))
+        store.index.rebuild(store.users)
+
+        # # pandas scans are O(n): keep their number of queries reasonable on big tables
+        pandas_queries = max(20, min(args.queries, 20_000_000 // size))
+        ids = [100000 + random.randrange(size) for _ in range(args.queries)]
+        names = [f"user_{i - 100000}" for i in ids]
+
+        cases = [
+            ("rating by user_id",
+             lambda k: pandas_rating_by_id(users, k), lambda k: store.get_rating(user_id=k), ids),
+            ("rating by username",
+             lambda k: pandas_rating_by_username(users, k.capitalize()), lambda k: store.get_rating(username=k), names),
+            ("user_id membership",
+             lambda k: pandas_membership(users, k), lambda k: store.index.find(user_id=k) is not None, ids),
+        ]
+        for title, pandas_func, index_func, keys in cases:
+            pandas_time = timed(pandas_func, keys[:pandas_queries])
+            index_time = timed(index_func, keys)
+            print(f"{size:>10} {title:<22} {pandas_time * 1e6:>12.1f} {index_time * 1e6:>12.2f} {pandas_time / index_time:>8.0f}x")
+
+
+if __name__ == '__main__':
+    main()
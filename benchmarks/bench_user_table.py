@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+"""
+User table: memory per user and cost of a new user, pandas DataFrame rows vs the column arrays of UserTable.
+
+The pandas side is the former insert: `users.loc[label, :] = [...]` followed by
+`users['index'].fillna(0).astype(int)`. The record side is `UserStore.upsert_user`.
+Also checks that a legacy DataFrame pickle loads into the same records.
+
+Usage:
+    python benchmarks/bench_user_table.py [--sizes 1000 10000 100000] [--inserts 200]
+"""
+
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from user_store import USER_COLUMNS, UserStore, UserTable, read_user_table  # noqa: E402
+
+
+def rows(start, count):
+    return [[i + 1, 100000 + i, f"User_{i}", f"Name{i % 500}", f"Last{i % 300}", i % 100] for i in range(start, start + count)]
+
+
+def traced(build):
+    gc.collect()
+    tracemalloc.start()
+    table = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return table, size
+
+
+def pandas_insert(users, row):
+    label = users.index.max() + 1 if len(users) else 0
+    users.loc[label, :] = row
+    users['index'] = users['index'].fillna(0).astype(int)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--inserts", type=int, default=200, help="new users timed per size")
+    args = parser.parse_args()
+
+    print(f"{'users':>10} {'pandas B/user':>14} {'table B/user':>15} {'pandas insert, us':>18} {'record insert, us':>18}")
+    for size in args.sizes:
+        # # the stored table has object columns (it grew row by row), every cell a Python object
+        frame, frame_bytes = traced(lambda: pd.DataFrame(rows(0, size), columns=USER_COLUMNS, dtype=object))
+        table, table_bytes = traced(lambda: UserTable(rows(0, size)))
+
+        new = rows(size, args.inserts)
+        started = time.perf_counter()
+        for row in new:
+            pandas_insert(frame, row)
+        pandas_time = (time.perf_counter() - started) / len(new)
+
+        store = UserStore(path=os.devnull, flush_interval=0)
+        store.users = table
+        store.index.rebuild(table)
+        started = time.perf_counter()
+        for _, user_id, username, first_name, last_name, _ in new:
+            store.upsert_user(user_id=user_id, username=username, first_name=first_name, last_name=last_name)
+        record_time = (time.perf_counter() - started) / len(new)
+
+        print(f"{size:>10} {frame_bytes / size:>14.0f} {table_bytes / size:>15.0f} "
+              f"{pandas_time * 1e6:>18.1f} {record_time * 1e6:>18.1f}")
+
+    # # a DataFrame pickle of the former store loads into the same users
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "users_database.pandas")
+        legacy = pd.DataFrame(rows(0, 1000), columns=USER_COLUMNS)
+        legacy.loc[len(legacy), :] = [1001, None, "no_id", "No", None, 5]
+        legacy.to_pickle(path, compression="gzip")
+        loaded = read_user_table(path)
+        assert loaded[:1000] == [tuple(row) for row in rows(0, 1000)], "legacy pickle rows differ"
+        assert loaded[-1] == (1001, None, "no_id", "No", None, 5), loaded[-1]
+        store = UserStore(path, flush_interval=0).load()
+        store.mark_dirty()
+        store.flush()
+        assert read_user_table(path) == loaded, "rewritten table differs"
+    print("legacy pickle: ok")
+
+
+if __name__ == '__main__':
+    main()
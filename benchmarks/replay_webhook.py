@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+Replay recorded Telegram updates against the webhook server at a high rate.
+
+Updates come from a file of recorded update JSON (one per line, e.g. taken
+from getUpdates or a webhook capture) or are synthesized. By default an
+in-process WebhookServer with a counting sink is started; with --url the
+updates are posted to a running bot instead.
+
+Usage:
+    python benchmarks/replay_webhook.py [--updates recorded.jsonl] [--requests 50000] [--connections 40]
+    python benchmarks/replay_webhook.py --url http://127.0.0.1:8443/telegram --secret s3cr3t
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from webhook_server import WebhookServer  # noqa: E402
+
+TEXTS = ["+", "-", "👍", "lol", "ok", "кто идёт сегодня?", "+ @alex", "/top", "/week"]
+
+
+def synthetic_updates(count):
+    updates = []
+    for update_id in range(1, count + 1):
+        chat_id = -1000 - random.randrange(50)
+        user_id = random.randrange(1, 5000)
+        updates.append({
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup", "title": f"Chat {chat_id}"},
+                "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}", "username": f"user{user_id}"},
+                "text": random.choice(TEXTS),
+            },
+        })
+    return updates
+
+
+def load_updates(path):
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def post_loop(host, port, path, secret, bodies, latencies, statuses):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for body in bodies:
+            head = (f"POST {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(body)}\r\n")
+            if secret:
+                head += f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+            started = time.perf_counter()
+            writer.write(head.encode() + b"\r\n" + body)
+            await writer.drain()
+            status_line = await reader.readline()
+            keep_alive = True
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b""):
+                    break
+                if line.lower().startswith(b"connection:") and b"close" in line.lower():
+                    keep_alive = False
+            latencies.append(time.perf_counter() - started)
+            status = int(status_line.split()[1]) if status_line else 0
+            statuses[status] = statuses.get(status, 0) + 1
+            if not keep_alive:
+                writer.close()
+                reader, writer = await asyncio.open_connection(host, port)
+    finally:
+        writer.close()
+
+
+async def replay(args):
+    updates = load_updates(args.updates) if args.updates else synthetic_updates(min(args.requests, 10000))
+    bodies = [json.dumps(update, ensure_ascii=False).encode() for update in updates]
+    bodies = list(itertools.islice(itertools.cycle(bodies), args.requests))
+
+    server = None
+    delivered = []
+    if args.url:
+        target = urlsplit(args.url)
+        host, port, path = target.hostname, target.port or 80, target.path or "/"
+    else:
+        async def deliver(update):
+            delivered.append(update["update_id"])
+
+        server = await WebhookServer(deliver, listen="127.0.0.1", port=0, path="/telegram",
+                                     secret_token=args.secret, max_concurrency=args.connections).start()
+        host, port, path = "127.0.0.1", server.port, "/telegram"
+
+    latencies, statuses = [], {}
+    per_connection = [bodies[n::args.connections] for n in range(args.connections)]
+    started = time.perf_counter()
+    await asyncio.gather(*(post_loop(host, port, path, args.secret, part, latencies, statuses)
+                           for part in per_connection if part))
+    elapsed = time.perf_counter() - started
+    if server is not None:
+        await server.stop()
+
+    latencies.sort()
+    print(f"requests: {len(latencies):,} over {args.connections} connections in {elapsed:.2f}s "
+          f"-> {len(latencies) / elapsed:,.0f} req/s")
+    print(f"latency: p50 {latencies[len(latencies) // 2] * 1000:.2f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99)] * 1000:.2f} ms, max {latencies[-1] * 1000:.2f} ms")
+    print(f"statuses: {statuses}" + (f", delivered: {len(delivered):,}" if server is not None else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--updates", help="recorded updates, one JSON per line (default: synthetic)")
+    parser.add_argument("--url", help="webhook URL of a running bot (default: in-process server)")
+    parser.add_argument("--secret", default="s3cr3t", help="X-Telegram-Bot-Api-Secret-Token")
+    parser.add_argument("--requests", type=int, default=50_000)
+    parser.add_argument("--connections", type=int, default=40)
+    args = parser.parse_args()
+    asyncio.run(replay(args))
+
+
+if __name__ == '__main__':
+    main()
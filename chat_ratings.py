@@ -0,0 +1,271 @@
+"""
+Ratings scoped by chat.
+
+Every chat is a shard: its own JSON file `<directory>/chat_<id>.json` of
+[member, rating] pairs, loaded on first use and kept in memory as a
+`Leaderboard`. Shards are locked, flushed and evicted independently, so busy
+chats do not contend on one table or one file: a background thread writes
+the changed shards every `flush_interval` seconds and drops the ones nobody
+touched for `idle_seconds`; above `max_chats` shards in memory the least
+recently used one is written and dropped at once. Shards are written
+(fsynced, then renamed over the old file) outside the lock of the shard map,
+so a disk write stalls only its own chat.
+
+A chat file that cannot be parsed is moved aside (`.corrupt-<time>`) and
+the chat starts over, never overwritten in place; a file that cannot be
+read fails the call instead of starting the chat from zero.
+
+Members are `leaderboard.member_key()`s: the user id, "@username" for users
+known only by name (merged into the id once it is known).
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from leaderboard import Leaderboard, member_key
+
+logger = logging.getLogger(__name__)
+
+
+class ChatShard:
+    """ Ratings of one chat """
+
+    def __init__(self, chat_id, ratings=()):
+        self.chat_id = chat_id
+        self.board = Leaderboard()
+        for member, rating in ratings:
+            self.board.set(member, rating)
+        self.dirty = False
+        self.evicted = False
+        self.gone = threading.Event()  # set once a dropped shard is written
+        self.used_at = time.monotonic()
+        self.lock = threading.Lock()
+
+
+class ChatRatings:
+    """ Per-chat rating shards with lazy loading, write-behind and eviction of cold chats """
+
+    def __init__(self, directory, max_chats=1000, idle_seconds=600, flush_interval=5):
+        self.directory = directory
+        self.max_chats = max_chats
+        self.idle_seconds = idle_seconds
+        self.flush_interval = flush_interval
+        self._shards = OrderedDict()  # chat id -> ChatShard, least recently used first
+        self._evicting = {}  # chat id -> ChatShard dropped from the map, not written yet
+        self._drops = 0
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._flusher = None
+        self.bytes_written = 0
+
+    def __len__(self):
+        """ Shards in memory """
+        return len(self._shards)
+
+    def _path(self, chat_id):
+        return os.path.join(self.directory, f"chat_{chat_id}.json")
+
+    # # —— Shards
+    def shard(self, chat_id):
+        """ The chat's shard, loaded from its file on first use """
+        while True:
+            with self._lock:
+                shard = self._shards.get(chat_id)
+                if shard is not None:
+                    self._shards.move_to_end(chat_id)
+                    shard.used_at = time.monotonic()
+                    return shard
+                evicting = self._evicting.get(chat_id)
+                drops = self._drops
+            if evicting is not None:
+                # # its last changes are being written: read the file after them
+                evicting.gone.wait()
+                continue
+            loaded = self._load(chat_id)
+            with self._lock:
+                # # another thread may have loaded it meanwhile; if shards were dropped, the file
+                # # read may be older than a copy loaded, changed and evicted in the meantime
+                shard = self._shards.get(chat_id)
+                if shard is None and self._drops != drops:
+                    continue
+                if shard is None:
+                    shard = self._shards[chat_id] = loaded
+                self._shards.move_to_end(chat_id)
+                cold = []
+                while len(self._shards) > self.max_chats:
+                    cold.append(self._drop(next(iter(self._shards))))
+            self._evict(cold)
+            return shard
+
+    def _load(self, chat_id):
+        path = self._path(chat_id)
+        if not os.path.isfile(path):
+            return ChatShard(chat_id)
+        with open(path, "r") as f:
+            text = f.read()
+        try:
+            return ChatShard(chat_id, [(member, rating) for member, rating in json.loads(text)])
+        except Exception as e:
+            corrupt_path = f"{path}.corrupt-{int(time.time())}"
+            os.replace(path, corrupt_path)
+            logger.error(f"ERROR read chat ratings {path}: {e}. Moved to {corrupt_path}, the chat starts over")
+            return ChatShard(chat_id)
+
+    def _drop(self, chat_id):
+        """ Take a shard out of the map to be evicted (the caller holds `_lock`) """
+        shard = self._shards.pop(chat_id)
+        self._evicting[chat_id] = shard
+        self._drops += 1
+        shard.gone.clear()
+        return shard
+
+    def _evict(self, shards):
+        """ Write dropped shards (without holding `_lock`) """
+        for shard in shards:
+            with shard.lock:
+                self._write(shard)
+                # # not written (disk error): kept in memory, retried by the next flush
+                shard.evicted = not shard.dirty
+                with self._lock:
+                    if self._evicting.get(shard.chat_id) is shard:
+                        del self._evicting[shard.chat_id]
+                    if not shard.evicted:
+                        self._shards.setdefault(shard.chat_id, shard)
+            shard.gone.set()
+
+    def _locked(self, chat_id):
+        """ The chat's shard, locked; retried if it was evicted while we waited """
+        while True:
+            shard = self.shard(chat_id)
+            shard.lock.acquire()
+            if not shard.evicted:
+                return shard
+            shard.lock.release()
+
+    # # —— Ratings
+    def add(self, chat_id, changes):
+        """ Change the ratings of [(delta, user_id, username)] in the chat at once; returns the new ratings """
+        shard = self._locked(chat_id)
+        try:
+            ratings = []
+            for delta, user_id, username in changes:
+                member = member_key(user_id, username)
+                if member is None:
+                    ratings.append(None)
+                    continue
+                rating = shard.board.ratings.get(member, 0)
+                if user_id is not None and username:
+                    # # the user was known only by @username before
+                    old = member_key(None, username)
+                    rating += shard.board.ratings.get(old, 0)
+                    shard.board.remove(old)
+                rating += delta
+                shard.board.set(member, rating)
+                shard.dirty = True
+                ratings.append(rating)
+            return ratings
+        finally:
+            shard.lock.release()
+
+    def set(self, chat_id, rating, user_id=None, username=None):
+        """ Set the user's rating in the chat (an admin override); returns it """
+        member = member_key(user_id, username)
+        if member is None:
+            return None
+        shard = self._locked(chat_id)
+        try:
+            if user_id is not None and username:
+                shard.board.remove(member_key(None, username))
+            shard.board.set(member, rating)
+            shard.dirty = True
+            return rating
+        finally:
+            shard.lock.release()
+
+    def members(self, chat_id):
+        """ Members rated in the chat """
+        shard = self._locked(chat_id)
+        try:
+            return list(shard.board.ratings)
+        finally:
+            shard.lock.release()
+
+    def standings(self, chat_id, members):
+        """ {member: (rating, place)} in the chat; members not on its board: (0, None) """
+        shard = self._locked(chat_id)
+        try:
+            board = shard.board
+            return {member: (board.ratings.get(member, 0), board.place(member)) for member in members}
+        finally:
+            shard.lock.release()
+
+    def top(self, chat_id, count, offset=0, member=None):
+        """ (rows [(place, member, rating)], members on the board, place of `member`) """
+        shard = self._locked(chat_id)
+        try:
+            board = shard.board
+            return board.top(count, offset), len(board), board.place(member) if member is not None else None
+        finally:
+            shard.lock.release()
+
+    # # —— Write-behind
+    def _write(self, shard):
+        """ Write a shard if changed (the caller holds its lock) """
+        if not shard.dirty:
+            return
+        path = self._path(shard.chat_id)
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(f"{path}.tmp", "w") as f:
+                json.dump([[member, rating] for member, rating in shard.board.ratings.items()], f)
+                f.flush()
+                os.fsync(f.fileno())
+                self.bytes_written += f.tell()
+            os.replace(f"{path}.tmp", path)
+            shard.dirty = False
+        except Exception as e:
+            logger.error(f"ERROR write chat ratings {path}: {e}")
+
+    def flush(self):
+        """ Write changed shards, drop the ones idle longer than `idle_seconds` """
+        with self._lock:
+            shards = list(self._shards.values())
+        idle_since = time.monotonic() - self.idle_seconds
+        for shard in shards:
+            if shard.used_at < idle_since:
+                with self._lock:
+                    idle = [self._drop(shard.chat_id)] if self._shards.get(shard.chat_id) is shard else []
+                self._evict(idle)
+                continue
+            with shard.lock:
+                if not shard.evicted:
+                    self._write(shard)
+
+    def start(self):
+        if self._flusher is None and self.flush_interval:
+            self._stop_event.clear()
+            self._flusher = threading.Thread(target=self._flush_loop, name="chat-ratings-flush", daemon=True)
+            self._flusher.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        with self._lock:
+            shards = list(self._shards.values())
+        for shard in shards:
+            with shard.lock:
+                self._write(shard)
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"ERROR flush chat ratings: {e}")
@@ -0,0 +1,99 @@
+"""
+Write coalescing for bursts of ratings.
+
+`RatingCoalescer.add()` does not write anything: it puts the delta on the
+open batch of its key (e.g. chat + rated user) and returns at once. The
+first delta of a batch schedules its flush `window` seconds later; then the
+whole batch — the summed delta and every pending item — goes to `apply` in
+one call: one storage transaction and one reply for a storm of "+".
+`add_many()` applies deltas to several keys (e.g. "+ @a @b") together, at
+once, in one call as well.
+
+Batches are applied in order per `order(key)` (by default the key itself):
+a batch waits for the previous batch of the same order key to finish, e.g.
+batches of one rated user from different chats never overlap; a call with
+several keys waits for all of them. With `window` 0 every delta is applied
+at once, in the same order.
+"""
+
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _Batch:
+    __slots__ = ('delta', 'items')
+
+    def __init__(self):
+        self.delta = 0
+        self.items = []
+
+
+class RatingCoalescer:
+    """ Per-key batches of rating deltas, flushed `window` seconds after their first delta """
+
+    def __init__(self, apply, window=0.2, create_task=None, order=None):
+        self.apply = apply  # async ([(key, delta, items)]): batches applied together
+        self.window = window
+        self.order = order or (lambda key: key)  # key -> key of the batches applied one after another
+        self.create_task = create_task  # e.g. Application.create_task: flushes are awaited on stop
+        self._open = {}  # key -> batch collecting deltas
+        self._applying = {}  # order key -> future of the latest call applied or waiting
+        self._tasks = set()
+        # # metrics
+        self.batches = 0
+        self.items = 0
+
+    async def add(self, key, delta, item):
+        self.items += 1
+        if self.window <= 0:
+            await self._apply_in_order([(key, delta, [item])])
+            return
+        batch = self._open.get(key)
+        if batch is None:
+            batch = self._open[key] = _Batch()
+            create_task = self.create_task or asyncio.get_running_loop().create_task
+            task = create_task(self._flush_later(key, batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        batch.delta += delta
+        batch.items.append(item)
+
+    async def _flush_later(self, key, batch):
+        await asyncio.sleep(self.window)
+        if self._open.get(key) is batch:
+            del self._open[key]
+        await self._apply_in_order([(key, batch.delta, batch.items)])
+
+    async def add_many(self, entries):
+        """ Apply [(key, delta, item)] together now, in one call (not batched with other deltas) """
+        self.items += len(entries)
+        await self._apply_in_order([(key, delta, [item]) for key, delta, item in entries])
+
+    async def _apply_in_order(self, batches):
+        orders = {self.order(key) for key, _, _ in batches}
+        previous = [self._applying[order] for order in orders if order in self._applying]
+        # # done when these batches are applied (not when the task running them ends: inline batches run
+        # # in handlers); taken for all order keys at once, so calls never wait for each other in a cycle
+        current = asyncio.get_running_loop().create_future()
+        for order in orders:
+            self._applying[order] = current
+        try:
+            if previous:
+                # # keep batches of an order key in order
+                await asyncio.wait(previous)
+            self.batches += len(batches)
+            await self.apply(batches)
+        except Exception as e:
+            logger.error(f"ERROR apply rating batches {[key for key, _, _ in batches]}: {e}")
+        finally:
+            current.set_result(None)
+            for order in orders:
+                if self._applying.get(order) is current:
+                    del self._applying[order]
+
+    async def drain(self):
+        """ Wait until every open batch is applied """
+        while self._tasks:
+            await asyncio.wait(set(self._tasks))
@@ -0,0 +1,151 @@
+"""
+Streaming export and import of the user table.
+
+Rows come from the store in chunks (`iter_rows()`) and are written chunk by
+chunk, so memory does not grow with the table; import reads a file back the
+same way and hands every chunk to the store's `import_rows()`. The format
+follows the file name:
+
+    .parquet         Parquet, a row group per chunk (pyarrow)
+    .arrow           Arrow IPC file, a record batch per chunk (pyarrow)
+    .csv, .csv.gz    CSV with a header row
+
+Columns are those of `user_store.USER_COLUMNS`; empty cells are None.
+"""
+
+import csv
+import gzip
+import importlib.util
+import os
+
+from user_store import USER_COLUMNS
+
+CHUNK_ROWS = 50000
+INT_COLUMNS = ('index', 'user_id', 'rating')
+FORMATS = {".parquet": "parquet", ".arrow": "arrow", ".csv": "csv", ".csv.gz": "csv"}
+# # format name (as asked for, e.g. by /export) -> suffix of the file written
+SUFFIXES = {"parquet": ".parquet", "arrow": ".arrow", "csv": ".csv.gz"}
+
+# # columnar when pyarrow is installed (checked without importing it)
+DEFAULT_SUFFIX = ".parquet" if importlib.util.find_spec("pyarrow") else ".csv.gz"
+
+
+def file_format(path):
+    for suffix, name in FORMATS.items():
+        if path.endswith(suffix):
+            return name
+    raise ValueError(f"Unknown export format of {path}: use one of {', '.join(FORMATS)}")
+
+
+def _open_text(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", newline="", encoding="utf-8")
+    return open(path, mode, newline="", encoding="utf-8")
+
+
+def _arrow_schema():
+    import pyarrow as pa
+
+    return pa.schema([(column, pa.int64() if column in INT_COLUMNS else pa.string()) for column in USER_COLUMNS])
+
+
+def _batch(schema, rows):
+    import pyarrow as pa
+
+    columns = list(zip(*rows))
+    return pa.RecordBatch.from_arrays([pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+                                      schema=schema)
+
+
+# # —— Export
+def write_rows(chunks, path):
+    """ Write chunks of rows (tuples of USER_COLUMNS) to `path` (atomically); returns the number of rows """
+    kind = file_format(path)
+    directory, name = os.path.split(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    tmp_path = os.path.join(directory, f".tmp-{name}")  # same suffix: same format
+    try:
+        count = _write_csv(chunks, tmp_path) if kind == "csv" else _write_arrow(chunks, tmp_path, kind)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+    return count
+
+
+def _write_csv(chunks, path):
+    count = 0
+    with _open_text(path, "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(USER_COLUMNS)
+        for rows in chunks:
+            writer.writerows(rows)
+            count += len(rows)
+    return count
+
+
+def _write_arrow(chunks, path, kind):
+    schema = _arrow_schema()
+    if kind == "parquet":
+        import pyarrow.parquet as pq
+
+        writer = pq.ParquetWriter(path, schema, compression="zstd")
+    else:
+        import pyarrow.ipc as ipc
+
+        writer = ipc.new_file(path, schema)
+    count = 0
+    try:
+        for rows in chunks:
+            writer.write_batch(_batch(schema, rows))
+            count += len(rows)
+    finally:
+        writer.close()
+    return count
+
+
+# # —— Import
+def _csv_value(column, value):
+    if value == "":
+        return None
+    return int(float(value)) if column in INT_COLUMNS else value
+
+
+def read_rows(path, chunk_size=CHUNK_ROWS):
+    """ Chunks (lists of tuples of USER_COLUMNS) of an exported file """
+    kind = file_format(path)
+    if kind == "csv":
+        with _open_text(path, "r") as f:
+            reader = csv.reader(f)
+            header = next(reader, None)
+            if header is None:
+                return
+            missing = [column for column in USER_COLUMNS if column not in header]
+            if missing:
+                raise ValueError(f"{path}: no columns {missing}")
+            positions = [header.index(column) for column in USER_COLUMNS]
+            rows = []
+            for record in reader:
+                rows.append(tuple(_csv_value(column, record[position])
+                                  for column, position in zip(USER_COLUMNS, positions)))
+                if len(rows) >= chunk_size:
+                    yield rows
+                    rows = []
+            if rows:
+                yield rows
+        return
+
+    if kind == "parquet":
+        import pyarrow.parquet as pq
+
+        batches = pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=USER_COLUMNS)
+        for batch in batches:
+            yield list(zip(*(batch.column(column).to_pylist() for column in USER_COLUMNS)))
+    else:
+        import pyarrow.ipc as ipc
+
+        with ipc.open_file(path) as reader:
+            for number in range(reader.num_record_batches):
+                batch = reader.get_batch(number)
+                yield list(zip(*(batch.column(column).to_pylist() for column in USER_COLUMNS)))
@@ -0,0 +1,148 @@
+"""
+GIF assets for `sendAnimation`.
+
+`GifLibrary` scans the GIF directory once and rescans it only when the
+directory changes (checked at most every `rescan_interval` seconds). After a
+GIF was uploaded once, the `file_id` Telegram returned is remembered (and
+saved to a JSON file), so next time the bot sends the id instead of the
+bytes. Bytes of GIFs without a known id are kept in a small LRU cache.
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class GifLibrary:
+    """ GIF files of a directory with Telegram file_id reuse """
+
+    def __init__(self, directory, file_ids_path=None, cache_bytes=16 * 1024 * 1024, rescan_interval=30):
+        self.directory = directory
+        self.file_ids_path = file_ids_path
+        self.cache_bytes = cache_bytes
+        self.rescan_interval = rescan_interval
+        self.files = {}  # name -> (size, mtime_ns): a changed file gets a new signature
+        self.file_ids = {}  # name -> [size, mtime_ns, file_id]
+        self._names = []
+        self._cache = OrderedDict()  # name -> bytes, least recently used first
+        self._cached_bytes = 0
+        self._dir_mtime = None
+        self._checked_at = 0
+        self._lock = threading.RLock()
+
+    # # —— Directory
+    def scan(self):
+        with self._lock:
+            try:
+                self._dir_mtime = os.stat(self.directory).st_mtime_ns
+                files = {}
+                for entry in os.scandir(self.directory):
+                    if entry.name.endswith(".gif") and entry.is_file():
+                        stat = entry.stat()
+                        files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+            except OSError as e:
+                logger.error(f"ERROR scan gifs in {self.directory}: {e}")
+                files = {}
+            self.files = files
+            self._names = sorted(files)
+            self._checked_at = time.monotonic()
+            for name in list(self._cache):
+                if name not in files:
+                    self._drop_cached(name)
+            logger.info(f"GIFs found in {self.directory}: {len(files)}")
+        return self
+
+    def _maybe_rescan(self):
+        if time.monotonic() - self._checked_at < self.rescan_interval:
+            return
+        self._checked_at = time.monotonic()
+        try:
+            changed = os.stat(self.directory).st_mtime_ns != self._dir_mtime
+        except OSError:
+            changed = self._dir_mtime is not None
+        if changed:
+            self.scan()
+
+    def pick(self):
+        """ Random GIF name, None if there are no GIFs """
+        with self._lock:
+            self._maybe_rescan()
+            return random.choice(self._names) if self._names else None
+
+    # # —— Contents
+    def animation(self, name):
+        """ What to send as `animation`: the remembered file_id or the GIF bytes """
+        with self._lock:
+            file_id = self.file_id(name)
+            if file_id:
+                return file_id
+            data = self._cache.get(name)
+            if data is not None:
+                self._cache.move_to_end(name)
+                return data
+        with open(os.path.join(self.directory, name), 'rb') as f:
+            data = f.read()
+        with self._lock:
+            if len(data) <= self.cache_bytes and name not in self._cache:
+                self._cache[name] = data
+                self._cached_bytes += len(data)
+                while self._cached_bytes > self.cache_bytes:
+                    self._drop_cached(next(iter(self._cache)))
+        return data
+
+    def _drop_cached(self, name):
+        self._cached_bytes -= len(self._cache.pop(name))
+
+    # # —— Telegram file ids
+    def file_id(self, name):
+        with self._lock:
+            known = self.file_ids.get(name)
+            if known and name in self.files and tuple(known[:2]) == self.files[name]:
+                return known[2]
+            return None
+
+    def remember(self, name, file_id):
+        """ Save the file_id Telegram returned for an uploaded GIF """
+        with self._lock:
+            if name not in self.files or not file_id:
+                return
+            self.file_ids[name] = [*self.files[name], file_id]
+            if name in self._cache:
+                self._drop_cached(name)
+            self.save()
+
+    def forget(self, name):
+        """ Drop a file_id Telegram did not accept """
+        with self._lock:
+            if self.file_ids.pop(name, None):
+                self.save()
+
+    def load(self):
+        if not (self.file_ids_path and os.path.isfile(self.file_ids_path)):
+            return self
+        try:
+            with open(self.file_ids_path, "r") as f:
+                file_ids = json.load(f)
+        except Exception as e:
+            logger.error(f"ERROR read gif file ids: {e}")
+            return self
+        with self._lock:
+            self.file_ids = file_ids
+        return self
+
+    def save(self):
+        if not self.file_ids_path:
+            return
+        try:
+            tmp_path = f"{self.file_ids_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.file_ids, f)
+            os.replace(tmp_path, self.file_ids_path)
+        except Exception as e:
+            logger.error(f"ERROR save gif file ids: {e}")
@@ -0,0 +1,121 @@
+"""
+Jokes for bot replies.
+
+`JokeService` keeps a shuffled ring of jokes per category and hands them out
+in O(1), without repeating a joke until the whole pool was used. The next
+shuffled round is prepared by a background thread while the current one is
+still being served, so no joke is ever generated on the reply path.
+
+Jokes come from pluggable sources: callables `source(category) -> [jokes]`.
+`pyjokes_source()` wraps pyjokes, `file_source()` reads local files
+`<directory>/<category>.txt` (one joke per line).
+"""
+
+import logging
+import os
+import random
+import threading
+
+logger = logging.getLogger(__name__)
+
+NO_JOKE = "No joke. It is not funny."
+
+
+def pyjokes_source(language='en'):
+    def source(category):
+        import pyjokes
+
+        try:
+            return pyjokes.get_jokes(language=language, category=category)
+        except Exception as e:
+            logger.warning(f"pyjokes has no '{category}' jokes for '{language}': {e}")
+            return []
+    return source
+
+
+def file_source(directory):
+    def source(category):
+        path = os.path.join(directory, f"{category}.txt")
+        if not os.path.isfile(path):
+            return []
+        with open(path, "r", encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip()]
+    return source
+
+
+class _Ring:
+    """ One shuffled round of a category and the next one, prepared in background """
+
+    def __init__(self, jokes):
+        self.jokes = jokes
+        self.position = 0
+        self.next_round = None
+        self.refilling = False
+
+
+class JokeService:
+    """ Per-category pools of pre-shuffled jokes """
+
+    def __init__(self, sources, categories=('neutral',)):
+        self.sources = sources
+        self.categories = categories
+        self._rings = {}
+        self._lock = threading.Lock()
+
+    def _collect(self, category):
+        jokes = []
+        for source in self.sources:
+            try:
+                jokes.extend(source(category))
+            except Exception as e:
+                logger.error(f"ERROR joke source for '{category}': {e}")
+        # # the same joke from two sources counts once
+        jokes = list(dict.fromkeys(jokes))
+        random.shuffle(jokes)
+        return jokes
+
+    def start(self):
+        """ Fill the pools of all categories (blocking; run it in a warm-up thread) """
+        for category in self.categories:
+            jokes = self._collect(category)
+            with self._lock:
+                self._rings[category] = _Ring(jokes)
+            logger.info(f"Jokes '{category}': {len(jokes)}")
+        return self
+
+    def get(self, category='neutral'):
+        """ Next joke of the category, NO_JOKE while the pool is empty or not loaded yet """
+        with self._lock:
+            ring = self._rings.get(category)
+            if ring is None or not ring.jokes:
+                return NO_JOKE
+            if ring.position >= len(ring.jokes):
+                self._next_round(ring)
+            joke = ring.jokes[ring.position]
+            ring.position += 1
+            if ring.position * 2 >= len(ring.jokes) and ring.next_round is None and not ring.refilling:
+                ring.refilling = True
+                threading.Thread(target=self._refill, args=(category, ring), name=f"jokes-{category}", daemon=True).start()
+            return joke
+
+    def _next_round(self, ring):
+        last = ring.jokes[-1]
+        jokes = ring.next_round
+        if jokes is None:
+            # # background refill is late: reshuffle what we have
+            jokes = ring.jokes[:]
+            random.shuffle(jokes)
+        if len(jokes) > 1 and jokes[0] == last:
+            # # do not repeat a joke across the rounds boundary
+            jokes[0], jokes[-1] = jokes[-1], jokes[0]
+        ring.jokes, ring.position, ring.next_round = jokes, 0, None
+
+    def _refill(self, category, ring):
+        jokes = self._collect(category)
+        with self._lock:
+            if not jokes:
+                # # sources are empty now: keep serving the current pool
+                jokes = ring.jokes[:]
+                random.shuffle(jokes)
+            ring.next_round = jokes
+            ring.refilling = False
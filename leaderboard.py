@@ -0,0 +1,186 @@
+"""
+Rating leaderboards.
+
+Every board keeps its members in an order-statistics tree (a treap with
+subtree sizes) sorted by rating, highest first. A rating change is one
+delete + insert, top-N and "place of user X" queries walk one path of the
+tree: all O(log n), nothing is re-sorted.
+
+`Leaderboards` keeps the global board; the board of a chat ranks the members
+rated there (kept by `chat_ratings`) by it when asked, so nothing per chat
+is held here.
+"""
+
+import random
+
+
+def member_key(user_id, username=None):
+    """ Board member: the user id, "@username" for users known only by name """
+    if user_id is not None:
+        return user_id
+    return f"@{username.lower()}" if username else None
+
+
+class _Node:
+    __slots__ = ('key', 'priority', 'left', 'right', 'size')
+
+    def __init__(self, key):
+        self.key = key
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.size = 1
+
+
+def _size(node):
+    return node.size if node else 0
+
+
+def _split(node, key, inclusive=False):
+    """ (keys < key, keys >= key); with `inclusive` — (keys <= key, keys > key) """
+    if node is None:
+        return None, None
+    if node.key < key or (inclusive and node.key == key):
+        left, right = _split(node.right, key, inclusive)
+        node.right = left
+        node.size = 1 + _size(node.left) + _size(node.right)
+        return node, right
+    left, right = _split(node.left, key, inclusive)
+    node.left = right
+    node.size = 1 + _size(node.left) + _size(node.right)
+    return left, node
+
+
+def _merge(left, right):
+    if left is None or right is None:
+        return left or right
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        left.size = 1 + _size(left.left) + _size(left.right)
+        return left
+    right.left = _merge(left, right.left)
+    right.size = 1 + _size(right.left) + _size(right.right)
+    return right
+
+
+class RankTree:
+    """ Sorted set of comparable keys with O(log n) insert, delete, rank and k-th """
+
+    def __init__(self):
+        self.root = None
+
+    def __len__(self):
+        return _size(self.root)
+
+    def insert(self, key):
+        left, right = _split(self.root, key)
+        self.root = _merge(_merge(left, _Node(key)), right)
+
+    def delete(self, key):
+        left, right = _split(self.root, key)
+        _, right = _split(right, key, inclusive=True)
+        self.root = _merge(left, right)
+
+    def rank(self, key):
+        """ Number of keys smaller than `key` """
+        node, rank = self.root, 0
+        while node is not None:
+            if node.key < key:
+                rank += _size(node.left) + 1
+                node = node.right
+            else:
+                node = node.left
+        return rank
+
+    def kth(self, k):
+        """ k-th smallest key (0-based) """
+        node = self.root
+        while node is not None:
+            left = _size(node.left)
+            if k < left:
+                node = node.left
+            elif k == left:
+                return node.key
+            else:
+                k -= left + 1
+                node = node.right
+        raise IndexError(k)
+
+    def slice(self, start, stop):
+        return [self.kth(k) for k in range(max(0, start), min(stop, len(self)))]
+
+
+class Leaderboard:
+    """ Members ordered by rating, highest first (ties — by member key) """
+
+    def __init__(self):
+        self.ratings = {}
+        self._tree = RankTree()
+
+    @staticmethod
+    def _key(member, rating):
+        return (-rating, str(member), member)
+
+    def __len__(self):
+        return len(self.ratings)
+
+    def __contains__(self, member):
+        return member in self.ratings
+
+    def set(self, member, rating):
+        old = self.ratings.get(member)
+        if old == rating:
+            return
+        if old is not None:
+            self._tree.delete(self._key(member, old))
+        self.ratings[member] = rating
+        self._tree.insert(self._key(member, rating))
+
+    def remove(self, member):
+        old = self.ratings.pop(member, None)
+        if old is not None:
+            self._tree.delete(self._key(member, old))
+
+    def top(self, count, offset=0):
+        """ [(place, member, rating)] starting from place `offset` + 1 """
+        return [(offset + n + 1, key[2], -key[0]) for n, key in enumerate(self._tree.slice(offset, offset + count))]
+
+    def place(self, member):
+        """ 1-based place of the member, None if not on the board """
+        rating = self.ratings.get(member)
+        if rating is None:
+            return None
+        return self._tree.rank(self._key(member, rating)) + 1
+
+
+class Leaderboards:
+    """ The global board; boards of chat members ranked by it on request """
+
+    def __init__(self):
+        self.all = Leaderboard()
+
+    def load(self, ratings):
+        """ Fill the global board from (user_id, username, rating) rows """
+        for user_id, username, rating in ratings:
+            member = member_key(user_id, username)
+            if member is not None and rating is not None:
+                self.all.set(member, rating)
+
+    def ranked(self, members):
+        """ A board of `members` (e.g. everyone rated in a chat) by their global ratings """
+        board = Leaderboard()
+        for member in members:
+            rating = self.all.ratings.get(member)
+            if rating is not None:
+                board.set(member, rating)
+        return board
+
+    def update(self, user_id, username, rating):
+        """ New rating of a user """
+        member = member_key(user_id, username)
+        if member is None:
+            return
+        if user_id is not None and username:
+            # # the user was known only by @username before
+            self.all.remove(member_key(None, username))
+        self.all.set(member, rating)
@@ -0,0 +1,258 @@
+"""
+Append-only ledger of rating events.
+
+Every "+"/"-" and every admin override is one fixed-width binary record
+(EVENT, 44 bytes) appended to the current segment file of the ledger
+directory. Current ratings are a materialized view: the latest snapshot plus
+a replay of the segments written after it. Snapshots are taken in background
+and old segments are compacted away: the newest `retain_segments`, and any
+written in the last `retain_seconds` (the longest time-window stat), are kept
+for audits and time-window stats.
+
+    ledger/segment-000001.log   records
+    ledger/snapshot-000002.json ratings before segment 2, offset 0
+"""
+
+import glob
+import json
+import logging
+import os
+import re
+import struct
+import threading
+import time
+from collections import namedtuple
+
+logger = logging.getLogger(__name__)
+
+# # ts, chat_id, from_user_id, to_user_id, value (delta or new rating), rating after the event, kind
+EVENT = struct.Struct("<dqqqiiB3x")
+DELTA = 1  # "+" / "-": value is the change
+SET = 2  # admin override: value is the new rating
+
+Event = namedtuple("Event", "ts chat_id from_user_id to_user_id value rating kind")
+
+SEGMENT_RE = re.compile(r"segment-(\d+)\.log$")
+SNAPSHOT_RE = re.compile(r"snapshot-(\d+)\.json$")
+
+
+class RatingLedger:
+    """ Rating events in append-only segments, ratings as a materialized view """
+
+    def __init__(self, directory, segment_bytes=4 * 1024 * 1024, retain_segments=8, retain_seconds=0,
+                 snapshot_every=10000, snapshot_interval=300):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retain_segments = retain_segments
+        self.retain_seconds = retain_seconds
+        self.snapshot_every = snapshot_every  # events since the last snapshot
+        self.snapshot_interval = snapshot_interval  # seconds between checks
+        self.ratings = {}  # user id -> rating (materialized view)
+        self.segment = 1
+        self.events_since_snapshot = 0
+        self.bytes_written = 0
+        self._file = None
+        self._lock = threading.RLock()
+        self._stop_event = threading.Event()
+        self._snapshotter = None
+
+    # # —— Files
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f"segment-{segment:06d}.log")
+
+    def _snapshot_path(self, segment):
+        return os.path.join(self.directory, f"snapshot-{segment:06d}.json")
+
+    def _numbered(self, pattern, regex):
+        found = []
+        for path in glob.glob(os.path.join(glob.escape(self.directory), pattern)):
+            match = regex.search(path)
+            if match:
+                found.append(int(match.group(1)))
+        return sorted(found)
+
+    def segments(self):
+        return self._numbered("segment-*.log", SEGMENT_RE)
+
+    def snapshots(self):
+        return self._numbered("snapshot-*.json", SNAPSHOT_RE)
+
+    # # —— Lifecycle
+    @property
+    def is_empty(self):
+        """ No snapshot and no events yet """
+        if self.snapshots():
+            return False
+        return all(os.path.getsize(self._segment_path(segment)) == 0 for segment in self.segments())
+
+    def open(self):
+        """ Rebuild the ratings from the latest snapshot and the segments after it """
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            self.ratings = {}
+            start = 1
+            snapshots = self.snapshots()
+            if snapshots:
+                start = snapshots[-1]
+                with open(self._snapshot_path(start), "r") as f:
+                    self.ratings = {user_id: rating for user_id, rating in json.load(f)["ratings"]}
+            replayed = 0
+            for segment in self.segments():
+                if segment < start:
+                    continue
+                for event in self._read_segment(segment, repair=True):
+                    self.ratings[event.to_user_id] = event.rating
+                    replayed += 1
+            self.events_since_snapshot = replayed
+            self.segment = max([start, *self.segments()])
+            self._file = open(self._segment_path(self.segment), "ab")
+        logger.info(f"Ledger {self.directory} opened: {len(self.ratings)} ratings, {replayed} events replayed")
+        return self
+
+    def start(self):
+        if self._file is None:
+            self.open()
+        if self._snapshotter is None and self.snapshot_interval:
+            self._stop_event.clear()
+            self._snapshotter = threading.Thread(target=self._snapshot_loop, name="ledger-snapshots", daemon=True)
+            self._snapshotter.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._snapshotter is not None:
+            self._snapshotter.join()
+            self._snapshotter = None
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _snapshot_loop(self):
+        while not self._stop_event.wait(self.snapshot_interval):
+            if self.events_since_snapshot >= self.snapshot_every:
+                try:
+                    self.snapshot()
+                    self.compact()
+                except Exception as e:
+                    logger.error(f"ERROR ledger snapshot: {e}")
+
+    # # —— Writing
+    def record(self, to_user_id, value, rating, kind=DELTA, chat_id=0, from_user_id=0, ts=None):
+        """ Record an event whose resulting rating is already known (e.g. from the user store) """
+        with self._lock:
+            self._write(EVENT.pack(time.time() if ts is None else ts, chat_id or 0, from_user_id or 0,
+                                   to_user_id, value, rating, kind))
+            self.ratings[to_user_id] = rating
+            return rating
+
+    def record_deltas(self, batches, chat_id=0, ts=None):
+        """ Record batches of DELTA events [(to_user_id, [(from_user_id, delta)], rating)] (flushed once);
+            `rating` is the user's rating after the last delta of the batch
+        """
+        ts = time.time() if ts is None else ts
+        with self._lock:
+            for to_user_id, deltas, rating in batches:
+                after = rating - sum(delta for _, delta in deltas)
+                for from_user_id, delta in deltas:
+                    after += delta
+                    self._write(EVENT.pack(ts, chat_id or 0, from_user_id or 0, to_user_id, delta, after, DELTA),
+                                flush=False)
+                self.ratings[to_user_id] = rating
+            self._file.flush()
+
+    def _write(self, record, flush=True):
+        if self._file is None:
+            self.open()
+        if self._file.tell() + len(record) > self.segment_bytes:
+            self._rotate()
+        self._file.write(record)
+        if flush:
+            self._file.flush()
+        self.bytes_written += len(record)
+        self.events_since_snapshot += 1
+
+    def _rotate(self):
+        self._file.close()
+        self.segment += 1
+        self._file = open(self._segment_path(self.segment), "ab")
+
+    def seed(self, ratings):
+        """ Start an empty ledger from existing (user_id, rating) pairs: written as the first snapshot """
+        with self._lock:
+            self.ratings = {int(user_id): int(rating) for user_id, rating in ratings
+                            if user_id is not None and rating is not None}
+            self._write_snapshot(self.segment, self.ratings)
+            self.events_since_snapshot = 0
+
+    def set_ratings(self, ratings):
+        """ Bulk override of (user_id, rating) pairs, no events: call `snapshot()` afterwards to keep them """
+        with self._lock:
+            for user_id, rating in ratings:
+                if user_id is not None and rating is not None:
+                    self.ratings[int(user_id)] = int(rating)
+
+    # # —— Snapshots and compaction
+    def snapshot(self):
+        """ Fold everything written so far into a snapshot; new events go to a new segment """
+        with self._lock:
+            self._rotate()
+            self._write_snapshot(self.segment, self.ratings)
+            self.events_since_snapshot = 0
+        logger.info(f"Ledger snapshot before segment {self.segment}: {len(self.ratings)} ratings")
+
+    def _write_snapshot(self, segment, ratings):
+        path = self._snapshot_path(segment)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump({"segment": segment, "ratings": [[user_id, rating] for user_id, rating in ratings.items()]}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{path}.tmp", path)
+
+    def compact(self):
+        """ Drop old snapshots and segments already folded into the latest snapshot,
+            keeping the newest `retain_segments` of them and those written in the last `retain_seconds`
+        """
+        snapshots = self.snapshots()
+        if not snapshots:
+            return
+        latest = snapshots[-1]
+        for segment in snapshots[:-1]:
+            os.remove(self._snapshot_path(segment))
+        folded = [segment for segment in self.segments() if segment < latest]
+        keep_since = time.time() - self.retain_seconds
+        for segment in folded[:max(0, len(folded) - self.retain_segments)]:
+            path = self._segment_path(segment)
+            if os.path.getmtime(path) < keep_since:
+                os.remove(path)
+
+    # # —— Reading
+    def _read_segment(self, segment, repair=False):
+        path = self._segment_path(segment)
+        with open(path, "rb") as f:
+            data = f.read()
+        whole = len(data) - len(data) % EVENT.size
+        if whole != len(data):
+            logger.warning(f"Ledger {path}: {len(data) - whole} bytes of a torn record")
+            if repair:
+                with open(path, "r+b") as f:
+                    f.truncate(whole)
+        for fields in EVENT.iter_unpack(data[:whole]):
+            yield Event(*fields)
+
+    def events(self, user_id=None, since=None):
+        """ Retained events (oldest first), optionally of one user and/or newer than `since` (unix time) """
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+            segments = self.segments()
+        for segment in segments:
+            if since is not None and os.path.getmtime(self._segment_path(segment)) < since:
+                # # last written before `since`: every event in it is older
+                continue
+            for event in self._read_segment(segment):
+                if user_id is not None and event.to_user_id != user_id:
+                    continue
+                if since is not None and event.ts < since:
+                    continue
+                yield event
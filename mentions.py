@@ -0,0 +1,101 @@
+"""
+Users tagged in a message and a username -> user cache.
+
+`parse_mentions()` reads every `mention` (@username) and `text_mention`
+(a user without a username, the entity carries the user) of a message in
+one pass, in the order of the text, each user once. Entity offsets are
+UTF-16 code units: the text is cut by `Message.parse_entities()`.
+
+`UsernameCache` maps lowercase usernames to (user_id, first_name,
+last_name). It learns from every message author and every user looked up,
+keeps at most `max_size` names and evicts the least recently used one, so
+"+ @user" is answered without touching the user table; misses of a message
+are looked up together, in one batch.
+"""
+
+from collections import OrderedDict, namedtuple
+
+from telegram import MessageEntity
+
+Mention = namedtuple("Mention", "user_id username first_name last_name")
+
+MENTION_TYPES = (MessageEntity.MENTION, MessageEntity.TEXT_MENTION)
+
+
+def parse_mentions(message):
+    """ [Mention] of the message; user_id (and names) are None for @usernames not resolved yet """
+    mentions = []
+    seen = set()
+    for entity, text in message.parse_entities(MENTION_TYPES).items():
+        if entity.type == MessageEntity.TEXT_MENTION and entity.user is not None:
+            user = entity.user
+            mention = Mention(user.id, user.username, user.first_name, user.last_name)
+            key = user.id
+        else:
+            username = text[1:] if text.startswith("@") else text
+            if not username:
+                continue
+            mention = Mention(None, username, None, None)
+            key = username.lower()
+        if key not in seen:
+            seen.add(key)
+            mentions.append(mention)
+    return mentions
+
+
+class UsernameCache:
+    """ Bounded LRU of lowercase username -> (user_id, first_name, last_name) """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._users = OrderedDict()
+        # # metrics
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._users)
+
+    def learn(self, user_id, username, first_name=None, last_name=None):
+        """ Remember (or refresh) a user seen in a message or read from storage """
+        if user_id is None or not username:
+            return
+        key = username.lower()
+        self._users[key] = (user_id, first_name, last_name)
+        self._users.move_to_end(key)
+        if len(self._users) > self.max_size:
+            self._users.popitem(last=False)
+
+    def get(self, username):
+        key = username.lower()
+        user = self._users.get(key)
+        if user is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._users.move_to_end(key)
+        return user
+
+    def missing(self, mentions):
+        """ Usernames of the mentions that are not in the cache (to be looked up in storage) """
+        return [mention.username for mention in mentions if mention.user_id is None and self.get(mention.username) is None]
+
+    def resolve(self, mentions, found=None):
+        """ Mentions with ids and names filled in from the cache, after learning `found` — the storage
+            rows {lowercase username: (user_id, username, first_name, last_name, ...)} of the misses.
+            Users found nowhere keep user_id None; mentions of one user are merged.
+        """
+        for user_id, username, first_name, last_name, *_ in (found or {}).values():
+            self.learn(user_id, username, first_name, last_name)
+        resolved = []
+        seen = set()
+        for mention in mentions:
+            if mention.user_id is None:
+                user = self._users.get(mention.username.lower())
+                if user is not None:
+                    mention = Mention(user[0], mention.username, user[1], user[2])
+            key = mention.user_id if mention.user_id is not None else mention.username.lower()
+            if key not in seen:
+                seen.add(key)
+                resolved.append(mention)
+        return resolved
@@ -0,0 +1,141 @@
+"""
+Buffered log of chat messages.
+
+`MessageLog.write()` only puts a record on a bounded in-memory queue. A
+background thread writes queued records as line-delimited JSON in batches
+(by count or time), rotates the file by size or at midnight (UTC), gzips
+rotated files and keeps the newest `backups` of them.
+
+When the disk is slow and the queue is full, records are dropped (policy
+"drop") or the caller waits up to `block_timeout` seconds (policy "block").
+"""
+
+import datetime as dt
+import glob
+import gzip
+import json
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class MessageLog:
+    """ Line-delimited JSON message log with a background writer """
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, rotate_daily=True, backups=30,
+                 batch_size=200, flush_interval=1.0, queue_size=10000, policy="drop", block_timeout=0.05):
+        if policy not in ("drop", "block"):
+            raise ValueError(f"Unknown message log policy: {policy}")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_daily = rotate_daily
+        self.backups = backups
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.dropped = 0
+        self.written = 0
+        self.bytes_written = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._writer = None
+        self._file = None
+        self._day = None
+
+    def write(self, record):
+        """ Queue a record (dict). Returns False if it was dropped """
+        try:
+            if self.policy == "block":
+                self._queue.put(record, timeout=self.block_timeout)
+            else:
+                self._queue.put_nowait(record)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    # # —— Lifecycle
+    def start(self):
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_loop, name="message-log-writer", daemon=True)
+            self._writer.start()
+        return self
+
+    def stop(self):
+        """ Write everything queued and close the file """
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+        if self.dropped:
+            logger.warning(f"Message log: {self.dropped} records dropped")
+
+    # # —— Writer thread
+    def _write_loop(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    record = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if record is None:
+                    stopping = True
+                    break
+                batch.append(record)
+            if batch:
+                try:
+                    self._write_batch(batch)
+                except Exception as e:
+                    logger.error(f"ERROR write message log: {e}")
+        self._close()
+
+    def _write_batch(self, batch):
+        if self._day is None and os.path.isfile(self.path):
+            # # day of a file left by the previous run
+            self._day = dt.datetime.utcfromtimestamp(os.path.getmtime(self.path)).date()
+        self._maybe_rotate()
+        if self._file is None:
+            self._file = open(self.path, "ab")
+            self._day = self._day or dt.datetime.utcnow().date()
+        lines = "".join(json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=str) + "\n"
+                        for record in batch)
+        data = lines.encode("utf-8")
+        self._file.write(data)
+        self._file.flush()
+        self.written += len(batch)
+        self.bytes_written += len(data)
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    # # —— Rotation
+    def _maybe_rotate(self):
+        if not os.path.isfile(self.path):
+            return
+        new_day = self.rotate_daily and self._day is not None and dt.datetime.utcnow().date() != self._day
+        if new_day or os.path.getsize(self.path) >= self.max_bytes:
+            self._close()
+            self._rotate()
+
+    def _rotate(self):
+        root, ext = os.path.splitext(self.path)
+        rotated = f"{root}.{dt.datetime.utcnow():%Y%m%d-%H%M%S-%f}{ext}"
+        os.replace(self.path, rotated)
+        self._day = None
+        with open(rotated, "rb") as src, gzip.open(f"{rotated}.gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(rotated)
+        rotated_files = sorted(glob.glob(f"{glob.escape(root)}.*{ext}.gz"))
+        for old in rotated_files[:max(0, len(rotated_files) - self.backups)]:
+            os.remove(old)
+        logger.info(f"Message log rotated: {rotated}.gz")
@@ -0,0 +1,242 @@
+"""
+Process metrics: counters and histograms in the Prometheus text format.
+
+Updating a metric is a dict lookup and an addition under a per-metric lock,
+cheap enough for every update. Values owned by other components (queue
+depths, records written, ...) are read only when scraped, through
+callbacks registered with `Registry.callback()`.
+
+`MetricsServer` serves `GET /metrics` from a background thread.
+"""
+
+import bisect
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+# # seconds: 0.5 ms .. 10 s
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels_text(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """ Monotonic totals per label values """
+
+    kind = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values = {}  # label values -> total
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self.values)
+        for labels, value in sorted(values.items()):
+            yield self.name, _labels_text(self.label_names, labels), value
+
+
+class Histogram:
+    """ Observations per label values in cumulative buckets, with their count and sum """
+
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [per-bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        slot = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+            counts[slot] += 1
+            counts[-1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def count(self, *labels):
+        counts = self.values.get(labels)
+        return sum(counts[:-1]) if counts else 0
+
+    def quantile(self, share, *labels):
+        """ Upper bound of the bucket holding the `share` quantile (None without observations) """
+        counts = self.values.get(labels)
+        if not counts:
+            return None
+        total = sum(counts[:-1])
+        if not total:
+            return None
+        seen = 0
+        for bound, count in zip((*self.buckets, float("inf")), counts[:-1]):
+            seen += count
+            if seen >= share * total:
+                return bound
+        return float("inf")
+
+    def mean(self, *labels):
+        counts = self.values.get(labels)
+        total = sum(counts[:-1]) if counts else 0
+        return counts[-1] / total if total else None
+
+    def samples(self):
+        with self._lock:
+            values = {labels: counts[:] for labels, counts in self.values.items()}
+        for labels, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts[:-1]):
+                cumulative += count
+                yield f"{self.name}_bucket", _labels_text(self.label_names, labels, [("le", _number(bound))]), cumulative
+            yield f"{self.name}_sum", _labels_text(self.label_names, labels), counts[-1]
+            yield f"{self.name}_count", _labels_text(self.label_names, labels), cumulative
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+        return False
+
+
+class _Callback:
+    """ A metric read from another component when scraped """
+
+    def __init__(self, name, help, kind, func, labels=()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label_names = tuple(labels)
+        self.func = func  # () -> value, or {label values: value}
+
+    def samples(self):
+        try:
+            values = self.func()
+        except Exception as e:
+            logger.error(f"ERROR metric {self.name}: {e}")
+            return
+        if not isinstance(values, dict):
+            values = {(): values}
+        for labels, value in sorted(values.items()):
+            labels = labels if isinstance(labels, tuple) else (labels,)
+            yield self.name, _labels_text(self.label_names, labels), value
+
+
+class Registry:
+    """ All metrics of the process """
+
+    def __init__(self):
+        self.metrics = {}
+        self.started_at = time.time()
+
+    def _add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is registered twice")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def callback(self, name, help, func, kind="gauge", labels=()):
+        return self._add(_Callback(name, help, kind, func, labels))
+
+    def render(self):
+        """ Prometheus text exposition format """
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer:
+    """ GET /metrics of a registry, served from a background thread """
+
+    def __init__(self, registry, host="127.0.0.1", port=9108):
+        self.registry = registry
+        self.host = host
+        self.port = port
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        except OSError as e:
+            logger.error(f"ERROR metrics server on {self.host}:{self.port}: {e}")
+            return self
+        self.port = self._server.server_address[1]
+        self._thread = threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True)
+        self._thread.start()
+        logger.info(f"Metrics on http://{self.host}:{self.port}/metrics")
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+            self._thread = None
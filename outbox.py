@@ -0,0 +1,251 @@
+"""
+Outbound Bot API calls, scheduled.
+
+Handlers do not talk to Telegram themselves: they `submit()` a call (a
+coroutine function, e.g. a partial of `message.reply_text`) for a chat and
+return at once. One scheduler task sends the calls:
+
+- token buckets per chat and for the whole bot keep the sends within
+  Telegram's flood limits (about 1 message/s in a chat, 20/min in a group,
+  30/s overall);
+- lanes: of the chats allowed to send, the call of the lowest lane goes
+  first (rating replies before admin dumps and GIFs); calls of one chat are
+  sent one at a time, lane first, then in order of submission;
+- a 429 (`RetryAfter`) pauses the chat for `retry_after` seconds and the call
+  is sent again; timeouts and network errors are retried with backoff up to
+  `max_retries` times; other errors are logged and the call is dropped.
+
+Up to `concurrency` calls are in flight at a time, over the keep-alive
+connections of the Bot's HTTP pool.
+"""
+
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import BadRequest, NetworkError, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# # Lanes, the lower goes first
+RATING, NORMAL, BULK = 0, 1, 2
+
+# # (messages per second, burst)
+CHAT_LIMITS = {
+    "private": (1.0, 3),
+    "group": (20 / 60, 5),
+}
+GLOBAL_LIMIT = (30.0, 30)
+
+_IDLE, _READY, _WAITING, _SENDING = range(4)
+
+
+class TokenBucket:
+    """ `rate` tokens per second, up to `burst` saved; `pause()` holds it for a while """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'paused_until')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def delay(self, now):
+        """ Seconds until a token can be taken """
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.paused_until - now)
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds, now):
+        self.paused_until = max(self.paused_until, now + seconds)
+
+    def full(self, now):
+        return self.delay(now) <= 0 and self.tokens >= self.burst
+
+
+class _Chat:
+    __slots__ = ('chat_id', 'bucket', 'calls', 'state', 'ready_key')
+
+    def __init__(self, chat_id, bucket):
+        self.chat_id = chat_id
+        self.bucket = bucket
+        self.calls = []  # heap of [lane, seq, call, attempt]
+        self.state = _IDLE
+        self.ready_key = None
+
+
+class Outbox:
+    """ Per-chat queues of Bot API calls, sent by lane within the flood limits """
+
+    def __init__(self, chat_limits=CHAT_LIMITS, global_limit=GLOBAL_LIMIT, concurrency=8, max_retries=5,
+                 max_pending=10000):
+        self.chat_limits = chat_limits
+        self.bucket = TokenBucket(*global_limit)
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.max_pending = max_pending
+        self._chats = {}  # chat id -> _Chat (with calls, or a bucket still refilling)
+        self._ready = []  # heap of (lane, seq, chat id): chats that may send now
+        self._waiting = []  # heap of (monotonic time, chat id): chats waiting for their bucket
+        self._seq = itertools.count()
+        self._sending = set()
+        self._wake = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._task = None
+        self._pruned_at = time.monotonic()
+        self.pending = 0
+        # # metrics
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def _chat_bucket(self, chat_id):
+        return TokenBucket(*self.chat_limits["group" if chat_id < 0 else "private"])
+
+    # # —— Producers
+    def submit(self, chat_id, call, lane=NORMAL):
+        """ Queue `call` (async, no arguments) for the chat; False if the outbox is full """
+        if self.pending >= self.max_pending:
+            self.dropped += 1
+            logger.warning(f"Outbox full ({self.pending} calls): dropped a call to chat {chat_id}")
+            return False
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat(chat_id, self._chat_bucket(chat_id))
+        entry = [lane, next(self._seq), call, 0]
+        heapq.heappush(chat.calls, entry)
+        self.pending += 1
+        self._drained.clear()
+        if chat.state == _IDLE:
+            self._schedule(chat, time.monotonic())
+        elif chat.state == _READY and chat.calls[0] is entry:
+            # # jumps ahead of the chat's queued calls; the old ready entry goes stale
+            chat.ready_key = (lane, entry[1])
+            heapq.heappush(self._ready, (lane, entry[1], chat_id))
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        self._wake.set()
+        return True
+
+    async def drain(self):
+        """ Wait until every submitted call is sent (or given up) """
+        while self.pending:
+            await self._drained.wait()
+
+    async def stop(self, timeout=10):
+        """ Send what is queued (for up to `timeout` seconds), then stop the scheduler """
+        try:
+            await asyncio.wait_for(self.drain(), timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"ERROR outbox stopped with {self.pending} calls not sent")
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, *self._sending, return_exceptions=True)
+            self._task = None
+
+    # # —— Scheduler
+    def _schedule(self, chat, now):
+        """ Put a chat that is not sending into the ready or the waiting heap """
+        if not chat.calls:
+            chat.state = _IDLE
+            return
+        delay = chat.bucket.delay(now)
+        if delay > 0:
+            chat.state = _WAITING
+            heapq.heappush(self._waiting, (now + delay, chat.chat_id))
+        else:
+            lane, seq = chat.calls[0][0], chat.calls[0][1]
+            chat.state = _READY
+            chat.ready_key = (lane, seq)
+            heapq.heappush(self._ready, (lane, seq, chat.chat_id))
+
+    def _prune(self, now):
+        """ Forget idle chats whose bucket is full again """
+        for chat_id in [chat_id for chat_id, chat in self._chats.items()
+                        if chat.state == _IDLE and chat.bucket.full(now)]:
+            del self._chats[chat_id]
+        self._pruned_at = now
+
+    async def _run(self):
+        while True:
+            self._wake.clear()
+            now = time.monotonic()
+            while self._waiting and self._waiting[0][0] <= now:
+                _, chat_id = heapq.heappop(self._waiting)
+                chat = self._chats.get(chat_id)
+                if chat is not None and chat.state == _WAITING:
+                    self._schedule(chat, now)
+            if now - self._pruned_at > 60:
+                self._prune(now)
+
+            timeout = self._waiting[0][0] - now if self._waiting else None
+            if self._ready and len(self._sending) < self.concurrency:
+                delay = self.bucket.delay(now)
+                if delay <= 0:
+                    self._send_next(now)
+                    continue
+                timeout = delay if timeout is None else min(timeout, delay)
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _send_next(self, now):
+        lane, seq, chat_id = heapq.heappop(self._ready)
+        chat = self._chats.get(chat_id)
+        if chat is None or chat.state != _READY or chat.ready_key != (lane, seq):
+            return  # stale entry
+        entry = heapq.heappop(chat.calls)
+        chat.state = _SENDING
+        chat.bucket.take(now)
+        self.bucket.take(now)
+        task = asyncio.get_running_loop().create_task(self._send(chat, entry))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _send(self, chat, entry):
+        lane, seq, call, attempt = entry
+        done = True
+        try:
+            await call()
+            self.sent += 1
+        except RetryAfter as e:
+            logger.warning(f"Flood control in chat {chat.chat_id}: retry in {e.retry_after} s")
+            chat.bucket.pause(float(e.retry_after), time.monotonic())
+            done = False
+        except NetworkError as e:
+            if isinstance(e, BadRequest) or attempt >= self.max_retries:
+                logger.error(f"ERROR send to chat {chat.chat_id}: {e}")
+                self.failed += 1
+            else:
+                logger.warning(f"Send to chat {chat.chat_id} failed ({e}), retry {attempt + 1}")
+                chat.bucket.pause(min(0.5 * 2 ** attempt, 30), time.monotonic())
+                done = False
+        except Exception as e:
+            logger.error(f"ERROR send to chat {chat.chat_id}: {e}")
+            self.failed += 1
+        finally:
+            if done:
+                self.pending -= 1
+                if not self.pending:
+                    self._drained.set()
+            else:
+                # # same place in the chat's queue, sent again when the pause is over
+                self.retried += 1
+                heapq.heappush(chat.calls, [lane, seq, call, attempt + 1])
+            self._schedule(chat, time.monotonic())
+            self._wake.set()
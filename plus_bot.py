@@ -4,8 +4,8 @@
 
 """
 Simple Bot to reply to Telegram messages.
-First, a few handler functions are defined. Then, those functions are passed to
-the Dispatcher and registered at their respective places.
+First, a few handler coroutines are defined. Then, those functions are passed to
+the Application and registered at their respective places.
 Then, the bot is started and runs until we press Ctrl-C on the command line.
 Usage:
 Basic Echobot example, repeats messages.
@@ -13,21 +13,53 @@ Press Ctrl-C on the command line or send a signal to the process to stop the
 bot.
 """
 
-import logging
+import argparse
+import asyncio
+import functools
+import itertools
 import json
-import datetime as dt
+import logging
 import os
+import random
 # from functools import lru_cache
 # from IPython.display import HTML
 import re
+import secrets
+import signal
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
 
-import pandas as pd
-from random import randrange
+STARTED_AT = time.perf_counter()  # startup timing, taken before the heavy imports
 
 from telegram import Update, ForceReply
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
-
-import pyjokes as pyj
+from telegram.error import BadRequest
+from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters
+
+from analytics import RatingAnalytics
+from api_request import TimedRequest
+from chat_ratings import ChatRatings
+from coalescer import RatingCoalescer
+from export import CHUNK_ROWS, DEFAULT_SUFFIX, SUFFIXES, read_rows, write_rows
+from gif_cache import GifLibrary
+from jokes import JokeService, file_source, pyjokes_source
+from leaderboard import Leaderboards, member_key
+from ledger import DELTA, SET, RatingLedger
+from mentions import Mention, UsernameCache, parse_mentions
+from message_log import MessageLog
+from metrics import MetricsServer, Registry
+from outbox import BULK, NORMAL, RATING, Outbox
+from rate_limiter import RateLimiter
+from rating_filter import RatingPrefilter
+from sqlite_store import SQLiteUserStore, migrate_to_sqlite
+from update_processor import InFlightQueue, ShardedUpdateProcessor, chat_key
+from user_store import UserStore
+from webhook_server import WebhookServer
+
+# # Startup phases and their duration (seconds), see main()
+STARTUP_PHASES = {"imports": time.perf_counter() - STARTED_AT}
 
 try:
     with open("bot_key.txt", "r") as f:
@@ -37,8 +69,57 @@ except Exception as e:
     TOKEN = ""
 
 USER_PANDAS_DATABASE = "users_database.pandas"
+USER_DB_FLUSH_INTERVAL = 5  # seconds between background writes of the user database
+USER_JSON_DATABASE = "user_data_base.json"  # legacy ratings, read only by `migrate-sqlite`
+USER_SQLITE_DATABASE = "users_database.sqlite3"
+STORAGE_BACKEND = os.environ.get("PLUS_BOT_STORAGE", "pickle")  # "pickle" | "sqlite"
+LEDGER_DIR = "./ledger/"  # append-only log of rating events (+ snapshots)
+RATING_SCOPE = os.environ.get("PLUS_BOT_RATING_SCOPE", "chat")  # "chat": a rating per chat | "global": one for all chats
+CHAT_RATINGS_DIR = "./chat_ratings/"  # one file per chat
+CHAT_RATINGS_IN_MEMORY = 1000  # chats kept loaded, colder ones are written and dropped
+CHAT_RATINGS_IDLE = 600  # seconds without ratings before a chat is dropped from memory
+
+# # Anti-spam windows — scope: (seconds, max appreciations in the window);
+# # "giver" (one giver in one chat) and "chat" (whole chat) windows can be added
+RATE_LIMITS = {
+    "pair": (15, 1),    # the same giver to the same receiver
+}
+RATE_LIMITS_SNAPSHOT = "rate_limits.json"
+RATE_LIMITS_SNAPSHOT_INTERVAL = 30  # seconds
+
+UPDATE_WORKERS = 16  # shards handled in parallel (updates within a shard go in order)
+UPDATE_QUEUE_SIZE = 100  # updates waiting per shard
+UPDATE_MAX_IN_FLIGHT = 1000  # updates taken but not processed yet; polling / webhook intake waits above it
+STORAGE_WORKERS = 4  # threads running blocking storage calls
+ANALYTICS_CHUNK = 5000  # ledger events replayed into the window stats per event-loop turn at start
+
+# # Webhook mode (instead of long polling) when a public URL is set; the secret is checked on every POST
+# # (a random one is registered with Telegram if none is set), behind a TLS proxy on the same host by default
+WEBHOOK_URL = os.environ.get("PLUS_BOT_WEBHOOK_URL", "")  # e.g. https://bot.example.com/telegram
+WEBHOOK_LISTEN = os.environ.get("PLUS_BOT_WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("PLUS_BOT_WEBHOOK_PORT", "8443"))
+WEBHOOK_SECRET = os.environ.get("PLUS_BOT_WEBHOOK_SECRET", "")
+WEBHOOK_MAX_CONNECTIONS = 40  # parallel connections Telegram may open
+WEBHOOK_MAX_CONCURRENCY = 64  # requests decoded and queued at a time
+WEBHOOK_MAX_BODY_BYTES = 1024 * 1024
+WEBHOOK_DECODE_WORKERS = 2
+
+# # Prometheus text metrics on http://<listen>:<port>/metrics (port 0 — off), a summary in /stats
+METRICS_LISTEN = os.environ.get("PLUS_BOT_METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("PLUS_BOT_METRICS_PORT", "9108"))
+LOG_SAMPLE_EVERY = 100  # at DEBUG level, per-message details are logged for every N-th update only
+
+# # Outgoing messages (flood limits per chat and per bot: see outbox.py)
+OUTBOX_CONCURRENCY = 8  # Bot API calls in flight at a time
+OUTBOX_MAX_RETRIES = 5  # on timeouts and network errors; 429 is always retried after its retry_after
+OUTBOX_STOP_TIMEOUT = 10  # seconds to send what is queued at shutdown
 COMMANDS = {"+": "Plus", 
             "-": "Minus"}
+RATING_DELTAS = {"+": 1, 
+                 "-": -1}
+
+RATING_COALESCE_WINDOW = 0.2  # seconds a burst of +/- to one user in one chat is collected (0 — write each at once)
+RATING_SUMMARY = True  # one "+7 ..." reply per burst instead of one per +/-
 
 RATING_COMMANDS = {    
     "👍": "+", 
@@ -47,7 +128,26 @@ RATING_COMMANDS = {
     "🙁": "-", 
 } 
 
+MESSAGE_LOG_FILE = "telegram_messages.jsonl"
+MESSAGE_LOG_MAX_BYTES = 10 * 1024 * 1024  # rotate (and gzip) when bigger, and at midnight UTC
+MESSAGE_LOG_BACKUPS = 30  # rotated files to keep
+MESSAGE_LOG_POLICY = "drop"  # "drop" | "block" — when the disk is too slow for the chat traffic
+
+TOP_PAGE_SIZE = 10  # users per /top page
+
+EXPORT_DIR = "./exports/"  # /export files: users-<time>.parquet | .arrow | .csv.gz
+EXPORT_KEEP = 5  # newest export files kept
+EXPORT_MAX_UPLOAD_BYTES = 50 * 1024 * 1024  # Bot API limit for sending a document
+USERNAME_CACHE_SIZE = 100000  # @username -> user id of recently seen users, for "+ @user"
+
+JOKES_DIR = "./jokes/"  # local jokes: <category>.txt, one joke per line
+JOKE_CATEGORIES = ("neutral", "chuck", "all")
+
 GIFS_DIR = "./gifs/"
+GIF_FILE_IDS = "gif_file_ids.json"  # Telegram file_id of every uploaded gif
+GIF_CACHE_BYTES = 16 * 1024 * 1024  # gifs not uploaded yet, kept in memory
+
+IS_RATING_CANDIDATE = RatingPrefilter(COMMANDS, RATING_COMMANDS)
 
 # Enable logging
 logging.basicConfig(
@@ -57,6 +157,89 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# # Process-wide user table
+if STORAGE_BACKEND == "sqlite":
+    # every change committed to SQLite (WAL), atomic rating increments
+    USERS = SQLiteUserStore(USER_SQLITE_DATABASE)
+else:
+    # loaded once, flushed to disk in background
+    USERS = UserStore(USER_PANDAS_DATABASE, flush_interval=USER_DB_FLUSH_INTERVAL)
+
+# # Ratings per chat, sharded by chat; USERS keeps the global rollup
+CHAT_RATINGS = ChatRatings(CHAT_RATINGS_DIR, 
+                           max_chats=CHAT_RATINGS_IN_MEMORY, 
+                           idle_seconds=CHAT_RATINGS_IDLE, 
+                           flush_interval=USER_DB_FLUSH_INTERVAL)
+
+STORAGE_EXECUTOR = ThreadPoolExecutor(max_workers=STORAGE_WORKERS, thread_name_prefix="storage")
+BACKGROUND_TASKS = set()  # warm-ups running after the first poll, cancelled at shutdown
+
+MESSAGE_LOG = MessageLog(MESSAGE_LOG_FILE, 
+                         max_bytes=MESSAGE_LOG_MAX_BYTES, 
+                         backups=MESSAGE_LOG_BACKUPS, 
+                         policy=MESSAGE_LOG_POLICY)
+
+# # Karma gained per rolling window (week, month, trending), all chats and per chat
+ANALYTICS = RatingAnalytics()
+
+# # Every rating change as an event; ratings rebuilt from snapshot + log tail.
+# # Old segments are kept for the longest window: the window stats are replayed from them at start
+LEDGER = RatingLedger(LEDGER_DIR, retain_seconds=ANALYTICS.span)
+
+# # Sorted ratings (global and per chat) for /top and places
+LEADERBOARDS = Leaderboards()
+
+# # Mentions resolved without the user table: learned from every message author
+USERNAMES = UsernameCache(USERNAME_CACHE_SIZE)
+
+# # Shuffled joke pools, refilled in background (pyjokes + local files)
+JOKES = JokeService([pyjokes_source(language='en'), file_source(JOKES_DIR)], categories=JOKE_CATEGORIES)
+
+GIFS = GifLibrary(GIFS_DIR, file_ids_path=GIF_FILE_IDS, cache_bytes=GIF_CACHE_BYTES)
+
+RATE_LIMITER = RateLimiter(RATE_LIMITS, 
+                           snapshot_path=RATE_LIMITS_SNAPSHOT, 
+                           snapshot_interval=RATE_LIMITS_SNAPSHOT_INTERVAL)
+
+# # Replies are queued: sent by lane (ratings first) within Telegram's flood limits, retried on 429
+OUTBOX = Outbox(concurrency=OUTBOX_CONCURRENCY, 
+                max_retries=OUTBOX_MAX_RETRIES)
+
+# # Metrics: cheap counters/histograms on the hot path, component state read when scraped
+METRICS = Registry()
+HANDLER_SECONDS = METRICS.histogram("plus_bot_handler_seconds", "Handler latency", labels=("handler",))
+STORAGE_SECONDS = METRICS.histogram("plus_bot_storage_seconds", "Blocking storage call latency", labels=("op",))
+API_SECONDS = METRICS.histogram("plus_bot_api_seconds", "Telegram Bot API call latency", labels=("method", "status"))
+RATINGS_CHANGED = METRICS.counter("plus_bot_ratings_total", "Ratings changed by +/-", labels=("delta",))
+RATE_LIMITED = METRICS.counter("plus_bot_rate_limited_total", "Ratings rejected by the anti-spam limits", labels=("scope",))
+METRICS.callback("plus_bot_bytes_written_total", "Bytes written to disk by storage", 
+                 lambda: {"users": getattr(USERS, 'bytes_written', 0), 
+                          "ledger": LEDGER.bytes_written, 
+                          "chat_ratings": CHAT_RATINGS.bytes_written, 
+                          "message_log": MESSAGE_LOG.bytes_written}, 
+                 kind="counter", labels=("store",))
+METRICS.callback("plus_bot_message_log_dropped_total", "Messages dropped by the full message log queue", 
+                 lambda: MESSAGE_LOG.dropped, kind="counter")
+METRICS.callback("plus_bot_updates_total", "Updates processed", lambda: UPDATE_PROCESSOR.processed, kind="counter")
+METRICS.callback("plus_bot_update_queue", "Updates waiting in the worker queues", lambda: UPDATE_PROCESSOR.stats()["queued"])
+METRICS.callback("plus_bot_update_wait_seconds_max", "Longest time an update waited in a queue", 
+                 lambda: UPDATE_PROCESSOR.wait_max)
+METRICS.callback("plus_bot_rating_batches_total", "Coalesced rating writes", lambda: RATING_COALESCER.batches, 
+                 kind="counter")
+METRICS.callback("plus_bot_rating_batch_items_total", "Ratings in coalesced writes", lambda: RATING_COALESCER.items, 
+                 kind="counter")
+METRICS.callback("plus_bot_outbox_calls_total", "Bot API calls of the outbox by result", 
+                 lambda: {"sent": OUTBOX.sent, "retried": OUTBOX.retried, "failed": OUTBOX.failed, "dropped": OUTBOX.dropped}, 
+                 kind="counter", labels=("result",))
+METRICS.callback("plus_bot_outbox_pending", "Bot API calls waiting in the outbox", lambda: OUTBOX.pending)
+METRICS.callback("plus_bot_username_cache_total", "Username cache lookups by result", 
+                 lambda: {"hit": USERNAMES.hits, "miss": USERNAMES.misses}, kind="counter", labels=("result",))
+METRICS.callback("plus_bot_users", "Users in the user table", lambda: len(USERS))
+METRICS.callback("plus_bot_chats_loaded", "Chat rating shards in memory", lambda: len(CHAT_RATINGS))
+METRICS.callback("plus_bot_uptime_seconds", "Seconds since start", lambda: time.time() - METRICS.started_at)
+
+METRICS_SERVER = MetricsServer(METRICS, host=METRICS_LISTEN, port=METRICS_PORT)
+
 my_style = """background-color: rgba(0, 0, 0, 0);
 border-bottom-color: rgb(0, 0, 0);
 border-bottom-style: none;
@@ -96,13 +279,12 @@ width: 700px;
 
 def HTML_with_style(df, style=None, random_id=None):
     # from IPython.display import HTML
-    import numpy as np
     # import re
 
     df_html = df.to_html()
 
     if random_id is None:
-        random_id = 'id%d' % np.random.choice(np.arange(1000000))
+        random_id = 'id%d' % random.randrange(1000000)
 
     if style is None:
         style = """
@@ -126,151 +308,228 @@ def HTML_with_style(df, style=None, random_id=None):
     return style + df_html
 
 
-# @lru_cache()
 def read_user_database(user_database_file="users_database.pandas"):
-    # # Read or create Database (pandas table)
-    if os.path.isfile(user_database_file):
-        users = pd.read_pickle(user_database_file, compression="gzip")
-    else:
-        logger.warning(f"No database {user_database_file} is found.")
-        users = pd.DataFrame(columns=['user_id', 'username', 'first_name', 'last_name', 'rating'])
-    return users
+    """ Copy of the in-memory user table (the file is read only once, at startup) """
+    return USERS.snapshot()
 
 
 def get_user_id(username):
     """ Gets id from database based on username 
         if not found returns None
     """
-    users = read_user_database(user_database_file=USER_PANDAS_DATABASE)
-    user_id = users.loc[users['username'] == username, 'user_id']
-    user_id = user_id.item() if len(user_id) > 0 else None
-    return user_id
+    return USERS.get_user_id(username)
 
 
 def get_user_full_name(user_id):
-    users = read_user_database(user_database_file=USER_PANDAS_DATABASE)
-    first_name = users.loc[users['user_id'] == user_id, 'first_name']
-    last_name = users.loc[users['user_id'] == user_id, 'last_name']
-    first_name = first_name.item() if len(first_name) > 0 else None
-    last_name = last_name.item() if len(last_name) > 0 else None
-    return (first_name, last_name)
+    return USERS.get_full_name(user_id)
 
 
 def get_user_rating(user_id=None, username=None, first_name=None):
     try:
-        users = read_user_database(user_database_file=USER_PANDAS_DATABASE)
-        if user_id:
-            rating = users.loc[users['user_id'] == user_id, 'rating']
-            return rating.item() if len(rating) == 1 else 0
-        elif username:
-            rating = users.loc[users['username'] == username, 'rating']
-            return rating.item() if len(rating) == 1 else 0            
-        elif first_name:
-            rating = users.loc[users['first_name'] == first_name, 'rating']
-            return rating.item() if len(rating) == 1 else 0
-
+        return USERS.get_rating(user_id=user_id, username=username, first_name=first_name)
     except Exception as e:
         logger.error(f"ERROR read user database: {e}")
     return 0
 
 
-def update_user_rating(user_id=None, username=None, first_name=None, rating=None):
+def get_users(user_ids=(), usernames=()):
+    """ Batched lookup: {user id or lowercase username: (user_id, username, first_name, last_name, rating)} """
     try:
-        logger.info(f"update_user_rating| rating: {rating}")
-        logger.info(f"Supplied info: user_id={user_id}, username={username}, first_name={first_name}, rating={rating}")
-        
-        users = read_user_database(user_database_file=USER_PANDAS_DATABASE)
-        
-        # logger.info(f"DEBUG {(user_id in users['user_id'].to_list())}")
-        # # Update rating        
-        if user_id and (user_id in users['user_id'].to_list()):
-            logger.info(f"by user_id: {user_id} found, change rating")
-            users.loc[users['user_id'] == user_id, 'rating'] = rating
-            username = users.loc[users['user_id'] == user_id, 'username'].item()
-            logger.info(f"Rating in DB updated. By {user_id}: @{username} R={rating}")
-
-        elif username and (username in users['username'].to_list()):
-            logger.info(f"by username: {username} found, change rating")
-            users.loc[users['username'] == username, 'rating'] = rating
-            db_user_id = users.loc[users['username'] == username, 'user_id'].item()
-            logger.info(f"Rating in DB updated. By @{username}: id {db_user_id} R={rating}")
-        
-        elif first_name and (first_name in users['first_name'].to_list()):
-            logger.info(f"by first_name: {first_name} found, change rating")
-            users.loc[users['first_name'] == first_name, 'rating'] = rating
-            db_user_id = users.loc[users['first_name'] == first_name, 'user_id'].item()
-            logger.info(f"Rating in DB updated. By {first_name}: id {db_user_id} R={rating}")
+        return USERS.get_users(user_ids=user_ids, usernames=usernames)
+    except Exception as e:
+        logger.error(f"ERROR read user database: {e}")
+    return {}
 
-        else:
-            # # didn't find user
-            logger.info(f"Fail! User by id:{user_id} / username:{username} — not found.")
-            return 0
-
-        users.to_pickle(USER_PANDAS_DATABASE, compression="gzip")
-        logger.info(f"Database updated. Records: {len(users)}")
-        # print(users)
-        return rating
+
+def user_display_name(user, member):
+    """ "First Last (@username)" of a get_users() row, the member key if the user is unknown """
+    if user is None:
+        return str(member)
+    name = " ".join(part for part in (user[2], user[3]) if part)
+    if user[1]:
+        name = f"{name} (@{user[1]})" if name else f"@{user[1]}"
+    return name or str(user[0])
+
+
+def update_user_rating(user_id=None, username=None, first_name=None, rating=None):
+    try:
+        if verbose():
+            logger.debug(f"update_user_rating| rating: {rating}")
+            logger.debug(f"Supplied info: user_id={user_id}, username={username}, first_name={first_name}, rating={rating}")
+        return USERS.set_rating(rating, user_id=user_id, username=username, first_name=first_name)
     except Exception as e:
         logger.error(f"ERROR `update_user_rating`: {e}")
     return 0            
 
 
-def update_user_db(user_id=None, username=None, first_name=None, last_name=None, rating=None):
+def add_user_ratings(changes):
+    """ Atomic +/- of several users at once: [(delta, user_id, username, first_name, last_name)], a user
+        found by id (by username if the id is not known). Unknown users are created, then rated.
+        Returns the new ratings (None where it failed)
+    """
     try:
-        users = read_user_database(USER_PANDAS_DATABASE)
+        ratings = USERS.add_ratings([(delta, user_id, None if user_id is not None else username) 
+                                     for delta, user_id, username, _, _ in changes])
+        missing = [number for number, rating in enumerate(ratings) if rating is None]
+        for number in missing:
+            _, user_id, username, first_name, last_name = changes[number]
+            update_user_db(user_id=user_id, username=username, first_name=first_name, last_name=last_name)
+        if missing:
+            created = USERS.add_ratings([changes[number][:3] for number in missing])
+            for number, rating in zip(missing, created):
+                ratings[number] = rating
+        return ratings
+    except Exception as e:
+        logger.error(f"ERROR `add_user_ratings`: {e}")
+    return [None] * len(changes)
 
-        # # Update Database 
-        if (user_id in users['user_id'].to_list()) and (username in users['username'].to_list()):
-            # Already updated
-            logger.info(f"{user_id} found in DB. Records: {len(users)}. No update.")
-            return 
-        
-        elif (user_id in users['user_id'].to_list()):
-            logger.info(f"ID: {user_id} found, update user name and full name")
-            users.loc[users['user_id'] == user_id, ['username', 'first_name', 'last_name']] = [username, first_name, last_name]
-            logger.info(f"Database updated by ID. Records: {len(users)} /{user_id}: @{username}, {first_name} {last_name}/")
-            if rating:
-                users.loc[users['user_id'] == user_id, 'rating'] = rating
-
-        elif (username in users['username'].to_list()) and (username is not None):
-            logger.info(f"USERNAME: {username} found, update user name and full name")
-            users.loc[users['username'] == username, ['user_id', 'first_name', 'last_name']] = [user_id, first_name, last_name]
-            logger.info(f"Database updated by USERNAME. Records: {len(users)} /{user_id}: @{username}, {first_name} {last_name}/")
-            if rating:
-                users.loc[users['username'] == username, 'rating'] = rating
 
-        else:
-            # Create a new row in the database (new user)
-            logger.info(f"[New user in DB] id:{user_id} username:{username} | {first_name} {last_name} | rating {rating}.")
-            users.loc[len(users), :] = [len(users)+1, user_id, username, first_name, last_name, 1]
-            users['index'] = users['index'].fillna(0).astype(int)
+def export_users(path):
+    """ Stream the user table to `path` (the format follows the extension); returns the number of rows """
+    return write_rows(USERS.iter_rows(CHUNK_ROWS), path)
+
+
+def import_users(path):
+    """ Bulk load an export into the user table, chunk by chunk. The imported ratings become
+        a new ledger snapshot (otherwise the ledger would "restore" the old ones at start).
+        Returns (added, updated)
+    """
+    added = updated = 0
+    for rows in read_rows(path, CHUNK_ROWS):
+        chunk_added, chunk_updated = USERS.import_rows(rows)
+        LEDGER.set_ratings((user_id, rating) for _, user_id, _, _, _, rating in rows)
+        added += chunk_added
+        updated += chunk_updated
+    LEDGER.snapshot()
+    return added, updated
+
+
+def prune_exports():
+    """ Keep the newest EXPORT_KEEP export files """
+    exports = sorted(name for name in os.listdir(EXPORT_DIR) if name.startswith("users-"))
+    for name in exports[:-EXPORT_KEEP]:
+        os.remove(os.path.join(EXPORT_DIR, name))
 
-        users.to_pickle(USER_PANDAS_DATABASE, compression="gzip")
-        logger.info(f"Database updated. Records: {len(users)} /{user_id}: @{username}, {first_name} {last_name}/")
+
+def update_user_db(user_id=None, username=None, first_name=None, last_name=None, rating=None):
+    try:
+        USERS.upsert_user(user_id=user_id, username=username, first_name=first_name, last_name=last_name, rating=rating)
     except Exception as e:
         logger.error(f"ERROR update user database: {e}")
     return
 
 
+class RatingCandidates(filters.MessageFilter):
+    """ Messages that may change a rating: text starting with + / - or a rating emoji """
+
+    def filter(self, message):
+        return IS_RATING_CANDIDATE(message.text)
+
+
+def shard_key(update):
+    """ Rating changes are ordered per target user (id of the replied user or the tagged @name),
+        everything else per chat
+    """
+    message = getattr(update, 'message', None)
+    text = getattr(message, 'text', None)
+    if IS_RATING_CANDIDATE(text):
+        reply = getattr(message.reply_to_message, 'from_user', None)
+        if reply is not None:
+            return ('user', reply.id)
+        for entity in message.entities:
+            if entity.type == 'mention':
+                return ('user', message.parse_entity(entity).lstrip("@").lower())
+    return chat_key(update)
+
+
+# # Updates are sharded by chat (rating changes — by target user) onto ordered worker queues
+UPDATE_PROCESSOR = ShardedUpdateProcessor(UPDATE_WORKERS, queue_size=UPDATE_QUEUE_SIZE, key=shard_key)
+
+
+async def run_storage(func, *args, **kwargs):
+    """ Run a blocking storage call in the storage thread pool (timed in STORAGE_SECONDS) """
+    name = getattr(func, '__qualname__', 'call')
+
+    def timed_call():
+        with STORAGE_SECONDS.time(name):
+            return func(*args, **kwargs)
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(STORAGE_EXECUTOR, timed_call)
+
+
+def verbose(update=None):
+    """ Per-message details: logged at DEBUG level for every LOG_SAMPLE_EVERY-th update only """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return False
+    update_id = getattr(update, 'update_id', None)
+    return update_id is None or update_id % LOG_SAMPLE_EVERY == 0
+
+
+def timed_handler(callback):
+    """ Handler callback observed in HANDLER_SECONDS under its name """
+    name = callback.__name__
+
+    @functools.wraps(callback)
+    async def timed(update, context):
+        with HANDLER_SECONDS.time(name):
+            return await callback(update, context)
+    return timed
+
+
+async def record_rating_deltas(chat_id, changes):
+    """ Everything that follows +/- in a chat: leaderboards, window stats and one ledger write.
+        `changes` — [(user_id, username, [(from_user_id, delta)], rating after them)]
+    """
+    ts = time.time()
+    for user_id, username, deltas, rating in changes:
+        LEADERBOARDS.update(user_id, username, rating)
+        ANALYTICS.add(member_key(user_id, username), sum(delta for _, delta in deltas), ts, chat_id=chat_id)
+    # # users known only by @username are not in the ledger
+    known = [(user_id, deltas, int(rating)) for user_id, _, deltas, rating in changes if user_id is not None]
+    if not known:
+        return
+    try:
+        await run_storage(LEDGER.record_deltas, known, chat_id=chat_id)
+    except Exception as e:
+        logger.error(f"ERROR ledger record: {e}")
+
+
+async def record_rating_set(user_id, username, rating, from_user_id=None):
+    """ Everything that follows an admin override of the global rating: leaderboards and the ledger """
+    LEADERBOARDS.update(user_id, username, rating)
+    if user_id is None:
+        return
+    try:
+        await run_storage(LEDGER.record, user_id, rating, int(rating), kind=SET, from_user_id=from_user_id)
+    except Exception as e:
+        logger.error(f"ERROR ledger record: {e}")
+
+
+def reply(update: Update, text, lane=NORMAL, **kwargs) -> None:
+    """ Queue a reply to the message: handlers do not wait for Telegram """
+    message = update.message
+    OUTBOX.submit(message.chat_id, functools.partial(message.reply_text, text, **kwargs), lane=lane)
+
+
 # Define a few command handlers. These usually take the two arguments update and
 # context.
-def start(update: Update, context: CallbackContext) -> None:
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
     user = update.effective_user
-    update.message.reply_markdown_v2(
-        fr'Hi {user.mention_markdown_v2()}\!', 
-        reply_markup=ForceReply(selective=True), 
-    )
+    OUTBOX.submit(update.message.chat_id, 
+                  functools.partial(update.message.reply_markdown_v2, 
+                                    fr'Hi {user.mention_markdown_v2()}\!', 
+                                    reply_markup=ForceReply(selective=True)))
 
 
-def help_command(update: Update, context: CallbackContext) -> None:
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /help is issued."""
-    update.message.reply_text('Help!')
+    reply(update, 'Help!')
 
 
-def about(update: Update, context: CallbackContext) -> None:
-    """Send a message when the command /help is issued."""
-    # joke = pyj.get_joke(language = 'en', category = 'all')
+async def about(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Ratings of tagged users: /about @user — in this chat, /about all @user — in all chats."""
     from_user = getattr(update.message, 'from_user', None)
     entities = getattr(update.message, 'entities', [])
     logger.info(f"/About called by {from_user}.")
@@ -282,22 +541,34 @@ def about(update: Update, context: CallbackContext) -> None:
             message_full = getattr(update.message, 'text', None)
             message_list = message_full.split(" ")
             logger.info(f"message_list: {message_list}")
-            rating = None
-            m_name = None
-            for text_part in message_list:
-                if text_part[0] == "@":
-                    m_name = text_part[1:]
-                    logger.info(f"==>> Tagged: {m_name}")
-                    rating = get_user_rating(username=m_name)
-            if rating:
-                update.message.reply_text(f'User @{m_name} has rating {rating:0,.0f}')        
-                return
-            elif m_name:
-                update.message.reply_text(f'Who is @{m_name}, eh?')
+            # # all tagged users in one lookup
+            tagged = [text_part[1:] for text_part in message_list if text_part.startswith("@") and len(text_part) > 1]
+            if tagged:
+                logger.info(f"==>> Tagged: {tagged}")
+                users = await run_storage(get_users, usernames=tagged)
+                chat = update.effective_chat
+                # # the rating of this chat in groups (as /top), of all chats in private or with "all"
+                in_chat = RATING_SCOPE == "chat" and chat.type != 'private' and 'all' not in message_list[1:]
+                if in_chat:
+                    standings = await run_storage(CHAT_RATINGS.standings, chat.id, 
+                                                  [member_key(user[0], user[1]) for user in users.values()])
+                lines = []
+                for m_name in tagged:
+                    user = users.get(m_name.lower())
+                    if user is None:
+                        lines.append(f'Who is @{m_name}, eh?')
+                        continue
+                    member = member_key(user[0], user[1])
+                    if in_chat:
+                        rating, place = standings[member]
+                    else:
+                        rating, place = user[4], LEADERBOARDS.all.place(member)
+                    lines.append(f'User @{m_name} has rating {rating:0,.0f}' + (f' (#{place})' if place else ''))
+                reply(update, "\n".join(lines))
                 return
                                     
     if username == 'banknote2000':
-        users = read_user_database(USER_PANDAS_DATABASE)
+        users = await run_storage(read_user_database, USER_PANDAS_DATABASE)
         # joke = HTML_with_style(users, '<style>table {{{}}}</style>'.format(my_style))
         # split dataframe on parts by 30 records
         for part in range(1, (len(users) // 30) + 2):
@@ -306,16 +577,137 @@ def about(update: Update, context: CallbackContext) -> None:
             logger.info(f"==== PART {part} ====")
             logger.info(f"lines from {from_line} to {to_line}")
             users_part = users.iloc[from_line:to_line, :].to_string(header=True, index=False)
-            update.message.reply_text(f"==== PART {part} ====\nfrom {from_line} to {to_line}\n{users_part}")
+            reply(update, f"==== PART {part} ====\nfrom {from_line} to {to_line}\n{users_part}", lane=BULK)
         return
     else:
-        joke = "No joke. It is not funny."
-        update.message.reply_text(f'I like jokes.\n{joke}')
+        joke = JOKES.get('all')
+        reply(update, f'I like jokes.\n{joke}')
         return
 
 
-def change(update: Update, context: CallbackContext) -> None:
-    """Send a message when the command /help is issued."""
+async def board_lines(rows, signed=False):
+    """ "place. name — rating" lines of leaderboard rows, users fetched in one batch """
+    members = [member for _, member, _ in rows]
+    users = await run_storage(get_users, 
+                              user_ids=[member for member in members if not isinstance(member, str)], 
+                              usernames=[member[1:] for member in members if isinstance(member, str)])
+    number = "{:+,.0f}" if signed else "{:0,.0f}"
+    lines = []
+    for place, member, rating in rows:
+        user = users.get(member[1:] if isinstance(member, str) else member)
+        lines.append(f"{place}. {user_display_name(user, member)} — {number.format(rating)}")
+    return lines
+
+
+async def top(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Leaderboard: /top [page] — of this chat, /top all [page] — of all chats."""
+    args = context.args or []
+    chat = update.effective_chat
+    all_chats = chat.type == 'private' or 'all' in args
+    page = max(1, next((int(arg) for arg in args if arg.isdigit()), 1))
+    from_user = update.effective_user
+    me = member_key(from_user.id, from_user.username) if from_user else None
+    offset = (page - 1) * TOP_PAGE_SIZE
+    if all_chats or RATING_SCOPE == "global":
+        # # global ratings: of everyone, or of the members rated in this chat
+        board = LEADERBOARDS.all if all_chats else LEADERBOARDS.ranked(await run_storage(CHAT_RATINGS.members, chat.id))
+        rows, size, my_place = board.top(TOP_PAGE_SIZE, offset=offset), len(board), board.place(me)
+    else:
+        rows, size, my_place = await run_storage(CHAT_RATINGS.top, chat.id, TOP_PAGE_SIZE, offset=offset, member=me)
+    pages = max(1, -(-size // TOP_PAGE_SIZE))
+    if not rows:
+        reply(update, "Nobody has social credit here yet." if page == 1 else f"There are only {pages} pages.")
+        return
+
+    title = "all chats" if all_chats else (chat.title or "this chat")
+    lines = [f"Top of {title} (page {page}/{pages}):"]
+    lines.extend(await board_lines(rows))
+    if my_place:
+        lines.append(f"\nYour place: {my_place} of {size}")
+    reply(update, "\n".join(lines))
+
+
+async def window_top(update: Update, context: ContextTypes.DEFAULT_TYPE, window, period) -> None:
+    """ Who gained the most social credit in a rolling window: of this chat, or of all chats with "all" """
+    args = context.args or []
+    chat = update.effective_chat
+    all_chats = chat.type == 'private' or 'all' in args
+    counter = ANALYTICS.counter(window, chat_id=None if all_chats else chat.id, ts=time.time())
+    rows = counter.top(TOP_PAGE_SIZE)
+    if not rows:
+        reply(update, f"Nobody got social credit {period}.")
+        return
+
+    title = "all chats" if all_chats else (chat.title or "this chat")
+    lines = [f"Top of {title} {period}:"]
+    lines.extend(await board_lines(rows, signed=True))
+    from_user = update.effective_user
+    my_place = counter.place(member_key(from_user.id, from_user.username)) if from_user else None
+    if my_place:
+        lines.append(f"\nYour place: {my_place} of {len(counter)}")
+    reply(update, "\n".join(lines))
+
+
+async def week(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Social credit gained in the last 7 days: /week [all]."""
+    await window_top(update, context, "week", "this week")
+
+
+async def month(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Social credit gained in the last 30 days: /month [all]."""
+    await window_top(update, context, "month", "this month")
+
+
+async def trending(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Social credit gained in the last 24 hours: /trending [all]."""
+    await window_top(update, context, "trending", "in the last 24 hours")
+
+
+def _ms(seconds):
+    if seconds is None:
+        return "-"
+    return ">10 s" if seconds == float("inf") else f"{seconds * 1000:,.1f} ms"
+
+
+def stats_text():
+    """ Summary of the metrics for /stats """
+    uptime = int(time.time() - METRICS.started_at)
+    processor = UPDATE_PROCESSOR.stats()
+    lines = [f"Uptime: {uptime // 3600}h {uptime % 3600 // 60}m", 
+             f"Updates: {processor['processed']:,} processed, {processor['queued']} queued, "
+             f"wait avg {_ms(processor['wait_avg'])}, max {_ms(processor['wait_max'])}", 
+             "", "Handlers (count, p50 ≤, p99 ≤):"]
+    for labels in sorted(HANDLER_SECONDS.values):
+        lines.append(f"  {labels[0]}: {HANDLER_SECONDS.count(*labels):,}, "
+                     f"{_ms(HANDLER_SECONDS.quantile(0.5, *labels))}, {_ms(HANDLER_SECONDS.quantile(0.99, *labels))}")
+    lines.append("Storage (count, mean):")
+    for labels in sorted(STORAGE_SECONDS.values):
+        lines.append(f"  {labels[0]}: {STORAGE_SECONDS.count(*labels):,}, {_ms(STORAGE_SECONDS.mean(*labels))}")
+    lines.append("Bot API (count, mean, p99 ≤):")
+    for labels in sorted(API_SECONDS.values):
+        lines.append(f"  {labels[0]} [{labels[1]}]: {API_SECONDS.count(*labels):,}, "
+                     f"{_ms(API_SECONDS.mean(*labels))}, {_ms(API_SECONDS.quantile(0.99, *labels))}")
+    ratings = ", ".join(f"{labels[0]}: {count:,}" for labels, count in sorted(RATINGS_CHANGED.values.items()))
+    limited = ", ".join(f"{labels[0]}: {count:,}" for labels, count in sorted(RATE_LIMITED.values.items()))
+    written = METRICS.metrics["plus_bot_bytes_written_total"].func()
+    lines += ["", f"Ratings: {ratings or 0}", 
+              f"Rate limited: {limited or 0}", 
+              "Written: " + ", ".join(f"{store} {size / 1024:,.0f} KiB" for store, size in written.items()), 
+              f"Message log dropped: {MESSAGE_LOG.dropped:,}"]
+    return "\n".join(lines)
+
+
+async def stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Metrics summary for the admin: /stats."""
+    from_user = getattr(update.message, 'from_user', None)
+    if getattr(from_user, 'username', None) != 'banknote2000':
+        reply(update, "It is a secret.")
+        return
+    reply(update, stats_text(), lane=BULK)
+
+
+async def change(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Set a rating (admin only): in this chat in groups, in all chats in private or with "all"."""
     # joke = pyj.get_joke(language = 'en', category = 'all')
     try:
         reply_list = getattr(update.message, 'from_user', None)
@@ -348,148 +740,245 @@ def change(update: Update, context: CallbackContext) -> None:
                                 m_name = None
                                 new_rating = int(message_list[2])
                                 break
-                    if new_rating:
-                        update.message.reply_text(f'Change rating of m_name:{m_name} to {new_rating}.\n')
-                        update_user_rating(user_id=user_id, username=m_name, rating=new_rating)
+                    chat = update.effective_chat
+                    # # the rating users see: of this chat in groups (as /about and /top), else the global one
+                    in_chat = RATING_SCOPE == "chat" and chat.type != 'private' and 'all' not in message_list[1:]
+                    if new_rating and in_chat:
+                        users = await run_storage(get_users, user_ids=[user_id] if user_id else [], usernames=[m_name] if m_name else [])
+                        user = next(iter(users.values()), None)
+                        if user is None:
+                            reply(update, f'Who is {m_name or user_id}, eh?')
+                            return
+                        await run_storage(CHAT_RATINGS.set, chat.id, new_rating, user_id=user[0], username=user[1])
+                        reply(update, f'Change rating of m_name:{m_name or user[1]} in this chat to {new_rating}.\n')
+                    elif new_rating:
+                        if await run_storage(update_user_rating, user_id=user_id, username=m_name, rating=new_rating):
+                            reply(update, f'Change rating of m_name:{m_name} to {new_rating}.\n')
+                            users = await run_storage(get_users, user_ids=[user_id] if user_id else [], usernames=[m_name] if m_name else [])
+                            for user in users.values():
+                                await record_rating_set(user[0], user[1], new_rating, from_user_id=getattr(reply_list, 'id', None))
+                        else:
+                            reply(update, f'Who is {m_name or user_id}, eh?')
                     else:
-                        update.message.reply_text("Use: /Change @user <rating> | /Change_id <id> <rating>")
+                        reply(update, "Use: /Change [all] @user <rating> | /Change_id <id> <rating> [all]")
                 return
         else:
             joke = "It will not change."
-        update.message.reply_text(f'I like jokes.\n{joke}')
+        reply(update, f'I like jokes.\n{joke}')
     except Exception as e:
         logger.error(f"Rating /change function error: {e}")
     return 
 
 
-def echo_new(update: Update, context: CallbackContext) -> None:
+async def export(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send the user table as one file: /export [parquet | arrow | csv] (admin only)."""
+    username = getattr(update.message.from_user, 'username', None)
+    if username != 'banknote2000':
+        reply(update, "It is a secret.")
+        return
+    suffix = SUFFIXES.get(context.args[0].lower()) if context.args else DEFAULT_SUFFIX
+    if suffix is None:
+        reply(update, f"Unknown format, use one of: {', '.join(SUFFIXES)}.")
+        return
+    path = os.path.join(EXPORT_DIR, f"users-{time.strftime('%Y%m%d-%H%M%S')}{suffix}")
+    try:
+        rows = await run_storage(export_users, path)
+        await run_storage(prune_exports)
+    except Exception as e:
+        logger.error(f"ERROR export {path}: {e}")
+        reply(update, f"Export failed: {e}")
+        return
+    logger.info(f"Exported {rows} users to {path}")
+    if os.path.getsize(path) > EXPORT_MAX_UPLOAD_BYTES:
+        reply(update, f"{rows} users exported to {path}, too big to send here.", lane=BULK)
+        return
+    message = update.message
+
+    async def send_document():
+        # # opened on every attempt: the outbox may retry
+        with open(path, "rb") as f:
+            await message.reply_document(f, filename=os.path.basename(path), caption=f"{rows} users")
+
+    OUTBOX.submit(message.chat_id, send_document, lane=BULK)
+
+
+async def echo_new(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Echo the user message."""
-    update.message.reply_text(f"NEW: {update.message.text}")
+    reply(update, f"NEW: {update.message.text}")
     return
 
 
-def get_gif_data():
-    files = []
-    for file in os.listdir(GIFS_DIR):
-        if file.endswith(".gif"):
-            files.append(file)
-    new_gif = files[randrange(len(files))] 
-    logger.info(f"-== Used gif file: {new_gif}")
-    logger.info(f"PATH: {GIFS_DIR + new_gif}")
-    animation = open(GIFS_DIR + new_gif, 'rb').read()    
-    return animation
+def send_gif(bot, chat_id, caption, lane=BULK):
+    """ Queue a random GIF with a caption """
+    OUTBOX.submit(chat_id, functools.partial(deliver_gif, bot, chat_id, caption), lane=lane)
 
 
-def echo_gif(update: Update, context: CallbackContext) -> None:
+async def deliver_gif(bot, chat_id, caption):
+    """ Random GIF with a caption. A GIF is uploaded once, then its Telegram file_id is reused """
+    name = GIFS.pick()
+    if name is None:
+        logger.warning(f"No gifs in {GIFS_DIR}")
+        return await bot.send_message(chat_id=chat_id, text=caption)
+    logger.info(f"-== Used gif file: {name}")
+    animation = await run_storage(GIFS.animation, name)
+    try:
+        message = await bot.send_animation(chat_id=chat_id, animation=animation, caption=caption)
+    except BadRequest as e:
+        if not isinstance(animation, str):
+            raise
+        # # remembered file_id is not valid anymore — upload the file again
+        logger.warning(f"file_id of {name} rejected: {e}")
+        await run_storage(GIFS.forget, name)
+        animation = await run_storage(GIFS.animation, name)
+        message = await bot.send_animation(chat_id=chat_id, animation=animation, caption=caption)
+    if not isinstance(animation, str):
+        uploaded = message.animation or message.document
+        if uploaded is not None:
+            await run_storage(GIFS.remember, name, uploaded.file_id)
+    return message
+
+
+async def echo_gif(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Echo the user message."""
 
-    context.bot.sendAnimation(chat_id=update.message.chat_id, 
-                              animation=get_gif_data(), 
-                              caption='That is your gif!', 
-                              #    parse_mode=ParseMode.MARKDOWN
-                              )
+    send_gif(context.bot, chat_id=update.message.chat_id, caption='That is your gif!')
     print("GIF!")
     return    
 
 
-def update_rating_routine(update, context, first_char, from_user_id, reply_to_id=None, username=None, first_name=None, last_name=None):
-    current_rating = 0
-    commands = COMMANDS
-    try:
-        if reply_to_id is None:
-            # current_rating = get_user_rating(user_id=None, username=username, first_name=None)
-            try:
-                logger.info(f"update.effective_user.username: {update.effective_user.username}")
-            except Exception as e:
-                logger.warning(f"cannot process update.effective_user.username: {e}")
-            reply_to_id = get_user_id(username=username)
-            logger.info(f"reply_to_id detected: {reply_to_id}")
-            first_name, last_name = get_user_full_name(reply_to_id)        
-
-        if reply_to_id == 1968168927:
-            # +/- to bot
-            update.message.reply_text(f"Thank you! I am not *that* type...\nBut I like jokes.\n{pyj.get_joke()}")
-            return
-        if reply_to_id == from_user_id:
-            # Self "plus"-ing
-            joke = pyj.get_joke(language='en', category='chuck')
-            update.message.reply_text(f"I like you too...Are you Chuck?\n{joke}")    
-            return
-        
-        # Read database
-        try:
-            with open("user_data_base.json", "r") as f:
-                database = json.load(f)
-        except Exception as e:
-            logger.error(f"{e}")
-            database = {1968168927: 0}
-        # print(database.items())
-        
-        # # Update rating
-        # current_rating = database.get(str(reply_to_id), 0)            
-        if reply_to_id is None:
-            logger.warning("No ID found! Looking by username")
-            current_rating = get_user_rating(user_id=None, username=username, first_name=first_name)
-        else:
-            current_rating = get_user_rating(user_id=reply_to_id, username=None, first_name=first_name)
-        logger.info(f"Current rating readed: {current_rating} ")
-        # last_update = int(database.get(f"{reply_to_id}_update", 0))
-        logger.info(f"Read: {reply_to_id}, previous rating: {current_rating}")
-        current_rating = eval(f"{current_rating}{first_char}1")
-        
-        # # —— Make a delay 
-        current_time = int(dt.datetime.utcnow().strftime('%s'))  # Time Now
-        try:
-            with open("recent_appreciations.json", "r+") as f:
-                recents = json.load(f)
-        except Exception as e:
-            logger.error(f"{e}")
-            recents = {}
-        # # filter out old appreciations (>60 sec)
-        new_recents = {k: v for k, v in recents.items() if (current_time-int(k)) <= 15}
-        
-        # Search for a users pair in recent appreiations
-        for k, v in new_recents.items():
-            if (str(from_user_id) in v.keys()) and (reply_to_id == v.get(str(from_user_id), None)):
-                update.message.reply_text("Wait a little!")
-                logger.info(f"Not updated: {from_user_id}->{reply_to_id} => Pause difference: {current_time-int(k)}")
-                return
+# # One +/- waiting in the coalescer
+PendingRating = namedtuple("PendingRating", "update from_user_id first_char delta reply_to_id username first_name last_name")
+
 
-        # # add a new appreciation to stack
-        if current_time not in new_recents.keys():
-            new_recents[current_time] = {}
-        new_recents[current_time][from_user_id] = reply_to_id
-        with open("recent_appreciations.json", "w") as f: 
-            recents = json.dump(new_recents, f)
-        # # ——
+async def apply_ratings(batches):
+    """ Write batches of +/- (PendingRating) in one chat, a batch per rated user, at once and answer them:
+        one storage call, one ledger write and one reply for a burst to one user or a "+ @a @b"
+    """
+    chat_id = batches[0][0][0]
+    targets = [pending[-1] for _, _, pending in batches]
+    try:
+        ratings = await run_storage(add_user_ratings, 
+                                    [(delta, last.reply_to_id, last.username, last.first_name, last.last_name) 
+                                     for (_, delta, _), last in zip(batches, targets)])
+        ratings = [int(rating or 0) for rating in ratings]
+        if verbose(targets[-1].update):
+            logger.debug(f"Read: {[last.reply_to_id for last in targets]}, new ratings: {ratings}")
+        for _, _, pending in batches:
+            for item in pending:
+                RATINGS_CHANGED.inc(f"{item.delta:+d}")
+        await record_rating_deltas(chat_id, [(last.reply_to_id, last.username, 
+                                              [(item.from_user_id, item.delta) for item in pending], rating) 
+                                             for (_, _, pending), last, rating in zip(batches, targets, ratings)])
+        # # the ratings of this chat: shown under the "chat" scope (the global ones above are the rollup);
+        # # under "global" they tell who is on the chat's board
+        chat_ratings = await run_storage(CHAT_RATINGS.add, chat_id, 
+                                         [(delta, last.reply_to_id, last.username) for (_, delta, _), last in zip(batches, targets)])
+        if RATING_SCOPE == "chat":
+            ratings = [int(rating or 0) for rating in chat_ratings]
+
+        replies = []
+        for (_, delta, pending), last, current_rating in zip(batches, targets, ratings):
+            first_name, username = last.first_name, last.username
+            # # rating after each +/- of the batch: a GIF when one of them is a multiple of 25
+            passed = list(itertools.accumulate((item.delta for item in pending), initial=current_rating - delta))[1:]
+            if len(pending) == 1 or not RATING_SUMMARY:
+                replies.extend((item, f"{COMMANDS[item.first_char]} one social credit to {first_name}. (@{username}) Total rating: {rating}", 
+                                [rating]) for item, rating in zip(pending, passed))
+            else:
+                replies.append((last, f"{delta:+d} social credit to {first_name}. (@{username}) in {len(pending)} ratings. "
+                                      f"Total rating: {current_rating}", passed))
+        if len(batches) > 1:
+            # # users rated by one message: one reply
+            replies = [(replies[0][0], "\n".join(text for _, text, _ in replies), 
+                        [rating for _, _, passed in replies for rating in passed])]
+        for item, reply_text, passed in replies:
+            if any(rating % 25 == 0 for rating in passed):
+                # Show with gif
+                send_gif(item.update.get_bot(), chat_id=chat_id, caption=reply_text, lane=RATING)
+            else: 
+                # # Routine as usual
+                reply(item.update, reply_text, lane=RATING, quote=False)
+    except Exception as e:
+        logger.error(f"Rating batch error: {e}")
+
+
+# # batches are keyed by (chat, member) but applied one after another per member: the global
+# # rating, the ledger and the leaderboards see a user's changes in order, whatever the chat
+RATING_COALESCER = RatingCoalescer(apply_ratings, window=RATING_COALESCE_WINDOW, order=lambda key: key[1])
+
+
+def rating_allowed(update, from_user_id, reply_to_id):
+    """ Answer +/- to the bot, to oneself and over the rate limits; True if the rating goes on """
+    if reply_to_id == 1968168927:
+        # +/- to bot
+        reply(update, f"Thank you! I am not *that* type...\nBut I like jokes.\n{JOKES.get('neutral')}")
+        return False
+    if reply_to_id == from_user_id:
+        # Self "plus"-ing
+        joke = JOKES.get('chuck')
+        reply(update, f"I like you too...Are you Chuck?\n{joke}")    
+        return False
+    
+    # # —— Make a delay 
+    limited_by = RATE_LIMITER.check(update.message.chat_id, from_user_id, reply_to_id)
+    if limited_by:
+        RATE_LIMITED.inc(limited_by)
+        if RATE_LIMITER.notice(limited_by, update.message.chat_id, from_user_id):
+            reply(update, "Wait a little!")
+        if verbose(update):
+            retry_in = RATE_LIMITER.retry_in(limited_by, update.message.chat_id, from_user_id, reply_to_id)
+            logger.debug(f"Not updated: {from_user_id}->{reply_to_id} => '{limited_by}' limit, retry in {retry_in:.0f}s")
+        return False
+    # # ——
+    return True
+
+
+async def update_rating_routine(update, context, first_char, from_user_id, targets):
+    """ +/- of a message to its targets ([Mention]: the replied user, or every tagged one) """
+    try:
+        # # a mentioned user is resolved by the caller (username cache); user_id None — not known yet
+        delta = RATING_DELTAS[first_char]
+        entries = []
+        for target in targets:
+            if not rating_allowed(update, from_user_id, target.user_id):
+                continue
+            if verbose(update):
+                logger.debug(f"Trying update user rating of id: {target.user_id} with {delta:+d}...")
+            pending = PendingRating(update, from_user_id, first_char, delta, target.user_id, target.username, 
+                                    target.first_name, target.last_name)
+            entries.append(((update.message.chat_id, member_key(target.user_id, target.username)), delta, pending))
         
-        # # Write database if everything is okay!
-        database[str(reply_to_id)] = current_rating  # # update new rating
-        logger.info(f"Trying update user rating of id: {reply_to_id} with {current_rating}...")
-        if reply_to_id is None:
-            update_user_rating(user_id=None, username=username, rating=current_rating)
-        else:
-            update_user_rating(user_id=reply_to_id, username=None, rating=current_rating)
-        with open("user_data_base.json", "w") as f:
-            json.dump(database, f)
-        current_rating = int(current_rating)
-        reply_text = f"{commands[first_char]} one social credit to {first_name}. (@{username}) Total rating: {current_rating}"
-        first_name, last_name = get_user_full_name(user_id=reply_to_id)
-        update_user_db(user_id=reply_to_id, username=username, first_name=first_name, last_name=last_name)
-        if current_rating % 25 == 0:
-            # Show with gif
-            context.bot.sendAnimation(chat_id=update.message.chat_id, 
-                                      animation=get_gif_data(), 
-                                      caption=reply_text, )
-        else: 
-            # # Routine as usual
-            update.message.reply_text(reply_text, quote=False)
+        # # Write database if everything is okay: via the coalescer, a burst of +/- to one user
+        # # in one chat becomes one write and one reply; users tagged together are written and
+        # # answered together (see apply_ratings)
+        if len(entries) == 1:
+            await RATING_COALESCER.add(*entries[0])
+        elif entries:
+            await RATING_COALESCER.add_many(entries)
     except Exception as e:
         logger.error(f"Rating update routine error: {e}")
     return 
 
 
-def echo(update: Update, context: CallbackContext) -> None:
+async def log_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Put every text message on the message log (no other work)."""
+    message = update.message
+    if message is None:
+        return
+    author = message.from_user
+    if author is not None:
+        USERNAMES.learn(author.id, author.username, author.first_name, author.last_name)
+    MESSAGE_LOG.write({
+        "ts": message.date.timestamp(), 
+        "chat_id": message.chat_id, 
+        "chat": message.chat.title, 
+        "user_id": getattr(message.from_user, 'id', None), 
+        "username": getattr(message.from_user, 'username', None), 
+        "text": message.text, 
+    })
+
+
+async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Echo the user message."""
     commands = COMMANDS
     try:
@@ -498,100 +987,287 @@ def echo(update: Update, context: CallbackContext) -> None:
         if not getattr(update, 'message', None):
             logger.warning("Empty message")
             return
-        reply = getattr(update.message.reply_to_message, 'from_user', None)
-        with open("telgram_messages.txt", "a") as f:
-            f.write(f"From_user:{from_user} from_user_id:{from_user_id} | Chat: '{update.message.chat['title']}' TEXT:'{update.message.text}'\n")
+        replied_to = getattr(update.message.reply_to_message, 'from_user', None)
         # logger.info(f"echo, from_user:{from_user} from_user_id:{from_user_id} TEXT:{update.message.text}")
-        if len(update.message.entities) > 0:
-            # # INFO: https://core.telegram.org/bots/api#messageentity
-            logger.info(update.message.entities[0])
-            if update.message.entities[0]['type'] == 'mention':
-                x, y = update.message.entities[0]['offset'], update.message.entities[0]['length']
-                m_name = update.message.text[x:x+y]
-                logger.info(f" Tagged: {m_name}")
-                message_text = getattr(update.message, 'text', None)
-                first_char = message_text[0]
-                if first_char in RATING_COMMANDS.keys():
-                    first_char = RATING_COMMANDS[first_char]
-                if m_name[0] == "@":
-                    m_name = m_name[1:]
-                if (message_text) and (first_char in commands.keys()):
-                    logger.info(f"+ username:{m_name} appreciation detected...")
-                    update_rating_routine(update, 
-                                          context, 
-                                          first_char=first_char, 
-                                          from_user_id=from_user_id, 
-                                          reply_to_id=None, 
-                                          username=m_name)
-                    # # + @user way of appreciataion
+        # # INFO: https://core.telegram.org/bots/api#messageentity
+        mentions = parse_mentions(update.message)
+        if mentions:
+            # # "+ @user" / "+ @a @b" way of appreciation: every tagged user, unknown names looked up at once
+            first_char = IS_RATING_CANDIDATE.sign(update.message.text)
+            if first_char in commands.keys():
+                missing = USERNAMES.missing(mentions)
+                found = await run_storage(get_users, usernames=missing) if missing else None
+                resolved = USERNAMES.resolve(mentions, found)
+                if verbose(update):
+                    logger.debug(f"+ {[(mention.username, mention.user_id) for mention in resolved]} appreciation detected...")
+                await update_rating_routine(update, 
+                                            context, 
+                                            first_char=first_char, 
+                                            from_user_id=from_user_id, 
+                                            targets=resolved)
             return
 
-            # for k in dir(update.message.entities[0]):
-            #     if k[0] != "_":
-            #         logger.info(f'{k}:{getattr(update.message.entities, k, "<▒▒▒▒▒▒▒▒▒>")}')
-        if reply:
+        if replied_to:
             # # React only to replies...
             reply_to_id = getattr(update.message.reply_to_message.from_user, 'id', None)
             username = getattr(update.message.reply_to_message.from_user, 'username', None)
             first_name = getattr(update.message.reply_to_message.from_user, 'first_name', None)
             last_name = getattr(update.message.reply_to_message.from_user, 'last_name', None)
-            update_user_db(user_id=reply_to_id, username=username, first_name=first_name, last_name=last_name)
-            logger.info(f"Reply to ID:{reply_to_id}, @{username} Name: {first_name} {last_name}")
-            first_char = update.message.text[0]
-            if first_char in RATING_COMMANDS.keys():
-                first_char = RATING_COMMANDS[first_char]            
+            await run_storage(update_user_db, user_id=reply_to_id, username=username, first_name=first_name, last_name=last_name)
+            USERNAMES.learn(reply_to_id, username, first_name, last_name)
+            if verbose(update):
+                logger.debug(f"Reply to ID:{reply_to_id}, @{username} Name: {first_name} {last_name}")
+            first_char = IS_RATING_CANDIDATE.sign(update.message.text)
             if first_char in commands.keys():
-                update_rating_routine(update, 
-                                      context, 
-                                      first_char=first_char, 
-                                      from_user_id=from_user_id, 
-                                      reply_to_id=reply_to_id, 
-                                      username=username, 
-                                      first_name=first_name, 
-                                      last_name=last_name)
+                await update_rating_routine(update, 
+                                            context, 
+                                            first_char=first_char, 
+                                            from_user_id=from_user_id, 
+                                            targets=[Mention(reply_to_id, username, first_name, last_name)])
                 # update_rating_routine(update, first_char, from_user_id, reply_to_id)
                 return
-        else:
-            logger.info("Note a reply.")
+        elif verbose(update):
+            logger.debug("Not a reply.")
 
     except Exception as e:
-        update.message.reply_text("I am feeling a bit unwell...\n")
+        reply(update, "I am feeling a bit unwell...\n")
         logger.error(f"{e}")
     return
 
 
-def main() -> None:
-    """Start the bot."""
-    # Create the Updater and pass it your bot's token.
-    updater = Updater(TOKEN)
-
-    # Get the dispatcher to register handlers
-    dispatcher = updater.dispatcher
-
-    # on different commands - answer in Telegram
-    dispatcher.add_handler(CommandHandler("start", start))
-    dispatcher.add_handler(CommandHandler("about", about))
-    dispatcher.add_handler(CommandHandler("change", change))
-    dispatcher.add_handler(CommandHandler("change_id", change))
-    dispatcher.add_handler(CommandHandler("help", help_command))
-    dispatcher.add_handler(CommandHandler("gif", echo_gif))
-
-    # on non command i.e message - echo the message on Telegram
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, echo))
-    # dispatcher.add_handler(
+def timed_phase(name, func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    STARTUP_PHASES[name] = time.perf_counter() - started
+    return result
+
+
+def restore_ratings_from_ledger():
+    """ The ledger gets every change at once, the pickle store — a few seconds later:
+        bring back ratings the store lost (e.g. in a crash)
+    """
+    stored = {int(user_id): rating for user_id, _, rating in USERS.ratings() if user_id is not None}
+    repaired = 0
+    for user_id, rating in LEDGER.ratings.items():
+        if user_id in stored and stored[user_id] != rating:
+            USERS.set_rating(rating, user_id=user_id)
+            repaired += 1
+    if repaired:
+        logger.warning(f"Ratings restored from the ledger: {repaired}")
+
+
+def warm_users():
+    # Load users once, write changes back in background
+    USERS.start()
+    LEDGER.start()
+    if LEDGER.is_empty:
+        LEDGER.seed((user_id, rating) for user_id, _, rating in USERS.ratings())
+    else:
+        restore_ratings_from_ledger()
+    LEADERBOARDS.load(USERS.ratings())
+
+
+def history_chunk(events, until):
+    """ Next ANALYTICS_CHUNK ledger events as ANALYTICS.load() input; None when none are left """
+    events = list(itertools.islice(events, ANALYTICS_CHUNK))
+    if not events:
+        return None
+    return [(event.to_user_id, event.value, event.ts, event.chat_id) 
+            for event in events if event.kind == DELTA and event.ts < until]
+
+
+async def load_history(until):
+    """Replay the ledger events of the longest window into ANALYTICS in background, a chunk per 
+    event-loop turn. Events after `until` are counted by the handlers themselves."""
+    started = time.perf_counter()
+    events = LEDGER.events(since=until - ANALYTICS.span)
+    loaded = 0
+    try:
+        while True:
+            chunk = await run_storage(history_chunk, events, until)
+            if chunk is None:
+                break
+            ANALYTICS.load(chunk)
+            loaded += len(chunk)
+    except Exception as e:
+        logger.error(f"ERROR load rating history: {e}")
+        return
+    logger.info(f"Rating history loaded: {loaded} events in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+
+def start_history_load() -> None:
+    """Start load_history() for the events before now; call before the first update is taken."""
+    task = asyncio.get_running_loop().create_task(load_history(time.time()))
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+
+
+async def on_startup(application: Application) -> None:
+    """Right before the first poll (or webhook): the rating history loads in background."""
+    start_history_load()
+    await report_startup(application)
+
+
+async def report_startup(application: Application) -> None:
+    """Log the startup breakdown right before the first poll (or webhook)."""
+    phases = ", ".join(f"{name} {seconds * 1000:.0f} ms" for name, seconds in list(STARTUP_PHASES.items()))
+    logger.info(f"Startup: {phases}. First poll after {(time.perf_counter() - STARTED_AT) * 1000:.0f} ms")
+
+
+async def stop_outbox(application: Application) -> None:
+    """Apply the ratings still in the coalescer, then send the queued replies, before the bot shuts down.
+    Flushes created while the application stops are not awaited by PTB: drained here.
+    Warm-ups still running in background are cancelled."""
+    await RATING_COALESCER.drain()
+    await OUTBOX.stop(timeout=OUTBOX_STOP_TIMEOUT)
+    for task in list(BACKGROUND_TASKS):
+        task.cancel()
+
+
+def build_application(token=None, request=None) -> Application:
+    # Create the Application and pass it your bot's token.
+    # Bot API calls are timed; `request` replaces the HTTP layer under the timing
+    # (benchmarks record the calls instead of sending them).
+    application = (
+        Application.builder()
+        .token(token or TOKEN)
+        .request(TimedRequest(API_SECONDS, inner=request))
+        .concurrent_updates(UPDATE_PROCESSOR)
+        .update_queue(InFlightQueue(UPDATE_MAX_IN_FLIGHT))
+        .post_init(on_startup)
+        .post_stop(stop_outbox)
+        .build()
+    )
+
+    # rating bursts are written by tasks of the application: awaited when it stops
+    RATING_COALESCER.create_task = application.create_task
+
+    # on different commands - answer in Telegram (every handler timed in HANDLER_SECONDS)
+    application.add_handler(CommandHandler("start", timed_handler(start)))
+    application.add_handler(CommandHandler("about", timed_handler(about)))
+    application.add_handler(CommandHandler("change", timed_handler(change)))
+    application.add_handler(CommandHandler("change_id", timed_handler(change)))
+    application.add_handler(CommandHandler("help", timed_handler(help_command)))
+    application.add_handler(CommandHandler("gif", timed_handler(echo_gif)))
+    application.add_handler(CommandHandler("top", timed_handler(top)))
+    application.add_handler(CommandHandler("week", timed_handler(week)))
+    application.add_handler(CommandHandler("month", timed_handler(month)))
+    application.add_handler(CommandHandler("trending", timed_handler(trending)))
+    application.add_handler(CommandHandler("stats", timed_handler(stats)))
+    application.add_handler(CommandHandler("export", timed_handler(export)))
+
+    # every text message goes to the message log first (separate group, nothing else is done there)
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(log_message)), group=-1)
+
+    # rating messages only: other chatter is dropped by a single first-character check
+    application.add_handler(MessageHandler(RatingCandidates(name="RatingCandidates"), timed_handler(echo)))
+    # application.add_handler(
     #     MessageHandler(            
-    #         Filters.all, echo_new
+    #         filters.ALL, echo_new
     #         )
     #     )
+    return application
+
+
+async def run_webhook(application: Application) -> None:
+    """Take updates from Telegram webhook POSTs until SIGINT/SIGTERM."""
+    bot = application.bot
+    secret_token = WEBHOOK_SECRET
+    if not secret_token:
+        # # never accept unauthenticated POSTs: updates carry the usernames admin commands trust
+        secret_token = secrets.token_urlsafe(32)
+        logger.warning("PLUS_BOT_WEBHOOK_SECRET is not set: a random secret is registered for this run "
+                       "(set one when several instances share the webhook)")
+    server = WebhookServer(application.update_queue.put, 
+                           decode=lambda body: Update.de_json(json.loads(body), bot), 
+                           listen=WEBHOOK_LISTEN, 
+                           port=WEBHOOK_PORT, 
+                           path=urlsplit(WEBHOOK_URL).path or "/", 
+                           secret_token=secret_token, 
+                           max_body_bytes=WEBHOOK_MAX_BODY_BYTES, 
+                           max_concurrency=WEBHOOK_MAX_CONCURRENCY, 
+                           decode_workers=WEBHOOK_DECODE_WORKERS)
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+
+    async with application:
+        await application.start()
+        start_history_load()
+        await server.start()
+        await bot.set_webhook(WEBHOOK_URL, 
+                              secret_token=secret_token, 
+                              allowed_updates=Update.ALL_TYPES, 
+                              max_connections=WEBHOOK_MAX_CONNECTIONS)
+        await report_startup(application)
+        await stopping.wait()
+        await server.stop()
+        await application.stop()
+        await stop_outbox(application)
 
-    # Start the Bot
-    updater.start_polling()
+
+def main() -> None:
+    """Start the bot."""
+    # # Jokes are not needed to start answering (NO_JOKE until loaded): they load in background, not waited for
+    threading.Thread(target=timed_phase, args=("jokes", JOKES.start), name="warmup-jokes", daemon=True).start()
+    # Warm up storage, rate limits and gifs concurrently, build the Application meanwhile
+    with ThreadPoolExecutor(max_workers=3, thread_name_prefix="warmup") as warmup:
+        warming = [
+            warmup.submit(timed_phase, "users", warm_users), 
+            warmup.submit(timed_phase, "rate limits", RATE_LIMITER.start), 
+            warmup.submit(timed_phase, "gifs", lambda: GIFS.load().scan()), 
+        ]
+        application = timed_phase("application", build_application)
+        for future in warming:
+            future.result()
+    MESSAGE_LOG.start()
+    CHAT_RATINGS.start()
+    if METRICS_PORT:
+        METRICS_SERVER.start()
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT, 
-    # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    updater.idle()
+    # SIGTERM or SIGABRT. run_polling() owns the asyncio event loop
+    # and stops the bot gracefully.
+    if WEBHOOK_URL:
+        # # Telegram pushes updates to the embedded server: no polling round trips
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+    # Write pending user database changes
+    STORAGE_EXECUTOR.shutdown(wait=True)
+    USERS.stop()
+    LEDGER.stop()
+    CHAT_RATINGS.stop()
+    RATE_LIMITER.stop()
+    MESSAGE_LOG.stop()
+    METRICS_SERVER.stop()
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Social credit (+/-) Telegram bot")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("migrate-sqlite", 
+                          help=f"one-shot copy of {USER_PANDAS_DATABASE} and {USER_JSON_DATABASE} into {USER_SQLITE_DATABASE}")
+    export_parser = subparsers.add_parser("export", help="stream the user table to a file (.parquet, .arrow, .csv, .csv.gz)")
+    export_parser.add_argument("path", nargs="?", default=f"users{DEFAULT_SUFFIX}")
+    import_parser = subparsers.add_parser("import", help="bulk load an export into the user table (bot stopped)")
+    import_parser.add_argument("path")
+    args = parser.parse_args()
+    if args.command == "migrate-sqlite":
+        migrated = migrate_to_sqlite(USER_PANDAS_DATABASE, USER_JSON_DATABASE, USER_SQLITE_DATABASE)
+        print(f"{migrated} users migrated. Run the bot with PLUS_BOT_STORAGE=sqlite")
+    elif args.command == "export":
+        USERS.start()
+        exported = export_users(args.path)
+        USERS.stop()
+        print(f"{exported} users exported to {args.path}")
+    elif args.command == "import":
+        warm_users()
+        added, updated = import_users(args.path)
+        USERS.stop()
+        LEDGER.stop()
+        print(f"{added} users added, {updated} updated from {args.path}")
+    else:
+        main()
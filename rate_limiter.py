@@ -0,0 +1,176 @@
+"""
+Sliding-window rate limiter for appreciations ("+"/"-" replies).
+
+Every scope (giver->receiver pair, giver in a chat, whole chat) has its own
+window: at most `limit` hits in the last `seconds`. Hits are kept in memory,
+one deque of timestamps per key, and a heap of expiry times drops old hits
+and idle keys, so a check costs O(1) amortized whatever the traffic.
+
+The state can be snapshotted to a JSON file in background, so limits survive
+restarts without touching the disk on every message.
+
+A giver rejected again and again is told so once per window (`notice()`),
+not on every rejected message.
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# # How a key is built for every supported scope
+SCOPES = {
+    "pair": lambda chat_id, giver, receiver: (giver, receiver),
+    "giver": lambda chat_id, giver, receiver: (chat_id, giver),
+    "chat": lambda chat_id, giver, receiver: (chat_id,),
+}
+
+
+class SlidingWindow:
+    """ At most `limit` hits per key in the last `seconds` """
+
+    def __init__(self, seconds, limit=1):
+        self.seconds = seconds
+        self.limit = limit
+        self.hits = {}  # key -> deque of hit times
+        self._expiry = []  # heap of (expiry time, seq, key), one entry per hit
+        self._seq = itertools.count()  # tie-breaker, keys may not be comparable
+
+    def _expire(self, now):
+        expiry = self._expiry
+        while expiry and expiry[0][0] <= now:
+            _, _, key = heapq.heappop(expiry)
+            hits = self.hits.get(key)
+            if hits is None:
+                continue
+            while hits and hits[0] + self.seconds <= now:
+                hits.popleft()
+            if not hits:
+                del self.hits[key]
+
+    def allows(self, key, now):
+        self._expire(now)
+        hits = self.hits.get(key)
+        return hits is None or len(hits) < self.limit
+
+    def add(self, key, now):
+        self.hits.setdefault(key, deque()).append(now)
+        heapq.heappush(self._expiry, (now + self.seconds, next(self._seq), key))
+
+    def retry_in(self, key, now):
+        """ Seconds until the key gets a free slot """
+        hits = self.hits.get(key)
+        if not hits or len(hits) < self.limit:
+            return 0
+        return max(0, hits[-self.limit] + self.seconds - now)
+
+    def __len__(self):
+        return len(self.hits)
+
+
+class RateLimiter:
+    """ Several sliding windows checked together: a hit counts only if every window allows it.
+        `windows` is {scope: (seconds, limit)} with scopes from SCOPES
+    """
+
+    def __init__(self, windows, snapshot_path=None, snapshot_interval=None):
+        unknown = set(windows) - set(SCOPES)
+        if unknown:
+            raise ValueError(f"Unknown rate limit scopes: {unknown}")
+        self.windows = {scope: SlidingWindow(seconds, limit) for scope, (seconds, limit) in windows.items()}
+        self.notices = {scope: SlidingWindow(seconds) for scope, (seconds, _) in windows.items()}
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._snapshotter = None
+
+    def check(self, chat_id, giver, receiver, now=None):
+        """ Register a hit if allowed. Returns None, or the name of the scope that rejects it """
+        now = time.time() if now is None else now
+        with self._lock:
+            keys = {scope: SCOPES[scope](chat_id, giver, receiver) for scope in self.windows}
+            for scope, window in self.windows.items():
+                if not window.allows(keys[scope], now):
+                    return scope
+            for scope, window in self.windows.items():
+                window.add(keys[scope], now)
+        return None
+
+    def retry_in(self, scope, chat_id, giver, receiver, now=None):
+        now = time.time() if now is None else now
+        with self._lock:
+            return self.windows[scope].retry_in(SCOPES[scope](chat_id, giver, receiver), now)
+
+    def notice(self, scope, chat_id, giver, now=None):
+        """ True at most once per giver in a chat per window of `scope`: whether to answer a rejection """
+        now = time.time() if now is None else now
+        key = (chat_id, giver)
+        with self._lock:
+            window = self.notices[scope]
+            if not window.allows(key, now):
+                return False
+            window.add(key, now)
+        return True
+
+    # # —— Snapshots
+    def start(self):
+        """ Restore the last snapshot and keep writing new ones in background """
+        self.load()
+        if self._snapshotter is None and self.snapshot_path and self.snapshot_interval:
+            self._stop_event.clear()
+            self._snapshotter = threading.Thread(target=self._snapshot_loop, name="rate-limiter-snapshots", daemon=True)
+            self._snapshotter.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._snapshotter is not None:
+            self._snapshotter.join()
+            self._snapshotter = None
+        self.save()
+
+    def _snapshot_loop(self):
+        while not self._stop_event.wait(self.snapshot_interval):
+            self.save()
+
+    def save(self):
+        if not self.snapshot_path:
+            return
+        with self._lock:
+            state = {scope: [[list(key), list(hits)] for key, hits in window.hits.items()]
+                     for scope, window in self.windows.items()}
+        try:
+            tmp_path = f"{self.snapshot_path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.snapshot_path)
+        except Exception as e:
+            logger.error(f"ERROR rate limiter snapshot: {e}")
+
+    def load(self):
+        if not (self.snapshot_path and os.path.isfile(self.snapshot_path)):
+            return
+        try:
+            with open(self.snapshot_path, "r") as f:
+                state = json.load(f)
+        except Exception as e:
+            logger.error(f"ERROR read rate limiter snapshot: {e}")
+            return
+        now = time.time()
+        with self._lock:
+            for scope, entries in state.items():
+                window = self.windows.get(scope)
+                if window is None:
+                    continue
+                for key, hits in entries:
+                    for hit in hits:
+                        if hit + window.seconds > now:
+                            window.add(tuple(key), hit)
+        logger.info(f"Rate limits restored from {self.snapshot_path}")
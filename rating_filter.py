@@ -0,0 +1,24 @@
+"""
+Pre-filter for rating messages.
+
+Only a text that starts with "+", "-" or one of the rating emoji can change a
+rating. `RatingPrefilter` turns the command tables into one dict once, so
+the check for every incoming message is a single lookup of the first
+character, and ordinary chatter is dropped before any handler runs.
+"""
+
+
+class RatingPrefilter:
+    """ First character of a text -> rating sign ("+" / "-") """
+
+    def __init__(self, commands, emoji_commands):
+        self.signs = {char: char for char in commands}
+        self.signs.update(emoji_commands)
+
+    def __call__(self, text):
+        """ True if the text may change a rating """
+        return bool(text) and text[0] in self.signs
+
+    def sign(self, text):
+        """ "+" / "-" for a rating text, None for anything else """
+        return self.signs.get(text[0]) if text else None
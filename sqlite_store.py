@@ -0,0 +1,324 @@
+"""
+SQLite storage backend for the plus bot user table.
+
+Same interface as `user_store.UserStore`, but every change is committed to a
+local SQLite database (WAL mode) right away, and rating changes are applied
+with a single `rating = rating + ?` statement inside a transaction, so
+concurrent "+" replies can not lose increments.
+
+`migrate_to_sqlite()` is a one-shot copy of the old gzip pickle and
+`user_data_base.json` ratings into a new SQLite database.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from user_store import read_user_table
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER UNIQUE,
+    username TEXT,
+    first_name TEXT,
+    last_name TEXT,
+    rating INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS users_username ON users (username COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS users_first_name ON users (first_name);
+"""
+
+# # Statements are constant strings: sqlite3 keeps them prepared in its statement cache
+SELECT_BY_ID = "SELECT id FROM users WHERE user_id = ?"
+SELECT_BY_USERNAME = "SELECT id FROM users WHERE username = ? COLLATE NOCASE LIMIT 1"
+SELECT_BY_FIRST_NAME = "SELECT id FROM users WHERE first_name = ? LIMIT 2"
+SELECT_ROW = "SELECT id, user_id, username, first_name, last_name, rating FROM users WHERE id = ?"
+SELECT_ALL = "SELECT id, user_id, username, first_name, last_name, rating FROM users ORDER BY id"
+SELECT_CHUNK = "SELECT id, user_id, username, first_name, last_name, rating FROM users WHERE id > ? ORDER BY id LIMIT ?"
+SELECT_COUNT = "SELECT COUNT(*) FROM users"
+SELECT_RATINGS = "SELECT user_id, username, rating FROM users"
+SELECT_USERS_BY_ID = "SELECT user_id, username, first_name, last_name, rating FROM users WHERE user_id IN ({})"
+SELECT_USERS_BY_USERNAME = "SELECT user_id, username, first_name, last_name, rating FROM users WHERE username COLLATE NOCASE IN ({})"
+UPDATE_RATING = "UPDATE users SET rating = ? WHERE id = ?"
+INCREMENT_RATING = "UPDATE users SET rating = rating + ? WHERE id = ?"
+UPDATE_NAMES = "UPDATE users SET user_id = ?, username = ?, first_name = ?, last_name = ? WHERE id = ?"
+INSERT_USER = "INSERT INTO users (user_id, username, first_name, last_name, rating) VALUES (?, ?, ?, ?, ?)"
+
+COLUMNS = ['index', 'user_id', 'username', 'first_name', 'last_name', 'rating']
+MAX_VARIABLES = 500  # parameters per IN (...) query
+
+
+class SQLiteUserStore:
+    """ User table in a local SQLite database (WAL mode) """
+
+    def __init__(self, path, timeout=5.0):
+        self.path = path
+        self.timeout = timeout
+        self._conn = None
+        self._lock = threading.RLock()
+
+    # # —— Lifecycle
+    def connect(self):
+        with self._lock:
+            if self._conn is None:
+                conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                                       check_same_thread=False, cached_statements=64)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                conn.executescript(SCHEMA)
+                self._conn = conn
+                logger.info(f"SQLite user database {self.path} opened. Records: {len(self)}")
+        return self._conn
+
+    def start(self):
+        self.connect()
+        return self
+
+    def stop(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def flush(self):
+        # # every change is already committed
+        return False
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            conn = self.connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    @staticmethod
+    def _find(conn, user_id=None, username=None, first_name=None):
+        """ Row id by user id, username or first name (the first key that matches) """
+        if user_id:
+            row = conn.execute(SELECT_BY_ID, (user_id,)).fetchone()
+            if row:
+                return row[0]
+        if username:
+            row = conn.execute(SELECT_BY_USERNAME, (username,)).fetchone()
+            if row:
+                return row[0]
+        if first_name:
+            rows = conn.execute(SELECT_BY_FIRST_NAME, (first_name,)).fetchall()
+            if len(rows) == 1:
+                return rows[0][0]
+        return None
+
+    def _row(self, user_id=None, username=None, first_name=None):
+        with self._lock:
+            conn = self.connect()
+            row_id = self._find(conn, user_id=user_id, username=username, first_name=first_name)
+            return conn.execute(SELECT_ROW, (row_id,)).fetchone() if row_id is not None else None
+
+    # # —— Queries
+    def snapshot(self):
+        """ Whole table as a pandas DataFrame (admin dumps) """
+        import pandas as pd
+
+        with self._lock:
+            rows = self.connect().execute(SELECT_ALL).fetchall()
+        return pd.DataFrame(rows, columns=COLUMNS)
+
+    def __len__(self):
+        with self._lock:
+            return self.connect().execute(SELECT_COUNT).fetchone()[0]
+
+    def get_user_id(self, username):
+        row = self._row(username=username)
+        return row[1] if row else None
+
+    def get_full_name(self, user_id):
+        row = self._row(user_id=user_id)
+        return (row[3], row[4]) if row else (None, None)
+
+    def get_rating(self, user_id=None, username=None, first_name=None):
+        # # the first supplied key decides, no fallback to the others
+        if user_id:
+            row = self._row(user_id=user_id)
+        elif username:
+            row = self._row(username=username)
+        elif first_name:
+            row = self._row(first_name=first_name)
+        else:
+            row = None
+        return row[5] if row else 0
+
+    def get_users(self, user_ids=(), usernames=()):
+        """ Batched lookup: {user id or lowercase username: (user_id, username, first_name, last_name, rating)} """
+        found = {}
+        user_ids, usernames = list(user_ids), list(usernames)
+        with self._lock:
+            conn = self.connect()
+            for start in range(0, len(user_ids), MAX_VARIABLES):
+                chunk = user_ids[start:start + MAX_VARIABLES]
+                for row in conn.execute(SELECT_USERS_BY_ID.format(",".join("?" * len(chunk))), chunk):
+                    found[row[0]] = row
+            for start in range(0, len(usernames), MAX_VARIABLES):
+                chunk = usernames[start:start + MAX_VARIABLES]
+                for row in conn.execute(SELECT_USERS_BY_USERNAME.format(",".join("?" * len(chunk))), chunk):
+                    found.setdefault(row[1].lower(), row)
+        return found
+
+    def iter_rows(self, chunk_size=10000):
+        """ Rows of the table in chunks (keyset pages: the connection is not held between chunks) """
+        last_id = 0
+        while True:
+            with self._lock:
+                rows = self.connect().execute(SELECT_CHUNK, (last_id, chunk_size)).fetchall()
+            if not rows:
+                return
+            yield rows
+            last_id = rows[-1][0]
+
+    def ratings(self):
+        """ (user_id, username, rating) of every user """
+        with self._lock:
+            return self.connect().execute(SELECT_RATINGS).fetchall()
+
+    # # —— Updates
+    def set_rating(self, rating, user_id=None, username=None, first_name=None):
+        """ Set rating of the user found by id, username or first name (in this order).
+            Returns the rating or 0 if the user is not found
+        """
+        with self._transaction() as conn:
+            row_id = self._find(conn, user_id=user_id, username=username, first_name=first_name)
+            if row_id is None:
+                logger.info(f"Fail! User by id:{user_id} / username:{username} — not found.")
+                return 0
+            conn.execute(UPDATE_RATING, (rating, row_id))
+        logger.info(f"Rating in DB updated. Row {row_id} R={rating}")
+        return rating
+
+    def add_rating(self, delta, user_id=None, username=None, first_name=None):
+        """ Atomically add `delta` to the user's rating.
+            Returns the new rating or None if the user is not found
+        """
+        with self._transaction() as conn:
+            row_id = self._find(conn, user_id=user_id, username=username, first_name=first_name)
+            if row_id is None:
+                return None
+            conn.execute(INCREMENT_RATING, (delta, row_id))
+            return conn.execute(SELECT_ROW, (row_id,)).fetchone()[5]
+
+    def add_ratings(self, changes):
+        """ add_rating() of every (delta, user_id, username) in one transaction; [new rating or None] """
+        ratings = []
+        with self._transaction() as conn:
+            for delta, user_id, username in changes:
+                row_id = self._find(conn, user_id=user_id, username=username)
+                if row_id is None:
+                    ratings.append(None)
+                    continue
+                conn.execute(INCREMENT_RATING, (delta, row_id))
+                ratings.append(conn.execute(SELECT_ROW, (row_id,)).fetchone()[5])
+        return ratings
+
+    def import_rows(self, rows):
+        """ Bulk load rows of COLUMNS in one transaction: a user found by id (or username) gets the names
+            and the rating of its row, the others are added. Returns (added, updated)
+        """
+        added = updated = 0
+        with self._transaction() as conn:
+            for _, user_id, username, first_name, last_name, rating in rows:
+                if _import_row(conn, user_id, username, first_name, last_name, rating):
+                    added += 1
+                else:
+                    updated += 1
+        return added, updated
+
+    def upsert_user(self, user_id=None, username=None, first_name=None, last_name=None, rating=None):
+        """ Create the user or refresh its names (looked up by id, then by username) """
+        with self._transaction() as conn:
+            row_id = self._find(conn, user_id=user_id)
+            if row_id is not None:
+                row = conn.execute(SELECT_ROW, (row_id,)).fetchone()
+                if row[2] == username:
+                    # Already updated
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug(f"{user_id} found in DB. No update.")
+                    return
+                conn.execute(UPDATE_NAMES, (user_id, username, first_name, last_name, row_id))
+                logger.info(f"Database updated by ID /{user_id}: @{username}, {first_name} {last_name}/")
+            elif (username is not None) and (self._find(conn, username=username) is not None):
+                row_id = self._find(conn, username=username)
+                row = conn.execute(SELECT_ROW, (row_id,)).fetchone()
+                conn.execute(UPDATE_NAMES, (user_id if user_id is not None else row[1], row[2], first_name, last_name, row_id))
+                logger.info(f"Database updated by USERNAME /{user_id}: @{username}, {first_name} {last_name}/")
+            else:
+                # Create a new row in the database (new user)
+                logger.info(f"[New user in DB] id:{user_id} username:{username} | {first_name} {last_name} | rating {rating}.")
+                conn.execute(INSERT_USER, (user_id, username, first_name, last_name, 1))
+                return
+            if rating:
+                conn.execute(UPDATE_RATING, (rating, row_id))
+
+
+def _import_row(conn, user_id, username, first_name, last_name, rating):
+    """ Insert or overwrite one user; True if added """
+    row_id = SQLiteUserStore._find(conn, user_id=user_id, username=username)
+    if row_id is not None and user_id is not None:
+        current = conn.execute(SELECT_ROW, (row_id,)).fetchone()
+        if current[1] not in (None, user_id):
+            # # the username belongs to another user now
+            row_id = None
+    if row_id is None:
+        conn.execute(INSERT_USER, (user_id, username, first_name, last_name, int(rating or 0)))
+        return True
+    if user_id is None:
+        user_id = conn.execute(SELECT_ROW, (row_id,)).fetchone()[1]
+    conn.execute(UPDATE_NAMES, (user_id, username, first_name, last_name, row_id))
+    conn.execute(UPDATE_RATING, (int(rating or 0), row_id))
+    return False
+
+
+def migrate_to_sqlite(pickle_path, json_path, sqlite_path):
+    """ One-shot copy of the pickle user table and the json ratings into a new SQLite database.
+        The pickle is authoritative; json ratings only add users missing from it.
+        Returns the number of migrated users.
+    """
+    store = SQLiteUserStore(sqlite_path).start()
+    if len(store) > 0:
+        store.stop()
+        raise RuntimeError(f"{sqlite_path} already has users, refusing to migrate over it")
+
+    rows = []
+    known_ids = set()
+    if os.path.isfile(pickle_path):
+        for _, user_id, username, first_name, last_name, rating in read_user_table(pickle_path):
+            if user_id is not None and user_id in known_ids:
+                logger.warning(f"Duplicate user id {user_id} skipped: @{username}")
+                continue
+            known_ids.add(user_id)
+            rows.append((user_id, username, first_name, last_name, int(rating) if rating is not None else 0))
+    else:
+        logger.warning(f"No database {pickle_path} is found.")
+
+    if os.path.isfile(json_path):
+        with open(json_path, "r") as f:
+            ratings = json.load(f)
+        for user_id, rating in ratings.items():
+            # # json keys are strings; "<id>_update" style keys are not ratings
+            if user_id.isdigit() and int(user_id) not in known_ids:
+                rows.append((int(user_id), None, None, None, int(rating)))
+                known_ids.add(int(user_id))
+
+    with store._transaction() as conn:
+        conn.executemany(INSERT_USER, rows)
+    logger.info(f"Migrated {len(rows)} users into {sqlite_path}")
+    store.stop()
+    return len(rows)
@@ -0,0 +1,133 @@
+"""
+Update processor for the bot `Application`.
+
+`ShardedUpdateProcessor` puts every update on one of a fixed number of worker
+queues, chosen by a shard key (by default the chat id). Each worker handles
+its queue strictly in order, different workers run in parallel, so a slow
+reply (e.g. a GIF upload) in one group no longer stalls all the others while
+updates sharing a key never overtake each other. It implements the
+`do_process_update()` hook: PTB's own semaphore around it admits
+`workers * queue_size` updates at a time, what the shard queues can hold.
+
+With concurrent updates the Application takes every update off its
+`update_queue` at once, so bounded shard queues alone hold nothing back.
+`InFlightQueue` is the `update_queue` that does: at most `limit` updates are
+in flight (queued, or taken and not processed yet) and intake — long polling
+or the webhook server — waits in `put()` until one is done (backpressure).
+"""
+
+import asyncio
+import logging
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+def chat_key(update):
+    """ Ordering key of an update: its chat id (None — no ordering needed) """
+    if isinstance(update, Update) and update.effective_chat is not None:
+        return update.effective_chat.id
+    return None
+
+
+class InFlightQueue(asyncio.Queue):
+    """ Application.update_queue admitting at most `limit` updates until the Application reports
+        them processed (`task_done()`, called after each update)
+    """
+
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+        self.in_flight = 0
+        self._room = asyncio.Event()
+
+    async def put(self, item):
+        # # only updates wait: the Application's own stop signal must always get through
+        while isinstance(item, Update) and self.in_flight >= self.limit:
+            self._room.clear()
+            await self._room.wait()
+        self.in_flight += 1
+        await super().put(item)
+
+    def task_done(self):
+        super().task_done()
+        self.in_flight -= 1
+        if self.in_flight < self.limit:
+            self._room.set()
+
+
+class ShardedUpdateProcessor(BaseUpdateProcessor):
+    """ Ordered within a shard, concurrent across `workers` shards """
+
+    def __init__(self, workers, queue_size=100, key=chat_key):
+        super().__init__(workers * queue_size)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.key = key
+        self._queues = []
+        self._workers = []
+        # # metrics
+        self.processed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def shard_of(self, update):
+        key = self.key(update)
+        return None if key is None else hash(key) % len(self._queues)
+
+    async def do_process_update(self, update, coroutine):
+        shard = self.shard_of(update) if self._queues else None
+        if shard is None:
+            await coroutine
+            return
+        done = asyncio.get_running_loop().create_future()
+        # # waits here while the shard queue is full
+        await self._queues[shard].put((time.monotonic(), coroutine, done))
+        await done
+
+    async def _work(self, queue):
+        while True:
+            queued_at, coroutine, done = await queue.get()
+            wait = time.monotonic() - queued_at
+            self.processed += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            try:
+                await coroutine
+            except Exception as e:
+                # # Application.process_update reports handler errors itself
+                logger.error(f"Update processing error: {e}")
+            finally:
+                queue.task_done()
+                if not done.done():
+                    done.set_result(None)
+
+    async def initialize(self):
+        self._queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        self._workers = [asyncio.create_task(self._work(queue), name=f"update-worker-{n}")
+                         for n, queue in enumerate(self._queues)]
+
+    async def shutdown(self):
+        for queue in self._queues:
+            await queue.join()
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        logger.info(f"Update workers stopped. {self.stats()}")
+        self._queues, self._workers = [], []
+
+    def stats(self):
+        """ Queue depths and time updates spent waiting in the queues (seconds) """
+        depths = [queue.qsize() for queue in self._queues]
+        return {
+            "workers": len(self._queues),
+            "queued": sum(depths),
+            "queue_depth_max": max(depths, default=0),
+            "queue_depths": depths,
+            "processed": self.processed,
+            "wait_avg": self.wait_total / self.processed if self.processed else 0.0,
+            "wait_max": self.wait_max,
+        }
@@ -0,0 +1,443 @@
+"""
+In-memory user repository for the plus bot.
+
+The user table is read from the gzip pickle once and then served from memory.
+Users are kept in a `UserTable` of column arrays (ints in `array('q')`,
+interned strings): a new user is one append per column, and a row label is
+its position. pandas is imported only to read a legacy DataFrame pickle and
+for admin dumps (`snapshot()`).
+Changes only mark the table as dirty; a background thread writes it back
+every `flush_interval` seconds and once more on shutdown (write-behind).
+Every write goes to a temporary file that is moved over the database with an
+atomic rename, so a crash in the middle of a flush never leaves a truncated
+pickle behind.
+"""
+
+import gzip
+import logging
+import os
+import pickle
+import sys
+import threading
+from array import array
+
+logger = logging.getLogger(__name__)
+
+USER_COLUMNS = ['index', 'user_id', 'username', 'first_name', 'last_name', 'rating']
+NO_ID = 0  # user_id column of users known only by username (Telegram ids are never 0)
+
+
+def _is_missing(value):
+    # None or NaN (empty cells of the pandas table)
+    return value is None or value != value
+
+
+def _clean(value):
+    """ Plain Python value of a pandas cell: NaN -> None, numpy scalar -> int/str/... """
+    if _is_missing(value):
+        return None
+    value = value.item() if hasattr(value, 'item') else value
+    if isinstance(value, float) and value.is_integer():
+        # # ids and ratings of a column with empty cells are floats in pandas
+        return int(value)
+    return _intern(value)
+
+
+def _intern(value):
+    # # first and last names repeat a lot: one string object per distinct name
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class UserTable:
+    """ Users as column arrays: numbers in `array('q')`, names in lists of interned strings.
+        A row label is the position; a new user is one append to every column.
+    """
+
+    __slots__ = tuple(USER_COLUMNS)
+
+    def __init__(self, rows=()):
+        self.index = array('q')
+        self.user_id = array('q')  # NO_ID for users known only by username
+        self.username = []
+        self.first_name = []
+        self.last_name = []
+        self.rating = array('q')
+        for row in rows:
+            self.append(*row)
+
+    def __len__(self):
+        return len(self.index)
+
+    def append(self, index, user_id, username, first_name, last_name, rating):
+        """ Add a user, returns its row label """
+        self.index.append(int(index or 0))
+        self.user_id.append(NO_ID if user_id is None else int(user_id))
+        self.username.append(_intern(username))
+        self.first_name.append(_intern(first_name))
+        self.last_name.append(_intern(last_name))
+        self.rating.append(int(rating or 0))
+        return len(self.index) - 1
+
+    def get_user_id(self, label):
+        user_id = self.user_id[label]
+        return None if user_id == NO_ID else user_id
+
+    def set(self, label, column, value):
+        if column == 'user_id':
+            value = NO_ID if value is None else int(value)
+        elif column in ('username', 'first_name', 'last_name'):
+            value = _intern(value)
+        getattr(self, column)[label] = value
+
+    def row(self, label):
+        """ (index, user_id, username, first_name, last_name, rating) """
+        return (self.index[label], self.get_user_id(label), self.username[label], self.first_name[label],
+                self.last_name[label], self.rating[label])
+
+    def rows(self):
+        return [self.row(label) for label in range(len(self))]
+
+    def to_frame(self):
+        """ The table as a pandas DataFrame (admin dumps only) """
+        return rows_to_frame(self.rows())
+
+
+def rows_to_frame(rows):
+    # # pandas is heavy: imported for an admin dump, not with the module
+    import pandas as pd
+
+    return pd.DataFrame(rows, columns=USER_COLUMNS)
+
+
+def read_user_table(path):
+    """ Rows (tuples of USER_COLUMNS) of a user table file: records, or the legacy pandas pickle """
+    with gzip.open(path, "rb") as f:
+        try:
+            data = pickle.load(f)
+        except Exception:
+            data = None
+    if isinstance(data, dict) and data.get("columns") == USER_COLUMNS:
+        return [tuple(row) for row in data["rows"]]
+    if data is None or not hasattr(data, 'itertuples'):
+        # # pickled by another pandas version
+        import pandas as pd
+
+        data = pd.read_pickle(path, compression="gzip")
+    return [tuple(_clean(value) for value in row) for row in data[USER_COLUMNS].itertuples(index=False)]
+
+
+class UserIndex:
+    """ Hash indexes over the user table: row labels by id, lowercase username and first name.
+        First names are not unique, so a first name resolves only when exactly one user has it.
+    """
+
+    def __init__(self):
+        self.by_id = {}
+        self.by_username = {}
+        self.by_first_name = {}
+
+    @staticmethod
+    def username_key(username):
+        return username.lower() if isinstance(username, str) else None
+
+    def rebuild(self, users):
+        self.by_id.clear()
+        self.by_username.clear()
+        self.by_first_name.clear()
+        for label in range(len(users)):
+            self.add(label, users.get_user_id(label), users.username[label], users.first_name[label])
+
+    def add(self, label, user_id, username, first_name):
+        if not _is_missing(user_id):
+            self.by_id.setdefault(user_id, label)
+        username = self.username_key(username)
+        if username:
+            self.by_username.setdefault(username, label)
+        if not _is_missing(first_name):
+            self.by_first_name.setdefault(first_name, set()).add(label)
+
+    def remove(self, label, user_id, username, first_name):
+        if not _is_missing(user_id) and self.by_id.get(user_id) == label:
+            del self.by_id[user_id]
+        username = self.username_key(username)
+        if username and self.by_username.get(username) == label:
+            del self.by_username[username]
+        if not _is_missing(first_name):
+            labels = self.by_first_name.get(first_name, set())
+            labels.discard(label)
+            if not labels:
+                self.by_first_name.pop(first_name, None)
+
+    def find(self, user_id=None, username=None, first_name=None):
+        """ Row label by id, username or first name (the first key that matches), None if not found """
+        if user_id and user_id in self.by_id:
+            return self.by_id[user_id]
+        username = self.username_key(username)
+        if username and username in self.by_username:
+            return self.by_username[username]
+        labels = self.by_first_name.get(first_name) if first_name else None
+        if labels and len(labels) == 1:
+            return next(iter(labels))
+        return None
+
+    def __len__(self):
+        return len(self.by_id)
+
+
+class UserStore:
+    """ Process-wide user table (UserTable) with write-behind persistence """
+
+    def __init__(self, path, flush_interval=5.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.users = None
+        self.index = UserIndex()
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._dirty = False
+        self._stop_event = threading.Event()
+        self._flusher = None
+        self.bytes_written = 0
+
+    # # —— Lifecycle
+    def load(self):
+        with self._lock:
+            if os.path.isfile(self.path):
+                users = UserTable(read_user_table(self.path))
+                logger.info(f"User database {self.path} loaded. Records: {len(users)}")
+            else:
+                logger.warning(f"No database {self.path} is found.")
+                users = UserTable()
+            self.users = users
+            self.index.rebuild(users)
+            self._dirty = False
+        return self
+
+    def start(self):
+        """ Load the table (if not yet) and start the background flusher """
+        self._ensure_loaded()
+        if self._flusher is None and self.flush_interval:
+            self._stop_event.clear()
+            self._flusher = threading.Thread(target=self._flush_loop, name="user-store-flusher", daemon=True)
+            self._flusher.start()
+        return self
+
+    def stop(self):
+        """ Stop the background flusher and write pending changes """
+        self._stop_event.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        self.flush()
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def _ensure_loaded(self):
+        if self.users is None:
+            self.load()
+        return self.users
+
+    # # —— Persistence
+    def mark_dirty(self):
+        self._dirty = True
+
+    def flush(self):
+        """ Write the table to disk if it has changed since the last flush """
+        with self._flush_lock:
+            with self._lock:
+                if not self._dirty or self.users is None:
+                    return False
+                snapshot = self.users.rows()
+                self._dirty = False
+            try:
+                self._write_atomic(snapshot)
+            except Exception as e:
+                logger.error(f"ERROR flush user database: {e}")
+                self._dirty = True
+                return False
+        logger.info(f"Database flushed. Records: {len(snapshot)}")
+        return True
+
+    def _write_atomic(self, rows):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb") as gz:
+                pickle.dump({"columns": USER_COLUMNS, "rows": rows}, gz, protocol=pickle.HIGHEST_PROTOCOL)
+            raw.flush()
+            os.fsync(raw.fileno())
+            self.bytes_written += raw.tell()
+        os.replace(tmp_path, self.path)
+
+    # # —— Queries
+    def snapshot(self):
+        """ Copy of the whole table as a pandas DataFrame (admin dumps) """
+        with self._lock:
+            rows = self._ensure_loaded().rows()
+        return rows_to_frame(rows)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._ensure_loaded())
+
+    def get_user_id(self, username):
+        with self._lock:
+            users = self._ensure_loaded()
+            label = self.index.find(username=username)
+            return users.get_user_id(label) if label is not None else None
+
+    def get_full_name(self, user_id):
+        with self._lock:
+            users = self._ensure_loaded()
+            label = self.index.find(user_id=user_id)
+            if label is None:
+                return (None, None)
+            return (users.first_name[label], users.last_name[label])
+
+    def get_rating(self, user_id=None, username=None, first_name=None):
+        with self._lock:
+            users = self._ensure_loaded()
+            # # the first supplied key decides, no fallback to the others
+            if user_id:
+                label = self.index.find(user_id=user_id)
+            elif username:
+                label = self.index.find(username=username)
+            elif first_name:
+                label = self.index.find(first_name=first_name)
+            else:
+                label = None
+            return users.rating[label] if label is not None else 0
+
+    def get_users(self, user_ids=(), usernames=()):
+        """ Batched lookup: {user id or lowercase username: (user_id, username, first_name, last_name, rating)} """
+        with self._lock:
+            users = self._ensure_loaded()
+            found = {}
+            keys = [(user_id, self.index.find(user_id=user_id)) for user_id in user_ids]
+            keys += [(UserIndex.username_key(username), self.index.find(username=username)) for username in usernames]
+            for key, label in keys:
+                if label is not None:
+                    found[key] = users.row(label)[1:]
+            return found
+
+    def iter_rows(self, chunk_size=10000):
+        """ Rows of the table in chunks, each copied under the lock: exports do not hold it for long """
+        start = 0
+        while True:
+            with self._lock:
+                users = self._ensure_loaded()
+                rows = [users.row(label) for label in range(start, min(start + chunk_size, len(users)))]
+            if not rows:
+                return
+            yield rows
+            start += len(rows)
+
+    def ratings(self):
+        """ (user_id, username, rating) of every user """
+        with self._lock:
+            users = self._ensure_loaded()
+            return [(users.get_user_id(label), users.username[label], users.rating[label]) for label in range(len(users))]
+
+    # # —— Updates
+    def set_rating(self, rating, user_id=None, username=None, first_name=None):
+        """ Set rating of the user found by id, username or first name (in this order).
+            Returns the rating or 0 if the user is not found
+        """
+        with self._lock:
+            users = self._ensure_loaded()
+            label = self.index.find(user_id=user_id, username=username, first_name=first_name)
+            if label is None:
+                logger.info(f"Fail! User by id:{user_id} / username:{username} — not found.")
+                return 0
+            users.rating[label] = rating
+            logger.info(f"Rating in DB updated. Id {users.get_user_id(label)}: @{users.username[label]} R={rating}")
+            self.mark_dirty()
+            return rating
+
+    def add_rating(self, delta, user_id=None, username=None, first_name=None):
+        """ Add `delta` to the user's rating.
+            Returns the new rating or None if the user is not found
+        """
+        with self._lock:
+            users = self._ensure_loaded()
+            label = self.index.find(user_id=user_id, username=username, first_name=first_name)
+            if label is None:
+                return None
+            users.rating[label] += delta
+            self.mark_dirty()
+            return users.rating[label]
+
+    def add_ratings(self, changes):
+        """ add_rating() of every (delta, user_id, username) at once; [new rating or None] """
+        with self._lock:
+            return [self.add_rating(delta, user_id=user_id, username=username) for delta, user_id, username in changes]
+
+    def upsert_user(self, user_id=None, username=None, first_name=None, last_name=None, rating=None):
+        """ Create the user or refresh its names (looked up by id, then by username) """
+        with self._lock:
+            users = self._ensure_loaded()
+            label = self.index.find(user_id=user_id)
+            if label is not None and users.username[label] == username:
+                # Already updated (every reply gets here: no formatting unless debugging)
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"{user_id} found in DB. Records: {len(users)}. No update.")
+                return
+
+            elif label is not None:
+                self._update_row(label, username=username, first_name=first_name, last_name=last_name)
+                logger.info(f"Database updated by ID. Records: {len(users)} /{user_id}: @{username}, {first_name} {last_name}/")
+
+            elif (username is not None) and (self.index.find(username=username) is not None):
+                label = self.index.find(username=username)
+                fields = dict(first_name=first_name, last_name=last_name)
+                if user_id is not None:
+                    fields['user_id'] = user_id
+                self._update_row(label, **fields)
+                logger.info(f"Database updated by USERNAME. Records: {len(users)} /{user_id}: @{username}, {first_name} {last_name}/")
+
+            else:
+                # Create a new row in the database (new user)
+                logger.info(f"[New user in DB] id:{user_id} username:{username} | {first_name} {last_name} | rating {rating}.")
+                label = users.append(len(users) + 1, user_id, username, first_name, last_name, 1)
+                self.index.add(label, user_id, username, first_name)
+                rating = None
+
+            if rating:
+                users.rating[label] = rating
+            self.mark_dirty()
+
+    def import_rows(self, rows):
+        """ Bulk load rows of USER_COLUMNS: a user found by id (or username) gets the names and the rating
+            of its row, the others are added. Returns (added, updated)
+        """
+        added = updated = 0
+        with self._lock:
+            users = self._ensure_loaded()
+            for _, user_id, username, first_name, last_name, rating in rows:
+                label = self.index.find(user_id=user_id, username=username)
+                if label is not None and user_id is not None and users.get_user_id(label) not in (None, user_id):
+                    # # the username belongs to another user now
+                    label = None
+                if label is None:
+                    label = users.append(len(users) + 1, user_id, username, first_name, last_name, rating)
+                    self.index.add(label, user_id, username, first_name)
+                    added += 1
+                    continue
+                fields = dict(username=username, first_name=first_name, last_name=last_name)
+                if user_id is not None:
+                    fields['user_id'] = user_id
+                self._update_row(label, **fields)
+                users.rating[label] = int(rating or 0)
+                updated += 1
+            self.mark_dirty()
+        return added, updated
+
+    def _update_row(self, label, **fields):
+        """ Change some columns of a row and keep the indexes in sync """
+        users = self.users
+        old_keys = (users.get_user_id(label), users.username[label], users.first_name[label])
+        for column, value in fields.items():
+            users.set(label, column, value)
+        self.index.remove(label, *old_keys)
+        self.index.add(label, users.get_user_id(label), users.username[label], users.first_name[label])
@@ -0,0 +1,161 @@
+"""
+Webhook ingestion: an embedded HTTP server for Telegram update POSTs.
+
+`WebhookServer` speaks just enough HTTP/1.1 (keep-alive, Content-Length
+bodies) to take updates from Telegram, or from a load balancer in front of
+several bot instances. A request is checked before its body is read: path,
+method, the `X-Telegram-Bot-Api-Secret-Token` header and the body size
+limit. Bodies are decoded in a thread pool, the decoded update is handed to
+`deliver` (e.g. `application.update_queue.put`), and only then the request
+is answered 200, so a full update queue slows Telegram down instead of
+losing updates. At most `max_concurrency` requests are decoded and
+delivered at a time.
+"""
+
+import asyncio
+import hmac
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "x-telegram-bot-api-secret-token"
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    401: "Unauthorized",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    411: "Length Required",
+    413: "Payload Too Large",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status):
+        super().__init__(REASONS.get(status, str(status)))
+        self.status = status
+
+
+class WebhookServer:
+    """ Telegram webhook endpoint: POST <path> with a JSON update """
+
+    def __init__(self, deliver, decode=json.loads, listen="127.0.0.1", port=8443, path="/", secret_token=None,
+                 max_body_bytes=1024 * 1024, max_concurrency=40, decode_workers=2, keepalive_timeout=75):
+        self.deliver = deliver  # async callable(update)
+        self.decode = decode  # callable(body bytes) -> update, runs in the decode pool
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.max_body_bytes = max_body_bytes
+        self.max_concurrency = max_concurrency
+        self.decode_workers = decode_workers
+        self.keepalive_timeout = keepalive_timeout
+        self._server = None
+        self._executor = None
+        self._in_flight = None
+        # # metrics
+        self.accepted = 0
+        self.rejected = 0
+
+    # # —— Lifecycle
+    async def start(self):
+        self._executor = ThreadPoolExecutor(max_workers=self.decode_workers, thread_name_prefix="webhook-decode")
+        self._in_flight = asyncio.Semaphore(self.max_concurrency)
+        self._server = await asyncio.start_server(self._serve, self.listen, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]  # the real one if 0 was given
+        logger.info(f"Webhook server listening on {self.listen}:{self.port}{self.path}")
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        logger.info(f"Webhook server stopped: {self.accepted} updates accepted, {self.rejected} requests rejected")
+
+    # # —— HTTP
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.keepalive_timeout)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                try:
+                    keep_alive = await self._handle(request_line, reader)
+                    status = 200
+                except HTTPError as e:
+                    status, keep_alive = e.status, False
+                    self.rejected += 1
+                writer.write(f"HTTP/1.1 {status} {REASONS[status]}\r\nContent-Length: 0\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode())
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            logger.error(f"ERROR webhook connection: {e}")
+        finally:
+            writer.close()
+
+    async def _handle(self, request_line, reader):
+        """ Read and deliver one request; returns whether to keep the connection """
+        try:
+            method, target, version = request_line.decode("latin-1").split()
+        except ValueError:
+            raise HTTPError(400)
+        headers = await self._read_headers(reader)
+        if target.split("?", 1)[0] != self.path:
+            raise HTTPError(404)
+        if method != "POST":
+            raise HTTPError(405)
+        if self.secret_token and not hmac.compare_digest(headers.get(SECRET_HEADER, ""), self.secret_token):
+            raise HTTPError(401)
+        length = headers.get("content-length")
+        if length is None or not length.isdigit():
+            raise HTTPError(411)
+        if int(length) > self.max_body_bytes:
+            raise HTTPError(413)
+        body = await reader.readexactly(int(length))
+
+        async with self._in_flight:
+            loop = asyncio.get_running_loop()
+            try:
+                update = await loop.run_in_executor(self._executor, self.decode, body)
+            except Exception as e:
+                logger.warning(f"Webhook: bad update body: {e}")
+                raise HTTPError(400)
+            try:
+                await self.deliver(update)
+            except Exception as e:
+                logger.error(f"ERROR webhook deliver: {e}")
+                raise HTTPError(500)
+        self.accepted += 1
+        connection = headers.get("connection", "").lower()
+        return connection != "close" and (version != "HTTP/1.0" or connection == "keep-alive")
+
+    async def _read_headers(self, reader):
+        headers = {}
+        while True:
+            try:
+                line = await reader.readline()
+            except (asyncio.LimitOverrunError, ValueError):
+                raise HTTPError(431)
+            if line in (b"\r\n", b"\n", b""):
+                return headers
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+            if len(headers) > 100:
+                raise HTTPError(431)